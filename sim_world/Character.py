@@ -1,11 +1,22 @@
 from __future__ import annotations
-from pydantic import BaseModel, Field, ValidationError
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
 from enum import Enum
+import asyncio
+import functools
 import json
-import os
-from typing import List, Optional, Dict, Any
+import time
+from typing import List, Optional, Dict, Any, Set, Tuple
 from chat import fix_character, new_character
 import util
+import repair as schema_repair
+import http_cache
+from structured_log import get_logger
+from storage import get_store, leave_batch
+from population import Population
+
+log = get_logger("Character")
+
+LOAD_BATCH_SIZE = 256
 
 
 class Gender(str, Enum):
@@ -144,7 +155,78 @@ class SkillsAndAbilities(BaseModel):
 
 
 class CharacterStore:
-    _all_characters: Dict[int, "Character"] = {}
+    # every loaded character as a row, models are built on demand
+    population = Population()
+    _loaded = False
+    # the event loop the lock and the queue below were made in, see _bind_loop
+    _loop: Optional[asyncio.AbstractEventLoop] = None
+    _load_lock: Optional[asyncio.Lock] = None
+    # (id, raw JSON) of characters waiting for an LLM repair
+    _repair_queue: Optional["asyncio.Queue[Tuple[int, str]]"] = None
+    # ids queued for a repair and not fixed yet, missing from population
+    unrepaired: Set[int] = set()
+    _repair_task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def _bind_loop(cls) -> None:
+        """
+        Make the lock and the queue in the running loop, on first use and
+        again when a test or script runs a new loop. Repairs left in the queue
+        of a loop that is gone move to the new one.
+        """
+        loop = asyncio.get_running_loop()
+        if cls._loop is loop:
+            return
+        pending = []
+        while cls._repair_queue is not None and not cls._repair_queue.empty():
+            pending.append(cls._repair_queue.get_nowait())
+        cls._loop = loop
+        cls._load_lock = asyncio.Lock()
+        cls._repair_queue = asyncio.Queue()
+        cls._repair_task = None
+        for item in pending:
+            cls._repair_queue.put_nowait(item)
+        if pending:
+            cls.start_repair_worker()
+
+    @classmethod
+    def get_load_lock(cls) -> asyncio.Lock:
+        cls._bind_loop()
+        return cls._load_lock
+
+    @classmethod
+    def get_repair_queue(cls) -> "asyncio.Queue[Tuple[int, str]]":
+        cls._bind_loop()
+        return cls._repair_queue
+
+    @classmethod
+    def restore(cls, population: Population) -> None:
+        """
+        Use characters validated earlier, e.g. from a snapshot, instead of loading.
+        """
+        cls.population = population
+        cls._loaded = True
+
+    @classmethod
+    def start_repair_worker(cls) -> None:
+        if cls._repair_task is None or cls._repair_task.done():
+            cls._repair_task = asyncio.create_task(cls._repair_worker())
+
+    @classmethod
+    async def _repair_worker(cls) -> None:
+        # it may be started during a day, its saves are not part of the day's batch
+        leave_batch()
+        repair_queue = cls.get_repair_queue()
+        while not repair_queue.empty():
+            character_id, raw = repair_queue.get_nowait()
+            try:
+                # save() puts the repaired character into the store
+                await Character.repair(character_id, raw)
+                cls.unrepaired.discard(character_id)
+            except Exception as e:
+                log.error(f"Failed to repair character {character_id}: {e}")
+            finally:
+                repair_queue.task_done()
 
 
 class Character(BaseModel):
@@ -161,14 +243,34 @@ class Character(BaseModel):
     lowlight_3_max: List[Event]
 
     def save(self):
-        os.makedirs("characters", exist_ok=True)
-        file_path = f"characters/{self.basic_info.id}.json"
-
-        with open(file_path, "w") as f:
-            json.dump(self.model_dump(), f, indent=2)
-
-        if CharacterStore._all_characters is not None:
-            CharacterStore._all_characters[self.basic_info.id] = self
+        Character.save_record(self.model_dump(mode="json"))
+
+    @staticmethod
+    def save_record(data: Dict[str, Any]) -> None:
+        """
+        Save a character in its JSON form, without building the model.
+        """
+        character_id = data["basic_info"]["id"]
+        get_store().save_character(character_id, data["basic_info"]["city"], data)
+        CharacterStore.population.put(data)
+        http_cache.invalidate("Character", character_id)
+
+    @staticmethod
+    def save_population_records(character_ids: List[int]) -> List[Dict[str, Any]]:
+        """
+        Save characters changed in the population table, e.g. by
+        Population.set_traits, in one store write.
+
+        Returns:
+            Their JSON form, in the order of character_ids.
+        """
+        records = CharacterStore.population.records(character_ids)
+        get_store().save_characters(
+            {data["basic_info"]["id"]: (data["basic_info"]["city"], data) for data in records}
+        )
+        for character_id in character_ids:
+            http_cache.invalidate("Character", character_id)
+        return records
 
     @classmethod
     def get_schema(cls) -> Dict[str, Any]:
@@ -176,65 +278,214 @@ class Character(BaseModel):
 
     @classmethod
     async def load_from_json(cls, character_id: int):
-        file_path = f"characters/{character_id}.json"
-        if not os.path.exists(file_path):
-            raise FileNotFoundError(f"Character file not found: {file_path}")
-
-        with open(file_path, "r") as f:
-            data = json.load(f)
+        data = get_store().load_character(character_id)
+        if data is None:
+            raise FileNotFoundError(f"Character not found: {character_id}")
+        return await cls.load_from_dict(character_id, data)
 
+    @classmethod
+    async def load_from_dict(cls, character_id: int, data: Dict[str, Any]):
         try:
             return cls(**data)
         except ValidationError:
-            print(
+            return await cls.repair(character_id, json.dumps(data))
+
+    @classmethod
+    def repair_locally(cls, character_id: int, raw_json: str) -> Optional["Character"]:
+        """
+        Schema-driven repair without the LLM, None if errors remain.
+        """
+        try:
+            data = json.loads(raw_json)
+        except json.JSONDecodeError:
+            return None
+        changes = []
+        basic_info = data.get("basic_info") if isinstance(data, dict) else None
+        # the id is the one thing known for sure, the one it is stored under
+        if isinstance(basic_info, dict) and basic_info.get("id") is None:
+            basic_info["id"] = character_id
+            changes.append(f"basic_info/id: missing, set to {character_id} from the store")
+        result = schema_repair.repair(cls, data)
+        if result.value is None:
+            return None
+        schema_repair.repair_stats["local"] += 1
+        changes += result.changes
+        log.info(f"Repaired character {character_id} locally: {'; '.join(changes)}")
+        return result.value
+
+    @classmethod
+    async def repair(cls, character_id: int, raw_json: str):
+        character = cls.repair_locally(character_id, raw_json)
+        if character is None:
+            log.warning(
                 f"Validation error occurred for character {character_id}. Attempting to fix with chat..."
             )
+            schema_repair.repair_stats["llm"] += 1
+            character = await cls.fix_with_chat(character_id, raw_json)
+        cls._check_repaired_id(character_id, character)
+        character.save()
+        return character
+
+    @staticmethod
+    def _check_repaired_id(character_id: int, character: "Character") -> None:
+        if character.basic_info.id != character_id:
+            # saving it would overwrite another character
+            raise ValueError(
+                f"Repair of character {character_id} returned id {character.basic_info.id}"
+            )
 
-            fixed_data = await cls.fix_with_chat(json.dumps(data))
-            character = cls(**json.loads(fixed_data))
-            character.save()
+    @classmethod
+    async def fix_with_chat(cls, character_id: int, user_data_json) -> "Character":
+        def accept(response: str) -> Character:
+            result = util.extract_longest_json(response)
+            if result is None:
+                raise ValueError("No character JSON found in the repair response")
+            character = schema_repair.validate_or_repair(
+                cls, json.loads(result), f"{character_id} from fix_with_chat"
+            )
+            cls._check_repaired_id(character_id, character)
             return character
 
+        return await fix_character(user_data_json, accept=accept)
+
     @classmethod
-    async def fix_with_chat(cls, user_data_json):
-        result = util.extract_longest_json(await fix_character(user_data_json))
-        print(result)
-        return result
+    def _load_batch(cls, batch: List[Tuple[int, str]]):
+        """
+        _validate_batch, with the valid characters in JSON form.
+        """
+        characters, repaired, invalid = cls._validate_batch(batch)
+        return [c.model_dump(mode="json") for c in characters], repaired, invalid
 
     @classmethod
-    async def load_all_characters(cls):
-        characters_dir = "characters"
-        if not os.path.exists(characters_dir):
-            print(
-                f"Warning: {characters_dir} directory not found. No characters loaded."
+    def _validate_batch(
+        cls, batch: List[Tuple[int, str]]
+    ) -> Tuple[List["Character"], List["Character"], List[Tuple[int, str]]]:
+        """
+        Validate raw JSON characters, all at once when they are all valid.
+
+        Returns:
+            the valid characters, the ones repaired locally, which need to be
+            saved, and (id, raw JSON) of those left for the LLM.
+        """
+        try:
+            characters = _character_list_adapter().validate_json(
+                "[" + ",".join(raw for _, raw in batch) + "]"
             )
+            return characters, [], []
+        except ValidationError:
+            pass
+        characters, repaired, invalid = [], [], []
+        for character_id, raw in batch:
+            try:
+                characters.append(cls.model_validate_json(raw))
+            except ValidationError:
+                character = cls.repair_locally(character_id, raw)
+                if character is None:
+                    invalid.append((character_id, raw))
+                else:
+                    repaired.append(character)
+        return characters, repaired, invalid
+
+    @classmethod
+    async def load_all_characters(cls):
+        """
+        Read, parse and validate every character off the event loop, in batches.
+        Characters that need a repair by the LLM are queued and added to the
+        store when fixed, startup does not wait for them.
+        """
+        start = time.perf_counter()
+        all_raw = await asyncio.to_thread(get_store().load_all_raw_characters)
+        if not all_raw:
+            log.warning("No characters found. No characters loaded.")
             return
+        read_time = time.perf_counter() - start
+
+        items = sorted(all_raw.items())
+        batches = [
+            items[i : i + LOAD_BATCH_SIZE] for i in range(0, len(items), LOAD_BATCH_SIZE)
+        ]
+        results = await asyncio.gather(
+            *[asyncio.to_thread(cls._load_batch, batch) for batch in batches]
+        )
+        invalid = []
+        for records, repaired, batch_invalid in results:
+            for data in records:
+                CharacterStore.population.put(data)
+            for character in repaired:
+                character.save()
+            invalid.extend(batch_invalid)
+        for character_id, raw in invalid:
+            if character_id in CharacterStore.unrepaired:
+                # already queued by an earlier load
+                continue
+            CharacterStore.unrepaired.add(character_id)
+            CharacterStore.get_repair_queue().put_nowait((character_id, raw))
+        if invalid:
+            CharacterStore.start_repair_worker()
+
+        elapsed = time.perf_counter() - start
+        log.info(
+            f"Loaded {len(CharacterStore.population)} characters in {elapsed:.2f}s "
+            f"(read {read_time:.2f}s, {len(items) / elapsed:.0f} characters/s), "
+            f"{len(invalid)} queued for repair."
+        )
 
-        for filename in os.listdir(characters_dir):
-            if filename.endswith(".json"):
-                character_id = int(filename.split(".")[0])
-                character = await cls.load_from_json(character_id)
-                if character:
-                    CharacterStore._all_characters[character_id] = character
+    @classmethod
+    async def ensure_loaded(cls):
+        async with CharacterStore.get_load_lock():
+            if not CharacterStore._loaded:
+                await cls.load_all_characters()
+                CharacterStore._loaded = True
 
-        print(f"Loaded {len(CharacterStore._all_characters)} characters.")
+    @classmethod
+    async def reload(cls):
+        """
+        Load every character again from the store, dropping what only changed
+        in memory, e.g. after a failed day. Readers wait until it is done.
+        """
+        async with CharacterStore.get_load_lock():
+            CharacterStore.population = Population()
+            CharacterStore._loaded = False
+            await cls.load_all_characters()
+            CharacterStore._loaded = True
 
     @classmethod
     async def get_character(cls, character_id: int):
-        if not CharacterStore._all_characters:
-            await cls.load_all_characters()
-        return CharacterStore._all_characters.get(character_id)
+        await cls.ensure_loaded()
+        data = CharacterStore.population.record(character_id)
+        return cls.model_validate(data) if data is not None else None
 
     @classmethod
     async def get_all_characters(cls) -> List["Character"]:
-        if not CharacterStore._all_characters:
-            await cls.load_all_characters()
-        return list(CharacterStore._all_characters.values())
+        """
+        Builds a model of everyone, for population-wide questions use
+        get_population instead.
+        """
+        await cls.ensure_loaded()
+        return [cls.model_validate(data) for data in CharacterStore.population.records()]
+
+    @classmethod
+    async def get_characters(cls, character_ids: List[int]) -> List["Character"]:
+        """
+        Models of the given characters, skipping unknown ids.
+        """
+        await cls.ensure_loaded()
+        records = CharacterStore.population.records(character_ids)
+        return [cls.model_validate(data) for data in records if data is not None]
+
+    @classmethod
+    async def get_population(cls) -> Population:
+        await cls.ensure_loaded()
+        return CharacterStore.population
 
     @classmethod
     async def create_new_character(cls, note) -> "Character":
-        c = await new_character(note, 4)
-        print(c)
-        c = cls(**json.loads(c))
+        c = await new_character(note, 4, accept=lambda content: cls(**json.loads(content)))
+        log.info(f"Created character {c.basic_info.id}", note=note)
         c.save()
         return c
+
+
+@functools.lru_cache(maxsize=1)
+def _character_list_adapter() -> TypeAdapter:
+    return TypeAdapter(List[Character])
@@ -1,15 +1,31 @@
 from __future__ import annotations
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 import json
-import os
-from typing import List, Dict, Any
+from typing import Any, Callable, Dict, List, Optional
 from Character import Event, Character
 from datetime import datetime, timedelta
-from chat import chat_sim_one_day, world_process_event
+from chat import LLM_MAX_CONCURRENCY, chat_sim_one_day_stream, world_process_event
+from llm_cache import response_cache
+from prompt_compiler import get_prompt_stats
 import asyncio
+import random
+import numpy as np
 import time
-from websocket_service import notify_update_in_background
+from websocket_service import notify_update_in_background, notify_updates_in_background
+from event_pipeline import EventPipeline, StartTimeGate
+from day_shards import shard_characters, cross_shard_candidates, index_characters
+from relationships import RELATIONSHIPS_PATH, get_graph
 import util
+import trait_evolution
+from repair import validate_or_repair, get_repair_stats
+import metrics
+from structured_log import correlate, get_logger
+from storage import get_store
+from event_log import get_event_log
+from memory import get_memory_store
+import workers
+
+log = get_logger("World")
 
 
 class Weather(BaseModel):
@@ -28,30 +44,27 @@ class World(BaseModel):
 
     @classmethod
     def load_from_local(cls) -> World:
-        file_path = "world.json"
-        if not os.path.exists(file_path):
-            raise FileNotFoundError(f"World file not found: {file_path}")
-
-        with open(file_path, "r") as f:
-            data = json.load(f)
-            return cls(**data)
+        data = get_store().load_world()
+        if data is None:
+            raise FileNotFoundError(f"World not found in {get_store().__class__.__name__}")
+        return cls(**data)
 
     @classmethod
     def load_from_json_str(cls, json_str) -> World:
         return cls(**json.loads(json_str))
 
+    def next_date(self) -> str:
+        current_date = datetime.strptime(self.date, "%Y-%m-%d")
+        return (current_date + timedelta(days=1)).strftime("%Y-%m-%d")
+
     def advance_date(self) -> None:
         """
         Move the date forward by one day.
         """
-        current_date = datetime.strptime(self.date, "%Y-%m-%d")
-        next_date = current_date + timedelta(days=1)
-        self.date = next_date.strftime("%Y-%m-%d")
+        self.date = self.next_date()
 
     def save(self) -> None:
-        file_path = f"world.json"
-        with open(file_path, "w") as f:
-            json.dump(self.model_dump(), f, indent=2)
+        get_store().save_world(self.model_dump(mode="json"))
 
     def get_current_date(self) -> str:
         """
@@ -62,58 +75,456 @@ class World(BaseModel):
         """
         return self.date
 
-    async def sim_one_day(self):
+    async def sim_one_day(self, progress: Optional[Dict[str, Any]] = None) -> World:
+        """
+        Simulate the next day and save it. self is left unchanged, the caller
+        swaps in the returned world.
+
+        Args:
+            progress: updated while the day runs, see jobs.Job.
+        """
+        progress = progress if progress is not None else {}
+        # one transaction per day, a crash halfway leaves the previous day intact
+        with correlate(day=self.next_date()), metrics.stage("sim_one_day"):
+            async with get_event_log().transaction(), get_store().batch():
+                new_world = await self._sim_one_day(progress)
+                progress["stage"] = "saving"
+        progress["stage"] = "done"
+        return new_world
+
+    async def _sim_one_day(self, progress: Dict[str, Any]) -> World:
         start_time = time.time()
-        all_characters = await Character.get_all_characters()
-        self.advance_date()
-        current_date = self.get_current_date()
-        response = util.extract_longest_json(
-            await chat_sim_one_day(all_characters, f"date: {current_date}")
+        # models are only built for the shards being simulated, see run_shard
+        population = await Character.get_population()
+        ids = population.column("id").tolist()
+        cities = population.decoded("city").tolist()
+        current_date = self.next_date()
+        known_ids = set(ids)
+
+        # events are processed while the shards are still being generated,
+        # weathers arrive first and are shared with the processing through today
+        today = World(date=current_date, events=[], weathers=[])
+        pipeline = EventPipeline(
+            lambda event: today._process_one_event(event, None)
+        )
+        # with workers, events are queued as they arrive and applied in event
+        # order once every shard is done, see workers
+        coordinator = (
+            await asyncio.to_thread(workers.Coordinator, current_date)
+            if workers.enabled()
+            else None
         )
+        submitted: Dict[Any, asyncio.Task] = {}
+        originals: Dict[Any, Event] = {}
+        log.info("Started simulating the day", characters=len(ids))
 
-        today_log_file = f"{current_date}.log"
-        with open(today_log_file, "a") as f:
-            f.write(f"responses from chat_sim_one_day:\n{response}\n\n")
-        self = World.load_from_json_str(response)
-        self.events = await self.process_event()
-        self.save()
-        notify_update_in_background("World", None, self.model_dump())
-        end_time = time.time()
-        execution_time = end_time - start_time
-
-        # Log the execution time
-        with open(today_log_file, "a") as log_file:
-            log_file.write(
-                f"[{datetime.now()}] sim_one_day execution time: {execution_time:.2f} seconds\n"
+        def on_weather(weather: Weather):
+            if all(w.city_name != weather.city_name for w in today.weathers):
+                today.weathers.append(weather)
+                notify_update_in_background(
+                    "Weather", weather.city_name, weather.model_dump(mode="json")
+                )
+
+        def on_processed(_):
+            progress["events_processed"] += 1
+
+        def on_event(shard_no: int, event: Event):
+            key = World.event_key(event, known_ids)
+            if key is None or key in originals:
+                return
+            notify_update_in_background("Event", None, event.model_dump(mode="json"))
+            originals[key] = event
+            if coordinator is None:
+                gate.add(shard_no, event)
+            else:
+                submitted[key] = asyncio.create_task(
+                    today._dispatch(coordinator, event, None)
+                )
+            progress["events_total"] += 1
+
+        def submit(event: Event):
+            key = World.event_key(event, known_ids)
+            submitted[key] = pipeline.submit(event)
+            submitted[key].add_done_callback(on_processed)
+
+        shards = shard_characters(ids, cities)
+        progress.update(
+            stage="simulating",
+            date=current_date,
+            shards_total=len(shards),
+            shards_done=0,
+            events_total=0,
+            events_processed=0,
+        )
+        # partners come from the relationship graph, drawn with a per-day seed
+        graph = get_graph(
+            # only read when there is no saved graph yet
+            Character.model_validate(population.record(c_id)) for c_id in ids
+        )
+        index = index_characters(ids, cities)
+        rng = random.Random(f"{trait_evolution.SIM_TRAIT_SEED}:{current_date}")
+        candidates = [
+            cross_shard_candidates(shard, index, graph, rng, current_date)
+            for shard in shards
+        ]
+
+        # shards finish in any order and may mention characters of other shards,
+        # the gate submits an event once no shard can stream an earlier one of
+        # its characters, so each character's chain follows start_time
+        gate = StartTimeGate(
+            (shard + shard_candidates for shard, shard_candidates in zip(shards, candidates)),
+            submit,
+        )
+
+        # shards beyond what the LLM serves at once would only hold their models
+        shard_slots = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+
+        async def run_shard(shard_no, shard, shard_candidates):
+            try:
+                async with shard_slots:
+                    return await self._sim_shard(
+                        await Character.get_characters(shard),
+                        await Character.get_characters(shard_candidates),
+                        current_date,
+                        on_weather,
+                        lambda event: on_event(shard_no, event),
+                    )
+            finally:
+                progress["shards_done"] += 1
+                gate.close(shard_no)
+
+        results = await asyncio.gather(
+            *[
+                run_shard(shard_no, shard, shard_candidates)
+                for shard_no, (shard, shard_candidates) in enumerate(zip(shards, candidates))
+            ],
+            return_exceptions=True,
+        )
+        for shard, result in zip(shards, results):
+            if isinstance(result, BaseException):
+                log.error(
+                    f"Failed to simulate shard: {result}",
+                    character_ids=shard,
+                )
+        progress["stage"] = "processing events"
+        if coordinator is None:
+            await pipeline.join()
+            processed = {key: task.result() for key, task in submitted.items()}
+        else:
+            processed = await World._apply_worker_results(
+                coordinator, submitted, originals, progress
+            )
+        if not submitted:
+            # nothing happened today, surface the failure of the first shard
+            failures = [r for r in results if isinstance(r, BaseException)]
+            if failures:
+                raise failures[0]
+        progress["stage"] = "evolving traits"
+        with metrics.stage("evolve_traits"):
+            await self.evolve_traits(current_date)
+
+        # every shard result went through on_weather/on_event, so today holds
+        # all of them, including events streamed by a shard that failed later
+        today.events = list(originals.values())
+        new_world = World.merge(current_date, [today], known_ids=known_ids)
+        # keep the original event when its processing failed
+        new_world.events = [
+            processed[World.event_key(event, known_ids)] or event
+            for event in new_world.events
+        ]
+        new_world.save()
+        # with the day's batch, a failed day leaves the saved graph as it was
+        get_store().save_file(RELATIONSHIPS_PATH, graph.save)
+        notify_update_in_background("World", None, new_world.model_dump(mode="json"))
+        execution_time = time.time() - start_time
+        log.info(
+            f"Simulated the day in {execution_time:.2f} seconds",
+            seconds=round(execution_time, 3),
+            events=len(new_world.events),
+            failed_events=sum(event is None for event in processed.values()),
+            llm_cache=response_cache.stats(),
+            prompt_tokens=get_prompt_stats(),
+            schema_repairs=get_repair_stats(),
+        )
+        return new_world
+
+    async def _sim_shard(
+        self,
+        shard,
+        candidates,
+        current_date,
+        on_weather: Callable[[Weather], None],
+        on_event: Callable[[Event], None],
+    ) -> World:
+        with metrics.stage("sim_shard", characters=len(shard)):
+            parser = util.IncrementalJsonParser(("weathers", "events"))
+            world = None
+
+            def accept(content: str) -> None:
+                # the full response is the source of truth, it is only cached once valid
+                nonlocal world
+                with metrics.stage("extract_json"):
+                    response = util.extract_longest_json(content)
+                if response is None:
+                    raise ValueError(f"No world JSON found in the response for {current_date}")
+                with metrics.stage("validate"):
+                    world = World.load_from_json_str(response)
+
+            async for delta in chat_sim_one_day_stream(
+                shard,
+                f"date: {current_date}",
+                candidates,
+                accept=accept,
+            ):
+                for key, obj in parser.feed(delta):
+                    try:
+                        if key == "weathers":
+                            on_weather(Weather(**obj))
+                        else:
+                            on_event(Event(**obj))
+                    except (ValidationError, TypeError):
+                        # see accept
+                        continue
+
+            # whatever the incremental parser missed, e.g. an answer without tags
+            for weather in world.weathers:
+                on_weather(weather)
+            for event in world.events:
+                on_event(event)
+            return world
+
+    async def evolve_traits(self, date: str) -> int:
+        """
+        One day of trait drift over the whole population, after today's events.
+        Works on the population columns and the JSON form of the characters
+        that changed, no model is built. The changed characters are saved in
+        one store write, logged together and sent to clients in one batch.
+
+        Returns:
+            int: number of characters that changed.
+        """
+        population = await Character.get_population()
+        ids, before, after = await asyncio.to_thread(
+            trait_evolution.evolve_population, population, date
+        )
+        population.set_traits(ids, after)
+        fields = trait_evolution.trait_fields()
+        character_ids = ids.tolist()
+        changes: List[List[Dict[str, Any]]] = [[] for _ in character_ids]
+        rows, columns = np.nonzero(before != after)
+        for row, column in zip(rows.tolist(), columns.tolist()):
+            changes[row].append(
+                {
+                    "op": "replace",
+                    "path": "/{}/{}".format(*fields[column]),
+                    "value": int(after[row, column]),
+                }
             )
-        return {"date": current_date, "world": self.model_dump()}
+        get_event_log().append_many(
+            "character",
+            date,
+            [([i], {"id": i, "ops": ops}) for i, ops in zip(character_ids, changes)],
+        )
+        records = Character.save_population_records(character_ids)
+        notify_updates_in_background("Character", list(zip(character_ids, records, changes)))
+        return len(character_ids)
+
+    @staticmethod
+    def event_key(event: Event, known_ids=None):
+        """
+        Identity of an event across shards, None if it involves unknown characters.
+        """
+        ids = tuple(sorted(set(event.id_of_character_involved)))
+        if not ids or (known_ids is not None and not set(ids) <= known_ids):
+            return None
+        return (event.start_time, ids)
+
+    @staticmethod
+    def event_id(event: Event) -> str:
+        """
+        Correlation id of an event in the logs.
+        """
+        ids = "-".join(str(i) for i in sorted(set(event.id_of_character_involved)))
+        return f"{event.date}T{event.start_time}/{ids}"
+
+    @classmethod
+    def merge(cls, date: str, worlds: List[World], known_ids=None) -> World:
+        """
+        Merge the worlds generated for each shard into one.
+
+        Weathers are deduplicated by city, the first shard wins. Events are
+        deduplicated by event_key, since a cross-shard event can be generated
+        by both shards, and sorted by start_time.
+        Events involving unknown characters are dropped.
+        """
+        weathers: Dict[str, Weather] = {}
+        events: Dict[Any, Event] = {}
+        for world in worlds:
+            for weather in world.weathers:
+                weathers.setdefault(weather.city_name, weather)
+            for event in world.events:
+                key = cls.event_key(event, known_ids)
+                if key is not None:
+                    events.setdefault(key, event)
+        return cls(
+            date=date,
+            events=[events[key] for key in sorted(events)],
+            weathers=[weathers[city] for city in sorted(weathers)],
+        )
 
     async def process_event(self, note=None):
-        today_log_file = f"{self.get_current_date()}.log"
-        new_event = []
-        with open(today_log_file, "a") as f:
-            f.write(f"Started processing events...\n")
-            for event in self.events:
-                character_ids = event.id_of_character_involved
-                related_characters = await asyncio.gather(
-                    *[Character.get_character(c_id) for c_id in character_ids]
+        pipeline = EventPipeline(lambda event: self._process_one_event(event, note))
+        with correlate(day=self.get_current_date()):
+            results = await pipeline.run(self.events)
+        # keep the original event when its processing failed
+        new_event = [
+            result if result is not None else event
+            for event, result in zip(self.events, results)
+        ]
+        return new_event
+
+    async def _process_one_event(self, event: Event, note) -> Event:
+        character_ids = event.id_of_character_involved
+        with correlate(event=World.event_id(event)), metrics.stage(
+            "process_event", characters=len(character_ids)
+        ):
+            related_characters = await asyncio.gather(
+                *[Character.get_character(c_id) for c_id in character_ids]
+            )
+            with metrics.stage("memory_recall"):
+                recalled = await get_memory_store().arecall(
+                    related_characters, event.description
                 )
-                response = await world_process_event(
-                    event, related_characters, self.weathers, note
+            processed_event = await World.narrate_event(
+                event, related_characters, self.weathers, note, recalled
+            )
+            await World.apply_event(processed_event, related_characters)
+            return processed_event
+
+    async def _dispatch(self, coordinator: workers.Coordinator, event: Event, note) -> int:
+        """
+        Queue an event for the workers, with everything its prompt needs.
+        """
+        with correlate(event=World.event_id(event)):
+            related_characters = await asyncio.gather(
+                *[Character.get_character(c_id) for c_id in event.id_of_character_involved]
+            )
+            with metrics.stage("memory_recall"):
+                recalled = await get_memory_store().arecall(
+                    related_characters, event.description
                 )
+            return await coordinator.submit(
+                {
+                    "event": event.model_dump(mode="json"),
+                    "characters": [c.model_dump(mode="json") for c in related_characters],
+                    "weathers": [w.model_dump(mode="json") for w in self.weathers],
+                    "note": note,
+                    "memories": recalled,
+                }
+            )
+
+    @staticmethod
+    async def _apply_worker_results(
+        coordinator: workers.Coordinator,
+        dispatched: Dict[Any, asyncio.Task],
+        originals: Dict[Any, Event],
+        progress: Dict[str, Any],
+    ) -> Dict[Any, Optional[Event]]:
+        """
+        Apply the events narrated by the workers, in event order, to the
+        characters as they are by then.
 
-                f.write(f"responses from world_process_event:\n{response}\n\n")
-                # store back changed characters
-                response = json.loads(response)
-                for cj in response["related_characters"]:
-                    char = Character(**cj)
-                    char.save()
-                    notify_update_in_background(
-                        "Character", char.basic_info.id, char.model_dump()
+        Returns:
+            the processed event of every key of dispatched, None if it failed.
+        """
+        keys = sorted(dispatched)
+        item_ids = await asyncio.gather(
+            *[dispatched[key] for key in keys], return_exceptions=True
+        )
+        processed: Dict[Any, Optional[Event]] = {key: None for key in keys}
+        queued = {}
+        for key, item_id in zip(keys, item_ids):
+            if isinstance(item_id, BaseException):
+                log.warning(f"Failed to queue event {World.event_id(originals[key])}: {item_id}")
+                progress["events_processed"] += 1
+            else:
+                queued[item_id] = key
+        async for item_id, result, error in coordinator.results(list(queued)):
+            key = queued[item_id]
+            event = originals[key]
+            with correlate(event=World.event_id(event)):
+                try:
+                    if error is not None:
+                        raise RuntimeError(error)
+                    processed_event = Event.model_validate(result["event"])
+                    related_characters = await asyncio.gather(
+                        *[Character.get_character(c_id) for c_id in event.id_of_character_involved]
                     )
-                new_event.append(Event(**response["event"]))
-            f.write(f"Finished processing events.\n")
-        return new_event
+                    await World.apply_event(processed_event, related_characters)
+                    processed[key] = processed_event
+                except Exception as e:
+                    log.warning(
+                        f"Error processing event at {event.start_time} "
+                        f"for characters {event.id_of_character_involved}: {e}"
+                    )
+                finally:
+                    progress["events_processed"] += 1
+        return processed
+
+    @staticmethod
+    async def narrate_event(
+        event: Event, related_characters, weathers, note, recalled
+    ) -> Event:
+        """
+        The LLM part of processing an event, also run by workers, see workers.
+        """
+
+        def accept(response: str) -> Event:
+            # validate everything before storing, a bad response must not half-apply
+            response = json.loads(response)
+            with metrics.stage("validate"):
+                return validate_or_repair(Event, response["event"], "from world_process_event")
 
+        return await world_process_event(
+            event, related_characters, weathers, note, recalled, accept=accept
+        )
 
-world = World.load_from_local()
+    @staticmethod
+    async def apply_event(processed_event: Event, related_characters) -> None:
+        """
+        Store a processed event and its effects on the characters involved.
+        """
+        # the model only narrates, scales drift in evolve_traits
+        new_characters = [
+            char.model_copy(
+                update={
+                    "events_latest_10": (char.events_latest_10 + [processed_event])[-10:]
+                }
+            )
+            for char in related_characters
+        ]
+        get_graph().add_event(
+            processed_event.id_of_character_involved, processed_event.date
+        )
+        history = get_event_log()
+        history.append_event(processed_event.model_dump(mode="json"))
+        changes = [
+            (old.model_dump(mode="json"), new.model_dump(mode="json"))
+            for old, new in zip(related_characters, new_characters)
+        ]
+        for old, new in changes:
+            history.append_character_change(
+                old, new, processed_event.date, processed_event.location
+            )
+        with metrics.stage("memory_remember"):
+            await get_memory_store().aremember(
+                new_characters, processed_event.description, processed_event.date
+            )
+        # store back changed characters
+        with metrics.stage("save"):
+            for _, new in changes:
+                Character.save_record(new)
+        for old, new in changes:
+            notify_update_in_background(
+                "Character", new["basic_info"]["id"], new, previous=old
+            )
@@ -0,0 +1,66 @@
+"""
+Websocket fan-out benchmark with in-process fake clients, some of them slow.
+
+Run from sim_world/:
+    python -m benchmarks.broadcast [--clients 5000] [--slow 50] [--messages 20]
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from websocket_service import broadcaster
+
+
+class FakeWebSocket:
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.received = 0
+
+    async def send_text(self, text: str) -> None:
+        await asyncio.sleep(self.delay)
+        self.received += 1
+
+    async def close(self, code: int = 1000) -> None:
+        pass
+
+
+async def run(clients: int, slow: int, messages: int) -> None:
+    sockets = [FakeWebSocket(1.0 if i < slow else 0) for i in range(clients)]
+    connections = [broadcaster.register(websocket) for websocket in sockets]
+    with open("world.json") as f:
+        world = json.load(f)
+
+    timings = []
+    for i in range(messages):
+        start = time.perf_counter()
+        broadcaster.broadcast(
+            {"event": "update", "updated_type": "World", "updated_id": None, "updated_value": world},
+            key="World:None",
+        )
+        timings.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    fast = connections[slow:]
+    while any(c.queue and not c.closed for c in fast):
+        await asyncio.sleep(0.001)
+    delivered = time.perf_counter() - start
+
+    timings.sort()
+    print(f"{clients} clients ({slow} slow), {messages} broadcasts of {len(json.dumps(world)) / 1024:.0f} KB")
+    print(f"broadcast call: median {timings[len(timings) // 2] * 1000:.2f} ms, max {timings[-1] * 1000:.2f} ms")
+    print(f"fast clients drained {delivered * 1000:.0f} ms after the last broadcast")
+    print(broadcaster.metrics())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=5000)
+    parser.add_argument("--slow", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(run(args.clients, args.slow, args.messages))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Micro-benchmark of util.extract_longest_json on large chain-of-thought responses.
+Correctness is covered by tests/test_extract_json.py.
+
+Run from sim_world/:
+    python -m benchmarks.extract_json [--size-kb 200] [--repeat 20]
+or from anywhere:
+    python sim_world/benchmarks/extract_json.py
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+
+SIM_WORLD = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if __package__ in (None, ""):
+    # run as a script, the modules are imported flat from sim_world/
+    sys.path.insert(0, SIM_WORLD)
+
+import util  # noqa: E402
+
+
+def legacy_extract_longest_json(text):
+    # the previous regex implementation, kept here for comparison
+    json_pattern = r"{[^{}]*(?:{[^{}]*}[^{}]*)*}"
+    valid_jsons = []
+    for match in re.finditer(json_pattern, text):
+        try:
+            json.loads(match.group())
+            valid_jsons.append(match.group())
+        except json.JSONDecodeError:
+            continue
+    return max(valid_jsons, key=len) if valid_jsons else None
+
+
+def make_cot_response(answer: dict, size_kb: int, seed: int = 0) -> str:
+    """
+    A thinking block of about size_kb with prose, quotes and stray JSON-ish
+    fragments, followed by the answer block the CoT template asks for.
+    """
+    rng = random.Random(seed)
+    fragments = [
+        "Let me think about how {this} should work for each character.",
+        'She said "it\'s fine {or not}" and left.',
+        'Maybe the event looks like {"start_time": "09:00", "note": "draft"}.',
+        "Weather could be [sunny, rainy] depending on the city.",
+        "Hmm, not sure about {unbalanced here, but moving on.",
+        'A nested draft: {"a": {"b": {"c": {"d": 1}}}} seems too deep.',
+    ]
+    parts = ["```thinking\n"]
+    size = 0
+    while size < size_kb * 1024:
+        fragment = rng.choice(fragments)
+        parts.append(fragment + "\n")
+        size += len(fragment) + 1
+    parts.append("```\n<answer>\n```json\n")
+    parts.append(json.dumps(answer, indent=2))
+    parts.append("\n```\n</answer>\n")
+    return "".join(parts)
+
+
+def make_truncated_response(size_kb: int) -> str:
+    """
+    A response cut off inside size_kb of nested objects, none of them closed.
+    """
+    return '{"a": ' * (size_kb * 1024 // 6)
+
+
+def make_nested_response(size_kb: int) -> str:
+    """
+    size_kb of objects nested deeper than json.loads can parse.
+    """
+    depth = size_kb * 1024 // 7
+    return '{"a": ' * depth + "1" + "}" * depth
+
+
+def bench(name, fn, text, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn(text)
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"{name:>8}: {elapsed * 1000:8.2f} ms/call, {len(text) / 1024 / elapsed / 1024:8.1f} MB/s")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-kb", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with open(os.path.join(SIM_WORLD, "world.json")) as f:
+        world = json.load(f)
+    text = make_cot_response(world, args.size_kb)
+    print(f"response size: {len(text) / 1024:.0f} KB")
+    found = bench("new", util.extract_longest_json, text, args.repeat)
+    legacy = bench("legacy", legacy_extract_longest_json, text, args.repeat)
+    for name, pathological in (
+        ("truncated", make_truncated_response(args.size_kb)),
+        ("nested", make_nested_response(args.size_kb)),
+    ):
+        print(f"{name} response size: {len(pathological) / 1024:.0f} KB")
+        bench("new", util.extract_longest_json, pathological, args.repeat)
+        bench("legacy", legacy_extract_longest_json, pathological, args.repeat)
+    print(f"new returns the world: {json.loads(found) == world}")
+    print(f"legacy returns the world: {legacy is not None and json.loads(legacy) == world}")
+    sys.exit(0 if json.loads(found) == world else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Import-time budget of the server: `import main` must not load data or
+build clients, that happens in main.lifespan.
+
+Imports main in a fresh interpreter with -X importtime, prints the slowest
+modules and exits non-zero if the import takes longer than the budget.
+Measure with compiled bytecode: the first import after a change also
+compiles every module it touches. tests/test_import_time.py enforces the
+budget.
+
+Run from sim_world/:
+    python -m benchmarks.import_time [--budget 2.0] [--top 15]
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+SIM_WORLD = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_TIME_BUDGET = float(os.getenv("IMPORT_TIME_BUDGET", "2.0"))
+# only loaded when the feature that needs them is used
+LAZY_MODULES = ("torch", "transformers", "tokenizers", "networkx", "uvicorn")
+
+
+def measure(module: str):
+    """
+    Returns:
+        (total seconds, [(self seconds, cumulative seconds, module name)])
+    """
+    env = dict(os.environ, OPENAI_API_KEY=os.environ.get("OPENAI_API_KEY", "import-time"))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        env=env,
+        cwd=SIM_WORLD,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-4000:]}")
+    modules = []
+    total = 0.0
+    for line in result.stderr.splitlines():
+        match = LINE.match(line)
+        if match is None:
+            continue
+        own, cumulative, indent, name = match.groups()
+        modules.append((int(own) / 1e6, int(cumulative) / 1e6, name))
+        if name == module and len(indent) == 1:
+            total = int(cumulative) / 1e6
+    return total, modules
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--budget", type=float, default=IMPORT_TIME_BUDGET, help="seconds")
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    total, modules = measure(args.module)
+    print(f"import {args.module}: {total:.3f}s, budget {args.budget:.3f}s")
+    print("slowest modules, self time:")
+    for own, cumulative, name in sorted(modules, reverse=True)[: args.top]:
+        print(f"  {own * 1000:8.1f} ms  (cumulative {cumulative * 1000:8.1f} ms)  {name}")
+    if total > args.budget:
+        print("over budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
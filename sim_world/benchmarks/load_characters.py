@@ -0,0 +1,55 @@
+"""
+Cold-start benchmark of Character.load_all_characters.
+
+Writes N copies of the fixture characters into a temporary characters/ directory
+and loads them with a fresh CharacterStore.
+
+Run from sim_world/:
+    python -m benchmarks.load_characters [--count 10000]
+"""
+
+import argparse
+import asyncio
+import glob
+import json
+import os
+import tempfile
+import time
+
+
+def write_population(directory: str, count: int) -> None:
+    fixtures = []
+    for path in sorted(glob.glob("characters/*.json")):
+        with open(path) as f:
+            fixtures.append(json.load(f))
+    os.makedirs(os.path.join(directory, "characters"))
+    for character_id in range(1, count + 1):
+        data = fixtures[character_id % len(fixtures)]
+        data["basic_info"]["id"] = character_id
+        with open(os.path.join(directory, "characters", f"{character_id}.json"), "w") as f:
+            json.dump(data, f, indent=2)
+
+
+async def load() -> int:
+    from Character import Character, CharacterStore
+
+    await Character.load_all_characters()
+    return len(CharacterStore.population)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=10000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        write_population(directory, args.count)
+        os.chdir(directory)
+        start = time.perf_counter()
+        loaded = asyncio.run(load())
+        elapsed = time.perf_counter() - start
+    print(f"{loaded} characters in {elapsed:.2f}s, {loaded / elapsed:.0f} characters/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Memory and query benchmark of population.Population against a dict of
+Character models.
+
+Builds N characters from the fixtures, spread over a few cities with varied
+scales, and measures with tracemalloc what each representation holds, then
+times the same question asked both ways: a loop over the models and a
+vectorized filter over the columns.
+
+Run from sim_world/:
+    python -m benchmarks.population [--count 100000]
+"""
+
+import argparse
+import gc
+import glob
+import json
+import random
+import time
+import tracemalloc
+
+CITIES = ["Davis", "Sacramento", "Oakland", "San Francisco", "Berkeley", "Fresno"]
+
+
+def fixture_records(count: int):
+    fixtures = []
+    for path in sorted(glob.glob("characters/*.json")):
+        with open(path) as f:
+            fixtures.append(json.load(f))
+    rng = random.Random(0)
+    for character_id in range(1, count + 1):
+        data = json.loads(json.dumps(fixtures[character_id % len(fixtures)]))
+        data["basic_info"]["id"] = character_id
+        data["basic_info"]["city"] = rng.choice(CITIES)
+        data["basic_info"]["age"] = rng.randint(18, 90)
+        for section in ("personality_and_psychology", "skills_and_abilities"):
+            for name, value in data[section].items():
+                if name not in ("personality", "iq", "eq"):
+                    data[section][name] = rng.randint(0, 100)
+        yield data
+
+
+def measure(build):
+    """
+    Returns:
+        (the built object, bytes it holds, seconds to build it)
+    """
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    built = build()
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return built, size, elapsed
+
+
+def timed(function, repeat: int = 5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=100000)
+    args = parser.parse_args()
+
+    from Character import Character
+    from population import Population
+
+    def build_models():
+        return {
+            data["basic_info"]["id"]: Character.model_validate(data)
+            for data in fixture_records(args.count)
+        }
+
+    def build_population():
+        population = Population()
+        for data in fixture_records(args.count):
+            population.put(data)
+        return population
+
+    models, model_bytes, model_time = measure(build_models)
+    population, population_bytes, population_time = measure(build_population)
+    mb = 1024 * 1024
+    print(f"{args.count} characters")
+    print(f"  models:     {model_bytes / mb:8.1f} MB, built in {model_time:.1f}s")
+    print(
+        f"  population: {population_bytes / mb:8.1f} MB, built in {population_time:.1f}s "
+        f"(columns and compressed rows {population.nbytes() / mb:.1f} MB)"
+    )
+
+    def loop():
+        return [
+            character_id
+            for character_id, c in models.items()
+            if c.basic_info.city == "Davis"
+            and c.personality_and_psychology.risk_taking_scale > 70
+        ]
+
+    def vectorized():
+        return population.filter(city="Davis", risk_taking_scale__gt=70)
+
+    expected, loop_time = timed(loop)
+    found, filter_time = timed(vectorized)
+    assert sorted(found) == sorted(expected)
+    print(f'city="Davis", risk_taking_scale > 70: {len(found)} characters')
+    print(f"  loop over models: {loop_time * 1000:8.2f} ms")
+    print(f"  population.filter: {filter_time * 1000:7.2f} ms")
+
+    character_id = found[0] if found else 1
+    _, record_time = timed(lambda: Character.model_validate(population.record(character_id)), 100)
+    print(f"one model built from its row: {record_time * 1e6:.0f} us")
+
+
+if __name__ == "__main__":
+    main()
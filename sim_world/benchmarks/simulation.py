@@ -0,0 +1,328 @@
+"""
+Offline benchmark of a full simulated day, from 10 to 10k characters.
+
+The OpenAI client is pointed at an in-process fake chat-completions endpoint
+(an httpx MockTransport) that answers with schema-valid worlds and events
+after a configurable latency. Everything else is the real code path:
+Character loading and saving, World.sim_one_day with shards, event
+processing, memories, the event log and the websocket broadcast to a few
+fake clients.
+
+Every population size runs in its own process, in a temporary copy of the
+fixture data, so peak RSS and module state do not leak between sizes.
+Results are appended to a JSON file together with the commit they were
+measured on, and compared with the last run that used the same parameters.
+
+Run from sim_world/:
+    python -m benchmarks.simulation [--sizes 10 100 1000 10000] [--latency 0.05]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+RESULTS_PATH = "benchmark_results.json"
+COMPARED = ("day_seconds", "peak_rss_mb", "events_per_second")
+# lower is better for all of them except events_per_second
+HIGHER_IS_BETTER = {"events_per_second"}
+
+
+def fake_transport(latency: float, events_per_character: int, description_chars: int):
+    """
+    An httpx transport answering chat completions like the real model would,
+    streamed or not, with usage figures.
+    """
+    import httpx
+
+    calls = {"sim_one_day": 0, "process_event": 0}
+
+    def sim_one_day(prompt: str) -> str:
+        date = re.search(r"today: (?:date: )?(\S+)", prompt).group(1)
+        persons = prompt.split("all persons:")[1].split("today:")[0]
+        persons = persons.split("other persons they may meet")[0]
+        ids = [int(i) for i in re.findall(r'"id":\s*(\d+)', persons)]
+        cities = sorted(set(re.findall(r'"city":\s*"([^"]*)"', persons))) or ["Davis"]
+        events = []
+        for n in range(events_per_character):
+            for i, character_id in enumerate(ids):
+                partner = ids[(i + 1) % len(ids)]
+                minute = (n * len(ids) + i) % (24 * 60)
+                events.append(
+                    {
+                        "id_of_character_involved": sorted({character_id, partner}),
+                        "location": cities[i % len(cities)],
+                        "date": date,
+                        "start_time": f"{minute // 60:02d}:{minute % 60:02d}",
+                        "description": "x" * description_chars,
+                    }
+                )
+        world = {
+            "date": date,
+            "weathers": [{"city_name": city, "weather": "sunny"} for city in cities],
+            "events": events,
+        }
+        return f"<answer>{json.dumps(world)}</answer>"
+
+    def process_event(prompt: str) -> str:
+        event = json.loads(prompt.split("Original Event: ")[1].split("\n")[0])
+        event["description"] += " They talked for a while."
+        return json.dumps({"event": event})
+
+    def chunk(content: str, usage: Dict[str, int]) -> bytes:
+        deltas = [content[i : i + 256] for i in range(0, len(content), 256)]
+        chunks = [
+            {
+                "id": "bench",
+                "object": "chat.completion.chunk",
+                "created": 0,
+                "model": "bench",
+                "choices": [{"index": 0, "delta": {"content": d}, "finish_reason": None}],
+            }
+            for d in deltas
+        ]
+        chunks.append(
+            {
+                "id": "bench",
+                "object": "chat.completion.chunk",
+                "created": 0,
+                "model": "bench",
+                "choices": [],
+                "usage": usage,
+            }
+        )
+        text = "".join(f"data: {json.dumps(c)}\n\n" for c in chunks) + "data: [DONE]\n\n"
+        return text.encode()
+
+    async def handler(request: "httpx.Request") -> "httpx.Response":
+        await asyncio.sleep(latency)
+        body = json.loads(request.content)
+        prompt = body["messages"][-1]["content"]
+        if "Original Event: " in prompt:
+            calls["process_event"] += 1
+            content = process_event(prompt)
+        else:
+            calls["sim_one_day"] += 1
+            content = sim_one_day(prompt)
+        usage = {
+            "prompt_tokens": len(prompt) // 4,
+            "completion_tokens": len(content) // 4,
+            "total_tokens": (len(prompt) + len(content)) // 4,
+        }
+        if body.get("stream"):
+            return httpx.Response(
+                200, content=chunk(content, usage), headers={"content-type": "text/event-stream"}
+            )
+        return httpx.Response(
+            200,
+            json={
+                "id": "bench",
+                "object": "chat.completion",
+                "created": 0,
+                "model": "bench",
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": usage,
+            },
+        )
+
+    return httpx.MockTransport(handler), calls
+
+
+async def run_day(args) -> Dict[str, Any]:
+    import httpx
+    from openai import AsyncOpenAI
+
+    import chat
+    from benchmarks.broadcast import FakeWebSocket
+    from Character import Character
+    from websocket_service import broadcaster
+    from World import World
+
+    transport, calls = fake_transport(
+        args.latency, args.events_per_character, args.description_chars
+    )
+    chat._client = AsyncOpenAI(
+        api_key="bench", max_retries=0, http_client=httpx.AsyncClient(transport=transport)
+    )
+    sockets = [FakeWebSocket(0) for _ in range(args.clients)]
+    for websocket in sockets:
+        broadcaster.register(websocket)
+
+    start = time.perf_counter()
+    characters = await Character.get_all_characters()
+    load_seconds = time.perf_counter() - start
+
+    world = World.load_from_local()
+    start = time.perf_counter()
+    new_world = await world.sim_one_day()
+    day_seconds = time.perf_counter() - start
+    # let the writers drain what the day queued
+    await asyncio.sleep(0.1)
+    await chat.close_client()
+
+    return {
+        "characters": len(characters),
+        "load_seconds": round(load_seconds, 3),
+        "day_seconds": round(day_seconds, 3),
+        "events": len(new_world.events),
+        "events_per_second": round(len(new_world.events) / day_seconds, 2),
+        "llm_calls": dict(calls),
+        "ws_messages_per_client": (
+            sum(s.received for s in sockets) / len(sockets) if sockets else 0
+        ),
+        # ru_maxrss is in KB on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def run_size(size: int, args) -> Dict[str, Any]:
+    """
+    One population size in a fresh process and a scratch directory.
+    """
+    from benchmarks.load_characters import write_population
+
+    source = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        write_population(directory, size)
+        shutil.copy(os.path.join(source, "world.json"), directory)
+        env = dict(
+            os.environ,
+            PYTHONPATH=os.pathsep.join([source, os.environ.get("PYTHONPATH", "")]),
+            OPENAI_API_KEY="bench",
+            LLM_CACHE_MODE="off",
+        )
+        env.setdefault("HF_HUB_OFFLINE", "1")
+        command = [sys.executable, "-m", "benchmarks.simulation", "--worker"]
+        command += [
+            "--latency", str(args.latency),
+            "--events-per-character", str(args.events_per_character),
+            "--description-chars", str(args.description_chars),
+            "--clients", str(args.clients),
+        ]
+        result = subprocess.run(command, cwd=directory, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(result.stdout[-2000:], result.stderr[-4000:], sep="\n")
+        raise RuntimeError(f"Benchmark with {size} characters failed")
+    # the worker's last line is its result, the rest is the usual logging
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def read_results(path: str) -> List[Dict[str, Any]]:
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def write_results(path: str, runs: List[Dict[str, Any]]) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(runs, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def compare(run: Dict[str, Any], previous: Dict[str, Any], tolerance: float) -> int:
+    """
+    Print the change of every figure against a previous run.
+
+    Returns:
+        int: number of figures that got worse by more than tolerance.
+    """
+    print(f"compared with {previous['commit']} from {previous['timestamp']}:")
+    regressions = 0
+    before = {r["characters"]: r for r in previous["results"]}
+    for result in run["results"]:
+        old = before.get(result["characters"])
+        if old is None:
+            continue
+        changes = []
+        for key in COMPARED:
+            if not old[key]:
+                continue
+            change = result[key] / old[key] - 1
+            worse = -change if key in HIGHER_IS_BETTER else change
+            flag = ""
+            if worse > tolerance:
+                regressions += 1
+                flag = " REGRESSION"
+            changes.append(f"{key} {change:+.0%}{flag}")
+        print(f"  {result['characters']:>6}: " + ", ".join(changes))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per LLM call")
+    parser.add_argument("--events-per-character", type=int, default=1)
+    parser.add_argument("--description-chars", type=int, default=200)
+    parser.add_argument("--clients", type=int, default=10, help="fake websocket clients")
+    parser.add_argument("--output", default=RESULTS_PATH)
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="relative change reported as a regression"
+    )
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(asyncio.run(run_day(args))))
+        return
+
+    params = {
+        "latency": args.latency,
+        "events_per_character": args.events_per_character,
+        "description_chars": args.description_chars,
+        "clients": args.clients,
+        "storage": os.getenv("SIM_STORAGE", "json"),
+    }
+    run = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "params": params,
+        "results": [],
+    }
+    for size in args.sizes:
+        result = run_size(size, args)
+        run["results"].append(result)
+        print(
+            f"{result['characters']:>6} characters: load {result['load_seconds']:.2f}s, "
+            f"day {result['day_seconds']:.2f}s, {result['events']} events "
+            f"({result['events_per_second']:.1f}/s), peak RSS {result['peak_rss_mb']:.0f} MB"
+        )
+
+    runs = read_results(args.output)
+    previous = next((r for r in reversed(runs) if r["params"] == params), None)
+    runs.append(run)
+    write_results(args.output, runs)
+    print(f"results appended to {args.output}")
+    if previous is not None and compare(run, previous, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
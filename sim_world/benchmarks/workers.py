@@ -0,0 +1,155 @@
+"""
+Scaling benchmark of the coordinator/worker mode, see workers.
+
+Runs two simulated days per worker count, each in a fresh process and a
+scratch copy of N fixture characters, and measures the second one: workers
+are long-lived, the first day only pays for their start-up. The coordinator and every worker talk
+to the fake chat-completions endpoint of benchmarks.simulation, with the
+same latency, so a worker handles --concurrency events per latency period
+and throughput should grow with the worker count until the coordinator,
+which applies every result, becomes the bottleneck. A run with events
+processed in-process is printed first for reference.
+
+Run from sim_world/:
+    python -m benchmarks.workers [--workers 1 2 4 8] [--characters 200]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict
+
+
+def install_fake_llm(args):
+    import httpx
+    from openai import AsyncOpenAI
+
+    import chat
+    from benchmarks.simulation import fake_transport
+
+    transport, calls = fake_transport(args.latency, 1, 200)
+    chat._client = AsyncOpenAI(
+        api_key="bench", max_retries=0, http_client=httpx.AsyncClient(transport=transport)
+    )
+    return calls
+
+
+async def run_worker(args) -> None:
+    import workers
+
+    install_fake_llm(args)
+    await workers.run_worker(concurrency=args.concurrency, parent=args.parent)
+
+
+async def run_day(args) -> Dict[str, Any]:
+    import chat
+    import workers
+    from World import World
+
+    calls = install_fake_llm(args)
+    command = [
+        sys.executable, "-m", "benchmarks.workers", "--worker",
+        "--latency", str(args.latency),
+        "--concurrency", str(args.concurrency),
+        "--parent", str(os.getpid()),
+    ]
+    processes = [
+        subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for _ in range(args.workers)
+    ]
+    try:
+        world = await World.load_from_local().sim_one_day()
+        start = time.perf_counter()
+        new_world = await world.sim_one_day()
+        day_seconds = time.perf_counter() - start
+    finally:
+        for process in processes:
+            process.terminate()
+        await chat.close_client()
+    return {
+        "workers": args.workers if workers.enabled() else "in-process",
+        "events": len(new_world.events),
+        "day_seconds": round(day_seconds, 3),
+        "events_per_second": round(len(new_world.events) / day_seconds, 2),
+        "coordinator_llm_calls": dict(calls),
+    }
+
+
+def run_count(workers: int, args) -> Dict[str, Any]:
+    """
+    One day with this many workers, -1 for in-process, in a scratch directory.
+    """
+    from benchmarks.load_characters import write_population
+
+    source = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        write_population(directory, args.characters)
+        shutil.copy(os.path.join(source, "world.json"), directory)
+        env = dict(
+            os.environ,
+            PYTHONPATH=os.pathsep.join([source, os.environ.get("PYTHONPATH", "")]),
+            OPENAI_API_KEY="bench",
+            LLM_CACHE_MODE="off",
+            # the benchmark starts its own workers, with the fake LLM
+            SIM_WORKERS="0" if workers >= 0 else "-1",
+            LOG_CONSOLE_LEVEL="WARNING",
+        )
+        env.setdefault("HF_HUB_OFFLINE", "1")
+        command = [
+            sys.executable, "-m", "benchmarks.workers", "--day",
+            "--workers", str(max(workers, 0)),
+            "--latency", str(args.latency),
+            "--concurrency", str(args.concurrency),
+        ]
+        result = subprocess.run(command, cwd=directory, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(result.stdout[-2000:], result.stderr[-4000:], sep="\n")
+        raise RuntimeError(f"Benchmark with {workers} workers failed")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--characters", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds per LLM call")
+    parser.add_argument(
+        "--concurrency", type=int, default=2, help="events a worker processes at once"
+    )
+    parser.add_argument("--day", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--parent", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        asyncio.run(run_worker(args))
+        return
+    if args.day:
+        args.workers = args.workers[0]
+        print(json.dumps(asyncio.run(run_day(args))))
+        return
+
+    print(
+        f"{args.characters} characters, {args.latency}s per LLM call, "
+        f"{args.concurrency} events at once per worker"
+    )
+    baseline = None
+    for workers in [-1] + args.workers:
+        result = run_count(workers, args)
+        if workers == 1:
+            baseline = result["events_per_second"]
+        speedup = f", x{result['events_per_second'] / baseline:.2f}" if baseline else ""
+        print(
+            f"  {result['workers']:>10}: {result['events']} events in "
+            f"{result['day_seconds']:.2f}s, {result['events_per_second']:.1f} events/s{speedup}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,254 @@
 import os
-from typing import Literal
+import asyncio
+import random
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, Literal, Optional, Sequence, Tuple
 from dotenv import load_dotenv
-from openai import OpenAI
+import httpx
+import openai
+from openai import AsyncOpenAI
 import CoTTemplate
-import json
+from prompt_compiler import (
+    CompiledPrompt,
+    PromptTemplate,
+    character_view,
+    compact_json,
+    compact_schema,
+    dynamic,
+    static,
+)
+from llm_cache import LLM_CACHE_MODE, make_key, response_cache
 import functools
+import local_llm
+import metrics
+from structured_log import cap, get_logger, new_id
 
 load_dotenv()
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+log = get_logger("chat")
+
+# validates a response and returns what the caller makes of it, see complete_prompt
+Accept = Callable[[str], Any]
 
 GPT_3_5_TURBO = "gpt-3.5-turbo"
 GPT_4O_MINI = "gpt-4o-mini"
 GPT_4O = "gpt-4o"
 default_model = GPT_4O_MINI
-default_model_type: Literal["openai", "llama"] = "openai"
+default_model_type: Literal["openai", "llama"] = os.getenv("LLM_MODEL_TYPE", "openai")
+
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "120"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "1"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "30"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "32"))
+
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+
+
+class LLMError(Exception):
+    """
+    Base class of every failure to get a completion, callers should catch this
+    instead of checking the returned text.
+    """
+
+
+class LLMUnavailableError(LLMError):
+    """
+    The provider kept failing with rate limits, 5xx, timeouts or connection errors
+    until the retries ran out.
+    """
+
+
+class LLMRequestError(LLMError):
+    """
+    The provider rejected the request, retrying it will not help.
+    """
+
+
+class LLMEmptyResponseError(LLMError):
+    """
+    The provider answered without any content.
+    """
+
+
+class LLMPromptTooLargeError(LLMError):
+    """
+    The compiled prompt is over the token budget of its call type, it was not sent.
+    """
+
+
+class LLMReplayMissError(LLMError):
+    """
+    LLM_CACHE_MODE is replay and the request was never recorded.
+    """
+
+
+_client: Optional[AsyncOpenAI] = None
+# (event loop, semaphore made in it), see _get_semaphore
+_semaphore: Optional[Tuple[asyncio.AbstractEventLoop, asyncio.Semaphore]] = None
+
+
+def get_client() -> AsyncOpenAI:
+    """
+    Shared async client, every completion reuses its HTTP connection pool.
+    """
+    global _client
+    if _client is None:
+        _client = AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            timeout=LLM_TIMEOUT,
+            # retries are done in _create_completion, with jitter
+            max_retries=0,
+            http_client=httpx.AsyncClient(
+                timeout=httpx.Timeout(LLM_TIMEOUT, connect=10.0),
+                limits=httpx.Limits(
+                    max_connections=LLM_MAX_CONNECTIONS,
+                    max_keepalive_connections=LLM_MAX_CONNECTIONS,
+                ),
+            ),
+        )
+    return _client
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    """
+    Made in the running loop on first use, and again in a new loop, e.g. of
+    the next asyncio.run in a script or test.
+    """
+    global _semaphore
+    loop = asyncio.get_running_loop()
+    if _semaphore is None or _semaphore[0] is not loop:
+        _semaphore = (loop, asyncio.Semaphore(LLM_MAX_CONCURRENCY))
+    return _semaphore[1]
+
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+
+# tokens billed by the provider, cache hits cost nothing and are counted apart
+token_usage: Dict[str, int] = defaultdict(int)
+
+
+def _record_usage(usage, call_type: str) -> None:
+    token_usage["requests"] += 1
+    if usage is not None:
+        token_usage["prompt_tokens"] += usage.prompt_tokens or 0
+        token_usage["completion_tokens"] += usage.completion_tokens or 0
+        metrics.llm_tokens.inc(call_type, "prompt", amount=usage.prompt_tokens or 0)
+        metrics.llm_tokens.inc(call_type, "completion", amount=usage.completion_tokens or 0)
+
+
+def get_token_usage() -> Dict[str, int]:
+    usage = dict(token_usage)
+    if default_model_type == "llama":
+        stats = local_llm.get_batcher().stats()
+        usage["requests"] = stats["requests"]
+        usage["prompt_tokens"] = stats["prompt_tokens"]
+        usage["completion_tokens"] = stats["generated_tokens"]
+    usage["total_tokens"] = usage.get("prompt_tokens", 0) + usage.get("completion_tokens", 0)
+    return usage
+
+
+def _retry_delay(attempt: int, error: Exception) -> float:
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), LLM_RETRY_MAX_DELAY)
+        except ValueError:
+            pass
+    # full jitter, so concurrent callers do not retry in lockstep
+    return random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2**attempt))
+
+
+async def _create_completion(**kwargs):
+    """
+    Callers hold _get_semaphore() around this, and around consuming a stream.
+    """
+    last_error: Optional[Exception] = None
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        try:
+            return await get_client().chat.completions.create(**kwargs)
+        except openai.APIConnectionError as e:
+            # includes timeouts
+            last_error = e
+        except openai.APIStatusError as e:
+            if e.status_code not in RETRYABLE_STATUS_CODES and e.status_code < 500:
+                raise LLMRequestError(f"{e.status_code}: {e.message}") from e
+            last_error = e
+        if attempt < LLM_MAX_RETRIES:
+            delay = _retry_delay(attempt, last_error)
+            log.warning(
+                f"Completion failed ({last_error}), retry {attempt + 1}/{LLM_MAX_RETRIES} in {delay:.1f}s"
+            )
+            await asyncio.sleep(delay)
+    raise LLMUnavailableError(
+        f"Completion failed after {LLM_MAX_RETRIES + 1} attempts: {last_error}"
+    ) from last_error
 
 
 @functools.lru_cache(maxsize=1)
 def get_character_schema():
     from Character import Character
 
-    return Character.get_schema()
+    return compact_schema(Character)
 
 
 @functools.lru_cache(maxsize=1)
 def get_event_schema():
     from Character import Event
 
-    return Event.model_json_schema()
+    return compact_schema(Event)
 
 
 @functools.lru_cache(maxsize=1)
 def get_weather_schema():
     from World import Weather
 
-    return Weather.model_json_schema()
+    return compact_schema(Weather)
+
+
+@functools.lru_cache(maxsize=1)
+def get_world_schema():
+    from World import World
+
+    return compact_schema(World)
 
 
 async def raw_completion_explicit_cot(messages):
     return await raw_completion(CoTTemplate.template_in_message + messages)
 
 
-async def raw_completion(messages):
+async def complete_prompt(prompt: CompiledPrompt, accept: Optional[Accept] = None, **params):
+    """
+    Returns accept(content) if accept is given, else the content. A completion
+    is only cached once accept returned, a cached one it rejects is dropped and
+    asked for again, so a bad response is not served forever. Without accept
+    nothing is cached.
+    """
+    if prompt.over_budget:
+        raise LLMPromptTooLargeError(
+            f"{prompt.call_type} prompt uses {prompt.total_tokens} tokens, "
+            f"budget is {prompt.budget}: {prompt.section_tokens}"
+        )
+    with metrics.stage(f"llm.{prompt.call_type}", tokens=prompt.total_tokens):
+        try:
+            return await _completion(
+                prompt.messages, params, prompt.call_type, accept, prompt.prefix
+            )
+        except LLMError as e:
+            metrics.llm_calls.inc(prompt.call_type, "error")
+            metrics.llm_errors.inc(prompt.call_type, type(e).__name__)
+            raise
+
+
+async def raw_completion(messages, **params):
     """
     example: messages == [
                 {
@@ -51,103 +257,419 @@ async def raw_completion(messages):
                 },
                 {"role": "user", "content": prompt},
             ]
+    params are passed to the provider and are part of the cache key. Any
+    non-empty response is accepted, and cached like in complete_prompt.
+
+    Raises:
+        LLMError: when no completion could be produced.
+    """
+    return await _completion(messages, params, "raw", _as_is)
+
+
+def _as_is(content: str) -> str:
+    """
+    accept of raw completions, there is nothing to validate.
+    """
+    return content
+
+
+async def _completion(
+    messages,
+    params,
+    call_type: str,
+    accept: Optional[Accept],
+    prefix: Sequence[Dict[str, str]] = (),
+):
+    call_id = new_id("llm")
+    cache_key = make_key(_model_name(), messages, params)
+    if LLM_CACHE_MODE in ("readwrite", "replay"):
+        cached = await _cached(cache_key, call_type, call_id, accept)
+        if cached is not None:
+            return cached[0]
+        if LLM_CACHE_MODE == "replay":
+            raise LLMReplayMissError(f"No recorded completion for {cache_key}")
+
+    if default_model_type == "llama":
+        content = await _local_completion(messages, params, prefix)
+    else:
+        async with _get_semaphore():
+            response = await _create_completion(
+                model=default_model,
+                messages=messages,
+                **params,
+            )
+        _record_usage(response.usage, call_type)
+        content = response.choices[0].message.content if response.choices else None
+    return await _finish_completion(cache_key, content, messages, call_type, call_id, accept)
+
+
+def _model_name() -> str:
+    if default_model_type == "llama":
+        return local_llm.LOCAL_LLM_MODEL
+    return default_model
+
+
+async def _local_completion(messages, params, prefix: Sequence[Dict[str, str]] = ()) -> str:
+    """
+    Batched with the other concurrent requests, see local_llm.Batcher.
     """
     try:
-        response = client.chat.completions.create(
-            model=default_model,
-            messages=messages,
+        return await local_llm.complete(messages, prefix, **params)
+    except Exception as e:
+        raise LLMUnavailableError(f"Local completion failed: {e}") from e
+
+
+async def _cached(
+    cache_key: str, call_type: str, call_id: str, accept: Optional[Accept]
+) -> Optional[tuple]:
+    """
+    (accepted value,) of a cached completion, None on a miss or if the caller
+    rejects it, which also drops it.
+    """
+    content = await response_cache.aget(cache_key)
+    if content is None:
+        return None
+    if accept is not None:
+        try:
+            content = accept(content)
+        except Exception as e:
+            if LLM_CACHE_MODE == "replay":
+                raise
+            log.warning(
+                f"Dropping a cached completion the caller rejects: {e}",
+                llm_call=call_id,
+                call_type=call_type,
+            )
+            await response_cache.adiscard(cache_key)
+            return None
+    token_usage["cached_requests"] += 1
+    metrics.llm_calls.inc(call_type, "cached")
+    log.debug("Cached completion", llm_call=call_id, call_type=call_type)
+    return (content,)
+
+
+async def _finish_completion(
+    cache_key: str,
+    content: Optional[str],
+    messages,
+    call_type: str,
+    call_id: str,
+    accept: Optional[Accept],
+):
+    if not content or not content.strip():
+        raise LLMEmptyResponseError(f"Empty completion from {_model_name()}")
+    content = content.strip()
+    log.debug(
+        "Completion",
+        llm_call=call_id,
+        call_type=call_type,
+        model=_model_name(),
+        prompt=cap(messages[-1]["content"] if messages else None),
+        response=cap(content),
+    )
+    metrics.llm_calls.inc(call_type, "ok")
+    if accept is None:
+        return content
+    # raises before caching if the caller rejects the response
+    value = accept(content)
+    if LLM_CACHE_MODE in ("readwrite", "record"):
+        await response_cache.aput(cache_key, content, _model_name())
+    return value
+
+
+async def complete_prompt_stream(
+    prompt: CompiledPrompt, accept: Optional[Accept] = None, **params
+):
+    """
+    Same as complete_prompt, accept is called with the whole content once the
+    stream ends, what it returns is not passed on.
+    """
+    if prompt.over_budget:
+        raise LLMPromptTooLargeError(
+            f"{prompt.call_type} prompt uses {prompt.total_tokens} tokens, "
+            f"budget is {prompt.budget}: {prompt.section_tokens}"
         )
-        content = response.choices[0].message.content.strip()
-        with open("chat.log", "a") as log_file:
-            log_file.write(content + "\n")
+    # the histogram only, a span cannot be held open across the yields
+    start = time.perf_counter()
+    try:
+        async for delta in _completion_stream(
+            prompt.messages, params, prompt.call_type, accept, prompt.prefix
+        ):
+            yield delta
+    except LLMError as e:
+        metrics.llm_calls.inc(prompt.call_type, "error")
+        metrics.llm_errors.inc(prompt.call_type, type(e).__name__)
+        raise
+    finally:
+        metrics.stage_seconds.observe(time.perf_counter() - start, f"llm.{prompt.call_type}")
+
+
+async def raw_completion_stream(messages, **params):
+    """
+    Same as raw_completion, but yields the content as it is generated.
+    A cached or local completion is yielded in one piece, local decoding is
+    batched and does not stream.
+
+    Raises:
+        LLMError: when no completion could be produced, also if the stream
+            breaks off after some content was yielded.
+    """
+    async for delta in _completion_stream(messages, params, "raw", _as_is):
+        yield delta
+
+
+def _passing_content(accept: Optional[Accept]) -> Optional[Accept]:
+    """
+    accept for a stream, which yields the content, not what accept returns.
+    """
+    if accept is None:
+        return None
+
+    def check(content: str) -> str:
+        accept(content)
         return content
-    except Exception as e:
-        print(f"Error generating AI response: {e}")
-        return "I'm not sure how to respond to that."
 
+    return check
+
+
+async def _completion_stream(
+    messages,
+    params,
+    call_type: str,
+    accept: Optional[Accept],
+    prefix: Sequence[Dict[str, str]] = (),
+):
+    # passed explicitly, a context variable set in a generator leaks into the caller
+    call_id = new_id("llm")
+    cache_key = make_key(_model_name(), messages, params)
+    if LLM_CACHE_MODE in ("readwrite", "replay"):
+        # accepted before it is yielded, a rejected one is asked for again
+        cached = await _cached(cache_key, call_type, call_id, _passing_content(accept))
+        if cached is not None:
+            yield cached[0]
+            return
+        if LLM_CACHE_MODE == "replay":
+            raise LLMReplayMissError(f"No recorded completion for {cache_key}")
+
+    if default_model_type == "llama":
+        content = await _finish_completion(
+            cache_key,
+            await _local_completion(messages, params, prefix),
+            messages,
+            call_type,
+            call_id,
+            _passing_content(accept),
+        )
+        yield content
+        return
+
+    parts = []
+    async with _get_semaphore():
+        stream = await _create_completion(
+            model=default_model,
+            messages=messages,
+            stream=True,
+            # the last chunk carries the usage of the whole completion
+            stream_options={"include_usage": True},
+            **params,
+        )
+        usage = None
+        try:
+            async for chunk in stream:
+                usage = chunk.usage or usage
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    yield delta
+        except (openai.APIError, httpx.HTTPError) as e:
+            raise LLMUnavailableError(f"Completion stream broke off: {e}") from e
+        finally:
+            await stream.close()
+            _record_usage(usage, call_type)
+    await _finish_completion(
+        cache_key, "".join(parts), messages, call_type, call_id, accept
+    )
 
-async def chat_sim_one_day(all_character, date: str):
-    all_character_json = [char.model_dump_json() for char in all_character]
-    from World import World
 
-    weather_schema = get_weather_schema()
-    event_schema = get_event_schema()
-    messages = [
-        {
-            "role": "system",
-            "content": f"""
+@functools.lru_cache(maxsize=1)
+def _sim_one_day_template() -> PromptTemplate:
+    return PromptTemplate(
+        "sim_one_day",
+        [
+            static(
+                "instructions",
+                """
 Plase chain of thoughts.
 You will have data of the characters and simulated days info, please based on \
 each character's data, simulate some events happenned for them, events could have multiple \
 characters involved, had have interaction with one another if it make sense.
-all persons: {all_character_json}
-today: {date}
-1. For "city" each person in, generate today's weather, weather's schema is {weather_schema}. \
+all persons: """,
+            ),
+            dynamic("characters", "{characters}\n"),
+            dynamic("other_characters", "{other_characters}"),
+            dynamic(
+                "instructions",
+                """today: {date}
+1. For "city" each person in, generate today's weather, weather's schema is """,
+            ),
+            static("weather_schema", get_weather_schema()),
+            static(
+                "instructions",
+                """. \
 Store the weather of each city in a list, WEATHER_LIST
-2. For each character, generate 3 events for them, based on info known and weather in the city. \
-Event's schema is {event_schema}, store the events in a list, EVENTS_LIST
-4. Return the simulated day in json strictly follows schema: {World.get_schema()}, without any explanations or thoughts.
+2. For each character in all persons, generate 3 events for them, based on info known and weather in the city. \
+Only use ids of the persons above in id_of_character_involved. \
+Event's schema is """,
+            ),
+            static("event_schema", get_event_schema()),
+            static(
+                "instructions",
+                """, store the events in a list, EVENTS_LIST
+4. Return the simulated day in json strictly follows schema: """,
+            ),
+            static("world_schema", get_world_schema()),
+            static(
+                "instructions",
+                """, without any explanations or thoughts. \
+Write "weathers" before "events", and the events in order of start_time.
 """,
-        },
+            ),
+        ],
+        cot=True,
+    )
+
+
+def _sim_one_day_prompt(all_character, date: str, other_characters=None):
+    other_character_json = [
+        {
+            "id": char.basic_info.id,
+            "name": char.basic_info.name,
+            "city": char.basic_info.city,
+            "occupation": char.education_and_career.current_occupation,
+        }
+        for char in other_characters or []
     ]
-    return await raw_completion_explicit_cot(messages)
+    return _sim_one_day_template().render(
+        characters=compact_json(
+            [character_view(char, "sim_one_day") for char in all_character]
+        ),
+        other_characters=(
+            "other persons they may meet, only involve them together with someone "
+            f"from all persons: {compact_json(other_character_json)}\n"
+            if other_character_json
+            else ""
+        ),
+        date=date,
+    )
+
+
+async def chat_sim_one_day(
+    all_character, date: str, other_characters=None, accept: Optional[Accept] = None
+):
+    """
+    all_character are the people to simulate, other_characters are people outside
+    of them who may show up in their events but get no events of their own here.
+    """
+    prompt = _sim_one_day_prompt(all_character, date, other_characters)
+    return await complete_prompt(prompt, accept)
 
 
-async def fix_character(user_data_json):
+async def chat_sim_one_day_stream(
+    all_character, date: str, other_characters=None, accept: Optional[Accept] = None
+):
     """
-    This method will return a json of data that can be loaded as a Character
+    Streaming chat_sim_one_day, yields the response text as it is generated.
     """
+    prompt = _sim_one_day_prompt(all_character, date, other_characters)
+    async for delta in complete_prompt_stream(prompt, accept):
+        yield delta
 
-    schema = get_character_schema()
-    messages = [
-        {
-            "role": "system",
-            "content": f"""
+
+@functools.lru_cache(maxsize=1)
+def _fix_character_template() -> PromptTemplate:
+    return PromptTemplate(
+        "fix_character",
+        [
+            static(
+                "instructions",
+                """
 I will give you two json, one is data of a Person potentially in old schema, another is new schema.
 1. Please strictly fit the old data into new schema.
 2. For the missing attribute in the data, generate some reasonable data according to the person's info.
 3. Return the result directly in json, without any explanations or thoughts.
-person's data is {user_data_json}
-new schema is {schema}
-""",
-        }
-    ]
-    return await raw_completion(messages)
+person's data is """,
+            ),
+            dynamic("character", "{user_data_json}"),
+            static("instructions", "\nnew schema is "),
+            static("character_schema", get_character_schema()),
+            static("instructions", "\n"),
+        ],
+    )
 
 
-async def new_character(note, next_character_id=None):
-    char_schema = get_character_schema()
+async def fix_character(user_data_json, accept: Optional[Accept] = None):
     """
     This method will return a json of data that can be loaded as a Character
     """
-    messages = [
-        {
-            "role": "system",
-            "content": f"""
+    prompt = _fix_character_template().render(user_data_json=user_data_json)
+    return await complete_prompt(prompt, accept)
+
+
+@functools.lru_cache(maxsize=1)
+def _new_character_template() -> PromptTemplate:
+    return PromptTemplate(
+        "new_character",
+        [
+            dynamic(
+                "instructions",
+                """
 I will give you json a Person schema, please help generate a person for me.
-{f"This person's id is {next_character_id}" if next_character_id else ""}\
-{note or ""}\
+{id_note}""",
+            ),
+            dynamic("note", "{note}"),
+            static(
+                "instructions",
+                """\
 1. Each new person must have more than 3 experiences, 10 events from past couple days.
 2. You MUST strictly follow the data schema.
 3. Return the result directly in json, without any explanations or thoughts.\
-person's schema is {char_schema} \
-""",
-        }
-    ]
-    return await raw_completion(messages)
+person's schema is """,
+            ),
+            static("character_schema", get_character_schema()),
+            static("instructions", " \n"),
+        ],
+    )
+
 
+async def new_character(note, next_character_id=None, accept: Optional[Accept] = None):
+    """
+    This method will return a json of data that can be loaded as a Character
+    """
+    prompt = _new_character_template().render(
+        id_note=(
+            f"This person's id is {next_character_id}" if next_character_id else ""
+        ),
+        note=note or "",
+    )
+    return await complete_prompt(prompt, accept)
 
-async def world_process_event(event, related_characters, waethers, note=None):
-    char_schema = get_character_schema()
-    event_schema = get_event_schema()
 
-    messages = [
-        {
-            "role": "system",
-            "content": f"""
+@functools.lru_cache(maxsize=1)
+def _world_process_event_template() -> PromptTemplate:
+    return PromptTemplate(
+        "process_event",
+        [
+            static(
+                "instructions",
+                """
 Please use Chain of Thoughts and follow these steps carefully:
 
-{note or ""}
+""",
+            ),
+            dynamic("note", "{note}"),
+            static(
+                "instructions",
+                """
 
 1. I will provide you with weather data, a list of important characters involved in an event, and the JSON of the event.
 
@@ -156,34 +678,60 @@ Please use Chain of Thoughts and follow these steps carefully:
    - Incorporate details about the weather and the characters' interactions.
    - Add vivid details and dialogue to make the event more engaging.
 
-3. Create a NEW_EVENT object that strictly follows this Event schema: {event_schema}
+3. Create a NEW_EVENT object that strictly follows this Event schema: """,
+            ),
+            static("event_schema", get_event_schema()),
+            static(
+                "instructions",
+                """
    - Copy all fields from the original event.
    - Replace the 'description' field with your expanded version.
 
 Here's the data:
-Weather: {json.dumps([w.model_dump() for w in waethers])}
-Characters: {json.dumps([c.model_dump() for c in related_characters])}
-Original Event: {event.model_dump()}
-
-4. Next, consider the impact of this event on each involved character:
-   - 1.5% chance of significant change
-   - 4.5% chance of moderate change
-   - 74% chance of slight change
-   - 20% chance of no change
-   - Relationships between characters may also change based on the event.
-
-5. Create NEW_CHARACTERS objects for all involved characters, strictly following this Character schema: {char_schema}
-   - Modify character attributes based on the event's impact.
-   - Update relationships if applicable.
-
-6. Return the result in this exact JSON format, without any explanations or thoughts:
-{{
-  "related_characters": [NEW_CHARACTERS],
+Weather: """,
+            ),
+            dynamic("weathers", "{weathers}"),
+            static("instructions", "\nCharacters: "),
+            dynamic("characters", "{characters}"),
+            static(
+                "instructions",
+                "\nWhat each character remembers that is related to the event, by character id: ",
+            ),
+            dynamic("memories", "{memories}"),
+            static("instructions", "\nOriginal Event: "),
+            dynamic("event", "{event}"),
+            static(
+                "instructions",
+                """
+
+4. Return the result in this exact JSON format, without any explanations or thoughts:
+{
   "event": NEW_EVENT
-}}
+}
 
-Ensure that the NEW_EVENT object has an expanded description and that character changes are reflected in NEW_CHARACTERS.
+Ensure that the NEW_EVENT object has an expanded description.
 """,
-        }
-    ]
-    return await raw_completion(messages)
+            ),
+        ],
+    )
+
+
+async def world_process_event(
+    event, related_characters, waethers, note=None, memories=None,
+    accept: Optional[Accept] = None,
+):
+    """
+    Only the narrated event is returned, the characters change locally, see
+    trait_evolution. memories are the few past events of each character
+    relevant to this one, see memory.MemoryStore.recall.
+    """
+    prompt = _world_process_event_template().render(
+        note=note or "",
+        weathers=compact_json([w.model_dump() for w in waethers]),
+        characters=compact_json(
+            [character_view(c, "process_event") for c in related_characters]
+        ),
+        memories=compact_json(memories or {}),
+        event=compact_json(event.model_dump()),
+    )
+    return await complete_prompt(prompt, accept)
@@ -0,0 +1,95 @@
+import os
+import random
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Optional
+from relationships import RelationshipGraph
+
+SIM_SHARD_SIZE = int(os.getenv("SIM_SHARD_SIZE", "20"))
+SIM_CROSS_SHARD_CANDIDATES = int(os.getenv("SIM_CROSS_SHARD_CANDIDATES", "5"))
+SIM_PARTNERS_PER_CHARACTER = int(os.getenv("SIM_PARTNERS_PER_CHARACTER", "2"))
+
+
+def shard_characters(
+    ids: List[int], cities: List[str], shard_size: int = SIM_SHARD_SIZE
+) -> List[List[int]]:
+    """
+    Split the characters, given as ids and their cities, into shards of at most
+    shard_size ids, keeping people of the same city together. Small cities are
+    packed into one shard, large cities are split. The result only depends on
+    the characters, not on their order.
+    """
+    shard_size = max(1, shard_size)
+    by_city: Dict[str, List[int]] = defaultdict(list)
+    for character_id, city in zip(ids, cities):
+        by_city[city].append(character_id)
+
+    shards: List[List[int]] = []
+    current: List[int] = []
+    for city in sorted(by_city):
+        residents = sorted(by_city[city])
+        if len(current) + len(residents) > shard_size and current:
+            shards.append(current)
+            current = []
+        for i in range(0, len(residents), shard_size):
+            chunk = residents[i : i + shard_size]
+            if len(current) + len(chunk) > shard_size:
+                shards.append(current)
+                current = []
+            current.extend(chunk)
+    if current:
+        shards.append(current)
+    return shards
+
+
+class CharacterIndex(NamedTuple):
+    city_of: Dict[int, str]
+    by_city: Dict[str, List[int]]
+
+
+def index_characters(ids: List[int], cities: List[str]) -> CharacterIndex:
+    """
+    Built once per day, so that candidate selection never scans everyone.
+    """
+    by_city: Dict[str, List[int]] = defaultdict(list)
+    for character_id, city in sorted(zip(ids, cities)):
+        by_city[city].append(character_id)
+    return CharacterIndex(dict(zip(ids, cities)), dict(by_city))
+
+
+def cross_shard_candidates(
+    shard: List[int],
+    index: CharacterIndex,
+    graph: RelationshipGraph,
+    rng: random.Random,
+    date: Optional[str] = None,
+    limit: int = SIM_CROSS_SHARD_CANDIDATES,
+) -> List[int]:
+    """
+    Ids of people outside the shard that its members are likely to meet.
+
+    Each member draws SIM_PARTNERS_PER_CHARACTER partners from its neighbourhood
+    in the relationship graph, weighted by how close they are; the ones drawn
+    most often are kept. Remaining places go to random people living in the
+    same cities. Costs O(sum of the members' degrees), not O(population).
+    """
+    shard_ids = set(shard)
+    drawn: Dict[int, int] = defaultdict(int)
+    for character_id in shard:
+        for c_id in graph.sample_partners(
+            character_id, SIM_PARTNERS_PER_CHARACTER, rng, date, exclude=shard_ids
+        ):
+            if c_id in index.city_of:
+                drawn[c_id] += 1
+    chosen = sorted(drawn, key=lambda c_id: (-drawn[c_id], c_id))[:limit]
+
+    cities = sorted({index.city_of[c_id] for c_id in shard})
+    attempts = 0
+    while len(chosen) < limit and cities and attempts < 4 * limit:
+        attempts += 1
+        residents = index.by_city.get(rng.choice(cities), [])
+        if not residents:
+            continue
+        candidate = rng.choice(residents)
+        if candidate not in shard_ids and candidate not in chosen:
+            chosen.append(candidate)
+    return chosen
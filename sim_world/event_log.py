@@ -0,0 +1,469 @@
+"""
+Append-only history of processed events and character changes.
+
+Records are JSON lines in numbered segments under EVENT_LOG_DIR. Only the last
+segment is open for appends; once it holds EVENT_LOG_SEGMENT_RECORDS records it
+is sealed: gzipped in a background thread, after which its index (dates,
+character ids, locations, sequence range) is added to manifest.json. Queries
+read the manifest and open only the segments whose index can match.
+
+A simulated day appends inside transaction(), its records are only written
+once the day succeeded, so a failed day leaves no history behind.
+
+Record layout:
+    {"seq": 12, "kind": "event", "date": "2024-03-02", "location": "Davis",
+     "character_ids": [1, 3], "data": <Event>}
+    {"seq": 13, "kind": "character", "date": "2024-03-02", "location": "Davis",
+     "character_ids": [3], "data": {"id": 3, "ops": <JSON Patch from the previous state>}}
+"""
+
+import asyncio
+import contextvars
+import functools
+import gzip
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Set, Tuple
+
+import json_patch
+from structured_log import get_logger
+
+log = get_logger("event_log")
+
+EVENT_LOG_DIR = os.getenv("EVENT_LOG_DIR", "event_log")
+EVENT_LOG_SEGMENT_RECORDS = int(os.getenv("EVENT_LOG_SEGMENT_RECORDS", "5000"))
+MANIFEST = "manifest.json"
+PLAIN_SEGMENT = re.compile(r"segment-(\d{6})\.jsonl")
+
+# records of the running transaction, tasks started inside it share them
+_transaction: contextvars.ContextVar[Optional[List[Dict[str, Any]]]] = contextvars.ContextVar(
+    "event_log_transaction", default=None
+)
+
+
+class SegmentIndex:
+    """
+    What a segment contains, enough to decide whether a query must read it.
+    """
+
+    def __init__(self, segment_id: int):
+        self.segment_id = segment_id
+        self.records = 0
+        self.first_seq: Optional[int] = None
+        self.last_seq: Optional[int] = None
+        self.dates: Set[str] = set()
+        self.character_ids: Set[int] = set()
+        self.locations: Set[str] = set()
+
+    def add(self, record: Dict[str, Any]) -> None:
+        self.records += 1
+        if self.first_seq is None:
+            self.first_seq = record["seq"]
+        self.last_seq = record["seq"]
+        self.dates.add(record["date"])
+        self.character_ids.update(record["character_ids"])
+        if record.get("location"):
+            self.locations.add(record["location"])
+
+    def may_match(
+        self,
+        character_id: Optional[int],
+        date_from: Optional[str],
+        date_to: Optional[str],
+        location: Optional[str],
+        after: int,
+    ) -> bool:
+        if not self.records or self.last_seq <= after:
+            return False
+        if character_id is not None and character_id not in self.character_ids:
+            return False
+        if location is not None and location not in self.locations:
+            return False
+        # dates are YYYY-MM-DD, so string comparison is chronological
+        if date_from is not None and max(self.dates) < date_from:
+            return False
+        if date_to is not None and min(self.dates) > date_to:
+            return False
+        return True
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "segment_id": self.segment_id,
+            "records": self.records,
+            "first_seq": self.first_seq,
+            "last_seq": self.last_seq,
+            "dates": sorted(self.dates),
+            "character_ids": sorted(self.character_ids),
+            "locations": sorted(self.locations),
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "SegmentIndex":
+        index = cls(data["segment_id"])
+        index.records = data["records"]
+        index.first_seq = data["first_seq"]
+        index.last_seq = data["last_seq"]
+        index.dates = set(data["dates"])
+        index.character_ids = set(data["character_ids"])
+        index.locations = set(data["locations"])
+        return index
+
+
+class EventLog:
+    """
+    Appends cost one line write and an in-memory index update, no matter how
+    much history exists. The manifest is only rewritten when a segment is sealed.
+
+    Queries run in the threadpool while the event loop appends, the segment
+    lists, the active file and next_seq are guarded by a lock.
+    """
+
+    def __init__(self, directory: str = EVENT_LOG_DIR, segment_records: int = EVENT_LOG_SEGMENT_RECORDS):
+        self.directory = directory
+        self.segment_records = segment_records
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # one at a time, so segments enter the manifest in order
+        self._sealer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="event-log-seal")
+        self.sealed: List[SegmentIndex] = self._read_manifest()
+        # closed, still being gzipped, read from their plain file meanwhile
+        self.sealing: List[SegmentIndex] = []
+        self.active = self._recover()
+        self.next_seq = self._last_seq() + 1
+        self._file = open(self._plain_path(self.active.segment_id), "a")
+
+    def _segment_path(self, segment_id: int) -> str:
+        return os.path.join(self.directory, f"segment-{segment_id:06d}.jsonl.gz")
+
+    def _plain_path(self, segment_id: int) -> str:
+        return os.path.join(self.directory, f"segment-{segment_id:06d}.jsonl")
+
+    def _read_manifest(self) -> List[SegmentIndex]:
+        manifest_path = os.path.join(self.directory, MANIFEST)
+        if not os.path.exists(manifest_path):
+            return []
+        with open(manifest_path, "r") as f:
+            return [SegmentIndex.from_dict(s) for s in json.load(f)["segments"]]
+
+    def _write_manifest(self) -> None:
+        manifest_path = os.path.join(self.directory, MANIFEST)
+        tmp_path = f"{manifest_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"segments": [s.to_dict() for s in self.sealed]}, f)
+        os.replace(tmp_path, manifest_path)
+
+    def _recover(self) -> SegmentIndex:
+        """
+        Rebuild the index of the active segment. A crash while sealing can leave
+        the plain file of a segment that is already in the manifest, which is
+        dropped, or of one that is not, which is sealed now. A crash while
+        appending can leave a partial last line, which is dropped.
+        """
+        for segment in self.sealed:
+            stale = self._plain_path(segment.segment_id)
+            if os.path.exists(stale):
+                os.remove(stale)
+        first = self.sealed[-1].segment_id + 1 if self.sealed else 0
+        plain_ids = sorted(
+            int(match.group(1))
+            for match in map(PLAIN_SEGMENT.fullmatch, os.listdir(self.directory))
+            if match and int(match.group(1)) >= first
+        )
+        segments = [self._index_plain(segment_id) for segment_id in plain_ids]
+        for segment in segments[:-1]:
+            self._compress(segment)
+        return segments[-1] if segments else SegmentIndex(first)
+
+    def _index_plain(self, segment_id: int) -> SegmentIndex:
+        segment = SegmentIndex(segment_id)
+        path = self._plain_path(segment_id)
+        valid = []
+        damaged = False
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    damaged = True
+                    continue
+                segment.add(record)
+                valid.append(line if line.endswith("\n") else line + "\n")
+        if damaged:
+            with open(path, "w") as f:
+                f.writelines(valid)
+        return segment
+
+    def _last_seq(self) -> int:
+        for segment in reversed(self.sealed + self.sealing + [self.active]):
+            if segment.last_seq is not None:
+                return segment.last_seq
+        return 0
+
+    def append(
+        self,
+        kind: str,
+        date: str,
+        character_ids: List[int],
+        data: Any,
+        location: Optional[str] = None,
+    ) -> Optional[int]:
+        """
+        Returns:
+            int: sequence number of the record, None inside a transaction,
+                where it is only numbered when written.
+        """
+        (record,) = self._add([self._record(kind, date, character_ids, data, location)])
+        return record["seq"]
+
+    def append_many(self, kind: str, date: str, entries: List[Tuple[List[int], Any]]) -> None:
+        """
+        Append a (character_ids, data) record for each entry, written together.
+        """
+        self._add([self._record(kind, date, ids, data) for ids, data in entries])
+
+    @staticmethod
+    def _record(
+        kind: str,
+        date: str,
+        character_ids: List[int],
+        data: Any,
+        location: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        return {
+            "seq": None,
+            "kind": kind,
+            "date": date,
+            "location": location,
+            "character_ids": sorted(set(character_ids)),
+            "time": time.time(),
+            "data": data,
+        }
+
+    def _add(self, records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        pending = _transaction.get()
+        if pending is not None:
+            pending.extend(records)
+        elif records:
+            with self._lock:
+                self._write(records)
+        return records
+
+    def _write(self, records: List[Dict[str, Any]]) -> None:
+        # with the lock held
+        for record in records:
+            record["seq"] = self.next_seq
+            self.next_seq += 1
+            self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+            self.active.add(record)
+            if self.active.records >= self.segment_records:
+                self._seal()
+        self._file.flush()
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Records appended inside the block, and by tasks it starts, are kept and
+        written in a thread when it exits, or dropped if it raises.
+        """
+        if _transaction.get() is not None:
+            # nested blocks are part of the outer one
+            yield self
+            return
+        records: List[Dict[str, Any]] = []
+        token = _transaction.set(records)
+        try:
+            yield self
+        except BaseException:
+            log.error(f"Dropping {len(records)} event log records after a failure")
+            raise
+        finally:
+            _transaction.reset(token)
+        if records:
+            await asyncio.to_thread(self._commit, records)
+
+    def _commit(self, records: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            self._write(records)
+
+    def append_event(self, event: Dict[str, Any]) -> int:
+        return self.append(
+            "event",
+            event["date"],
+            event["id_of_character_involved"],
+            event,
+            event.get("location"),
+        )
+
+    def append_character_change(
+        self,
+        old: Dict[str, Any],
+        new: Dict[str, Any],
+        date: str,
+        location: Optional[str] = None,
+    ) -> Optional[int]:
+        """
+        Log only the difference, a character is several KB and most of it
+        does not change with an event. Nothing is logged if nothing changed.
+        """
+        ops = json_patch.diff(old, new)
+        if not ops:
+            return None
+        character_id = new["basic_info"]["id"]
+        return self.append(
+            "character", date, [character_id], {"id": character_id, "ops": ops}, location
+        )
+
+    def seal(self) -> None:
+        """
+        Start a new segment, the active one is compressed in the background.
+        """
+        with self._lock:
+            self._seal()
+
+    def _seal(self) -> None:
+        # with the lock held
+        if not self.active.records:
+            return
+        self._file.close()
+        self.sealing.append(self.active)
+        self._sealer.submit(self._compress, self.active)
+        self.active = SegmentIndex(self.active.segment_id + 1)
+        self._file = open(self._plain_path(self.active.segment_id), "a")
+
+    def _compress(self, segment: SegmentIndex) -> None:
+        path = self._plain_path(segment.segment_id)
+        gz_path = self._segment_path(segment.segment_id)
+        try:
+            with open(path, "rb") as src, gzip.open(f"{gz_path}.tmp", "wb") as dst:
+                dst.write(src.read())
+            os.replace(f"{gz_path}.tmp", gz_path)
+        except OSError as e:
+            # it stays readable as a plain file and is sealed again on restart
+            log.error(f"Failed to seal segment {segment.segment_id}: {e}")
+            return
+        with self._lock:
+            if segment in self.sealing:
+                self.sealing.remove(segment)
+            self.sealed.append(segment)
+            self._write_manifest()
+            os.remove(path)
+
+    def close(self) -> None:
+        self._sealer.shutdown(wait=True)
+        with self._lock:
+            self._file.close()
+
+    @staticmethod
+    def _read_plain(f: BinaryIO, size: int) -> Iterator[Dict[str, Any]]:
+        """
+        The records in the first size bytes, what was written when the query started.
+        """
+        for line in f:
+            size -= len(line)
+            if size < 0:
+                return
+            yield json.loads(line)
+
+    def _read_sealed(self, segment: SegmentIndex) -> Iterator[Dict[str, Any]]:
+        with gzip.open(self._segment_path(segment.segment_id), "rt") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+    def query(
+        self,
+        character_id: Optional[int] = None,
+        date_from: Optional[str] = None,
+        date_to: Optional[str] = None,
+        location: Optional[str] = None,
+        kind: Optional[str] = None,
+        after: int = 0,
+        limit: int = 50,
+    ) -> Dict[str, Any]:
+        """
+        Records matching every given filter, oldest first.
+
+        Args:
+            after: cursor, the next_cursor of the previous page.
+
+        Returns:
+            {"records": [...], "next_cursor": int or None, "segments_read": int}
+        """
+        def may_match(segment: SegmentIndex) -> bool:
+            return segment.may_match(character_id, date_from, date_to, location, after)
+
+        plain_files = []
+        with self._lock:
+            sources = [self._read_sealed(segment) for segment in self.sealed if may_match(segment)]
+            for segment in self.sealing + [self.active]:
+                if may_match(segment):
+                    # opened with the lock held, the plain file is removed once sealed,
+                    # and only what is written now is read, appends go on meanwhile
+                    f = open(self._plain_path(segment.segment_id), "rb")
+                    plain_files.append(f)
+                    sources.append(self._read_plain(f, os.fstat(f.fileno()).st_size))
+        try:
+            return self._query(sources, character_id, date_from, date_to, location, kind, after, limit)
+        finally:
+            for source in sources:
+                source.close()
+            for f in plain_files:
+                f.close()
+
+    @staticmethod
+    def _query(
+        sources: List[Iterator[Dict[str, Any]]],
+        character_id: Optional[int],
+        date_from: Optional[str],
+        date_to: Optional[str],
+        location: Optional[str],
+        kind: Optional[str],
+        after: int,
+        limit: int,
+    ) -> Dict[str, Any]:
+        records = []
+        segments_read = 0
+        for source in sources:
+            segments_read += 1
+            for record in source:
+                if record["seq"] <= after:
+                    continue
+                if kind is not None and record["kind"] != kind:
+                    continue
+                if character_id is not None and character_id not in record["character_ids"]:
+                    continue
+                if location is not None and record.get("location") != location:
+                    continue
+                if date_from is not None and record["date"] < date_from:
+                    continue
+                if date_to is not None and record["date"] > date_to:
+                    continue
+                records.append(record)
+                if len(records) == limit:
+                    return {
+                        "records": records,
+                        "next_cursor": record["seq"],
+                        "segments_read": segments_read,
+                    }
+        return {"records": records, "next_cursor": None, "segments_read": segments_read}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            segments = self.sealed + self.sealing + [self.active]
+            return {
+                "segments": len(segments),
+                "records": sum(s.records for s in segments),
+                "last_seq": self._last_seq(),
+            }
+
+
+@functools.lru_cache(maxsize=1)
+def get_event_log() -> EventLog:
+    return EventLog()
@@ -0,0 +1,132 @@
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from Character import Event
+from structured_log import get_logger
+
+log = get_logger("event_pipeline")
+
+DEFAULT_MAX_CONCURRENCY = int(os.getenv("SIM_EVENT_CONCURRENCY", "8"))
+
+
+class EventPipeline:
+    """
+    Run an async handler over events with bounded concurrency.
+
+    Events that share no character run at the same time. An event that involves
+    a character waits until the previously submitted event of that character has
+    finished, so updates to one character are applied in submission order.
+    A failing handler only loses its own event; events chained after it still run.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[Event], Awaitable[Any]],
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    ):
+        self._handler = handler
+        self._semaphore = asyncio.Semaphore(max(1, max_concurrency))
+        self._tails: Dict[int, asyncio.Task] = {}
+        self._tasks: List[asyncio.Task] = []
+        self.failures: List[Tuple[Event, BaseException]] = []
+
+    def submit(self, event: Event) -> asyncio.Task:
+        depends_on = {
+            self._tails[c_id]
+            for c_id in event.id_of_character_involved
+            if c_id in self._tails
+        }
+        task = asyncio.create_task(self._run(event, depends_on))
+        for c_id in event.id_of_character_involved:
+            self._tails[c_id] = task
+        self._tasks.append(task)
+        return task
+
+    async def _run(self, event: Event, depends_on: Set[asyncio.Task]):
+        if depends_on:
+            # asyncio.wait does not re-raise, a failed predecessor must not block us
+            await asyncio.wait(depends_on)
+        async with self._semaphore:
+            try:
+                return await self._handler(event)
+            except Exception as e:
+                log.warning(
+                    f"Error processing event at {event.start_time} "
+                    f"for characters {event.id_of_character_involved}: {e}",
+                    exc_info=True,
+                )
+                self.failures.append((event, e))
+                return None
+
+    async def join(self) -> List[Optional[Any]]:
+        """
+        Wait for every submitted event.
+
+        Returns:
+            List: handler results in submission order, None for failed events.
+        """
+        return list(await asyncio.gather(*self._tasks))
+
+    async def run(self, events: List[Event]) -> List[Optional[Any]]:
+        """
+        Submit events ordered by start_time and wait for all of them.
+
+        Returns:
+            List: handler results in the original order of events, None for failed events.
+        """
+        order = sorted(range(len(events)), key=lambda i: events[i].start_time)
+        tasks = {i: self.submit(events[i]) for i in order}
+        await asyncio.gather(*tasks.values())
+        return [tasks[i].result() for i in range(len(events))]
+
+
+class StartTimeGate:
+    """
+    Release events streamed by several shards in start_time order per character.
+
+    Every shard streams its events in order of start_time, so once a shard has
+    streamed an event at some time it cannot produce an earlier one. An event is
+    released as soon as every still open shard that mentions one of its
+    characters has got at least as far, and no earlier held event shares a
+    character with it.
+    """
+
+    def __init__(self, shards: Iterable[Iterable[int]], release: Callable[[Event], Any]):
+        self._release = release
+        self._shards_of: Dict[int, List[int]] = {}
+        for shard, ids in enumerate(shards):
+            for c_id in ids:
+                self._shards_of.setdefault(c_id, []).append(shard)
+        # the latest start_time each shard streamed, "" before its first event
+        self._since: Dict[int, str] = {}
+        self._closed: Set[int] = set()
+        self._held: List[Event] = []
+
+    def add(self, shard: int, event: Event) -> None:
+        self._since[shard] = max(self._since.get(shard, ""), event.start_time)
+        self._held.append(event)
+        self._flush()
+
+    def close(self, shard: int) -> None:
+        self._closed.add(shard)
+        self._flush()
+
+    def _settled(self, c_id: int, start_time: str) -> bool:
+        return all(
+            shard in self._closed or self._since.get(shard, "") >= start_time
+            for shard in self._shards_of.get(c_id, ())
+        )
+
+    def _flush(self) -> None:
+        blocked: Set[int] = set()
+        waiting = []
+        for event in sorted(self._held, key=lambda event: event.start_time):
+            involved = event.id_of_character_involved
+            if blocked.isdisjoint(involved) and all(
+                self._settled(c_id, event.start_time) for c_id in involved
+            ):
+                self._release(event)
+            else:
+                blocked.update(involved)
+                waiting.append(event)
+        self._held = waiting
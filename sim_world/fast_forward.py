@@ -0,0 +1,121 @@
+"""
+Simulate many days headless, e.g. to give a new world a month of history.
+
+Run from sim_world/:
+    python fast_forward.py --days 30
+
+The world and the characters are saved by every simulated day, so they are
+the state to resume from. The checkpoint file only records the target date
+and the figures of the completed days: after a crash, running the same
+command again continues with the day that did not finish, until the target
+date is reached. Use --fresh to drop an unfinished run and start a new one.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict
+
+CHECKPOINT_PATH = os.getenv("FAST_FORWARD_CHECKPOINT", "fast_forward.json")
+
+
+def read_checkpoint(path: str):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def write_checkpoint(path: str, checkpoint: Dict[str, Any]) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def throughput(days) -> str:
+    seconds = sum(day["seconds"] for day in days)
+    events = sum(day["events"] for day in days)
+    tokens = sum(day["tokens"] for day in days)
+    if not days or not seconds:
+        return "no completed days"
+    return (
+        f"{len(days) * 3600 / seconds:.1f} days/hour, "
+        f"{events * 60 / seconds:.1f} events/min, "
+        f"{tokens / len(days):.0f} tokens/day"
+    )
+
+
+async def run(days: int, checkpoint_path: str, fresh: bool) -> None:
+    # imported here so that --help does not load the world
+    import snapshot
+    import workers
+    from chat import close_client, get_token_usage
+
+    world = await snapshot.warm_start()
+    checkpoint = None if fresh else read_checkpoint(checkpoint_path)
+    if checkpoint is not None and world.date >= checkpoint["target_date"]:
+        checkpoint = None
+    if checkpoint is None:
+        target = datetime.strptime(world.date, "%Y-%m-%d") + timedelta(days=days)
+        checkpoint = {
+            "start_date": world.date,
+            "target_date": target.strftime("%Y-%m-%d"),
+            "days": [],
+        }
+        write_checkpoint(checkpoint_path, checkpoint)
+    else:
+        print(
+            f"Resuming from {world.date}, {len(checkpoint['days'])} days done, "
+            f"target {checkpoint['target_date']}"
+        )
+
+    try:
+        while world.date < checkpoint["target_date"]:
+            tokens_before = get_token_usage().get("total_tokens", 0)
+            start = time.perf_counter()
+            new_world = await world.sim_one_day()
+            elapsed = time.perf_counter() - start
+            day = {
+                "date": new_world.date,
+                "events": len(new_world.events),
+                "seconds": round(elapsed, 2),
+                "tokens": get_token_usage().get("total_tokens", 0) - tokens_before,
+            }
+            checkpoint["days"].append(day)
+            write_checkpoint(checkpoint_path, checkpoint)
+            print(
+                f"{day['date']}: {day['events']} events in {elapsed:.1f}s, "
+                f"{day['tokens']} tokens | {throughput(checkpoint['days'])}"
+            )
+            world = new_world
+    finally:
+        workers.stop_local_workers()
+        await close_client()
+    await snapshot.save_current(world)
+    print(f"Reached {world.date}: {throughput(checkpoint['days'])}")
+    print(f"token usage: {get_token_usage()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate several days in a row.")
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH)
+    parser.add_argument(
+        "--fresh", action="store_true", help="ignore an unfinished run and start a new one"
+    )
+    args = parser.parse_args()
+    import structured_log
+
+    structured_log.start_logging()
+    try:
+        asyncio.run(run(args.days, args.checkpoint, args.fresh))
+    finally:
+        structured_log.stop_logging()
+
+
+if __name__ == "__main__":
+    main()
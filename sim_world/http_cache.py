@@ -0,0 +1,82 @@
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Any, Callable, NamedTuple, Optional, Tuple
+from fastapi import Request, Response
+
+# versions and bodies kept, least recently used first out, e.g. of characters
+HTTP_CACHE_ENTRIES = int(os.getenv("HTTP_CACHE_ENTRIES", "10000"))
+
+
+class CachedBody(NamedTuple):
+    version: int
+    body: bytes
+    etag: str
+
+
+# (entity type, id) -> version, bumped every time the entity is saved. An
+# entry never outlives its version, so a forgotten version cannot match it.
+_versions: "OrderedDict[Tuple[str, Any], int]" = OrderedDict()
+_entries: "OrderedDict[Tuple[str, Any], CachedBody]" = OrderedDict()
+
+
+def version(entity_type: str, entity_id: Any = None) -> int:
+    return _versions.get((entity_type, entity_id), 0)
+
+
+def invalidate(entity_type: str, entity_id: Any = None) -> None:
+    """
+    Called when an entity is saved, the next request serializes it again.
+    """
+    key = (entity_type, entity_id)
+    _versions[key] = _versions.get(key, 0) + 1
+    _versions.move_to_end(key)
+    _entries.pop(key, None)
+    while len(_versions) > HTTP_CACHE_ENTRIES:
+        forgotten, _ = _versions.popitem(last=False)
+        _entries.pop(forgotten, None)
+
+
+def invalidate_all(entity_type: str) -> None:
+    """
+    Called when every entity of a type may have changed.
+    """
+    for key in [key for key in _versions.keys() | _entries.keys() if key[0] == entity_type]:
+        invalidate(*key)
+
+
+def get_or_build(
+    entity_type: str, entity_id: Any, build: Callable[[], bytes]
+) -> CachedBody:
+    """
+    The serialized entity for its current version, build is only called on a miss.
+    """
+    key = (entity_type, entity_id)
+    current = version(entity_type, entity_id)
+    cached = _entries.get(key)
+    if cached is None or cached.version != current:
+        body = build()
+        # content hash, so that ETags stay valid across restarts
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        cached = CachedBody(current, body, etag)
+        _entries[key] = cached
+        while len(_entries) > HTTP_CACHE_ENTRIES:
+            _entries.popitem(last=False)
+    _entries.move_to_end(key)
+    return cached
+
+
+def _matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return etag in tags or f"W/{etag}" in tags
+
+
+def respond(request: Request, cached: CachedBody) -> Response:
+    headers = {"ETag": cached.etag, "Cache-Control": "no-cache"}
+    if _matches(request.headers.get("if-none-match"), cached.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=cached.body, media_type="application/json", headers=headers)
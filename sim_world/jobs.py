@@ -0,0 +1,146 @@
+"""
+Simulated days run as background jobs, so a request only submits one.
+
+There is a single authoritative World, JobManager.world. A day is simulated
+from it and, once saved, the new World replaces it in one assignment, so
+readers see either the old day or the new one. At most one day runs at a
+time: submitting while a day is in flight returns the running job.
+"""
+
+import asyncio
+import itertools
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import http_cache
+import metrics
+from Character import Character
+from memory import get_memory_store
+from relationships import reset_graph
+from structured_log import correlate, get_logger
+
+log = get_logger("jobs")
+
+SIM_JOB_HISTORY = int(os.getenv("SIM_JOB_HISTORY", "50"))
+
+
+class Job:
+    def __init__(self, job_id: str, date: str, trace: bool, profile: bool):
+        self.id = job_id
+        self.date = date
+        self.trace = trace
+        self.profile = profile
+        self.status = "queued"
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.error: Optional[str] = None
+        # filled by World.sim_one_day: stage, shards and events done/total
+        self.progress: Dict[str, Any] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "kind": "sim_one_day",
+            "date": self.date,
+            "status": self.status,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "seconds": (
+                round((self.finished or time.time()) - self.started, 2)
+                if self.started
+                else None
+            ),
+            "progress": dict(self.progress),
+            "error": self.error,
+            "trace": self.trace,
+            "profile": self.profile,
+        }
+
+
+class JobManager:
+    def __init__(self, world=None):
+        # set before the first submission, see main.lifespan
+        self.world = world
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self.current: Optional[Job] = None
+        # False once a failed day could not be rolled back: its changes were
+        # dropped from the store but may still be in memory
+        self.consistent = True
+        self._ids = itertools.count(1)
+
+    def submit_day(self, trace: bool = False, profile: bool = False) -> Job:
+        """
+        Start simulating the next day, or return the day already in flight.
+        Must be called from the event loop.
+        """
+        if self.current is not None and not self.current.done:
+            return self.current
+        job = Job(
+            f"{int(time.time())}-{next(self._ids)}", self.world.next_date(), trace, profile
+        )
+        self.jobs[job.id] = job
+        while len(self.jobs) > SIM_JOB_HISTORY:
+            self.jobs.popitem(last=False)
+        self.current = job
+        job.task = asyncio.create_task(self._run(job))
+        return job
+
+    async def _run(self, job: Job) -> None:
+        job.status = "running"
+        job.started = time.time()
+        try:
+            with correlate(job=job.id):
+                async with metrics.trace_day(job.date, job.trace), metrics.profile_day(
+                    job.date, job.profile
+                ):
+                    new_world = await self.world.sim_one_day(job.progress)
+            # the only place the served world changes, a body cached before
+            # this line is of the previous world
+            self.world = new_world
+            http_cache.invalidate("World")
+            job.status = "done"
+        except Exception as e:
+            job.status = "failed"
+            job.error = f"{type(e).__name__}: {e}"
+            log.exception(f"Job {job.id} failed: {job.error}", job=job.id)
+            await self._roll_back(job)
+        finally:
+            job.finished = time.time()
+            metrics.jobs_total.inc(job.status)
+
+    async def _roll_back(self, job: Job) -> None:
+        """
+        The store dropped the failed day's batch, memory is brought back to it:
+        characters are loaded again, the graph and memories read again from
+        their files, and the cached bodies built from the day are dropped.
+        """
+        try:
+            with correlate(job=job.id):
+                discarded = get_memory_store().discard_unsaved()
+                reset_graph()
+                await Character.reload()
+                http_cache.invalidate_all("Character")
+                log.info("Rolled back the failed day", memories=discarded)
+        except Exception as e:
+            self.consistent = False
+            log.exception(f"Rolling back job {job.id} failed: {e}", job=job.id)
+
+    async def wait(self, job: Job) -> Job:
+        if job.task is not None:
+            await asyncio.shield(job.task)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def list(self) -> List[Job]:
+        return list(reversed(self.jobs.values()))
@@ -0,0 +1,99 @@
+"""
+Minimal JSON Patch (RFC 6902): diff two JSON documents into add/remove/replace
+operations, and apply them.
+"""
+
+import copy
+from typing import Any, Dict, List
+
+
+def _escape(token: Any) -> str:
+    return str(token).replace("~", "~0").replace("/", "~1")
+
+
+def _unescape(token: str) -> str:
+    return token.replace("~1", "/").replace("~0", "~")
+
+
+def diff(old: Any, new: Any, path: str = "") -> List[Dict[str, Any]]:
+    if type(old) is not type(new):
+        return [{"op": "replace", "path": path, "value": new}]
+    if isinstance(old, dict):
+        return _diff_dict(old, new, path)
+    if isinstance(old, list):
+        return _diff_list(old, new, path)
+    if old != new:
+        return [{"op": "replace", "path": path, "value": new}]
+    return []
+
+
+def _diff_dict(old: Dict[str, Any], new: Dict[str, Any], path: str) -> List[Dict[str, Any]]:
+    ops = []
+    for key in old:
+        if key not in new:
+            ops.append({"op": "remove", "path": f"{path}/{_escape(key)}"})
+    for key, value in new.items():
+        child = f"{path}/{_escape(key)}"
+        if key not in old:
+            ops.append({"op": "add", "path": child, "value": value})
+        else:
+            ops.extend(diff(old[key], value, child))
+    return ops
+
+
+def _diff_list(old: List[Any], new: List[Any], path: str) -> List[Dict[str, Any]]:
+    if old == new:
+        return []
+    # a sliding window like events_latest_10: drop from the front, append at the end
+    if new:
+        for shift, item in enumerate(old):
+            kept = len(old) - shift
+            if item == new[0] and old[shift:] == new[:kept]:
+                ops = [{"op": "remove", "path": f"{path}/0"} for _ in range(shift)]
+                ops += [{"op": "add", "path": f"{path}/-", "value": v} for v in new[kept:]]
+                if len(ops) < len(new):
+                    return ops
+                break
+    if len(old) == len(new):
+        ops = []
+        for i, (a, b) in enumerate(zip(old, new)):
+            ops.extend(diff(a, b, f"{path}/{i}"))
+        return ops
+    return [{"op": "replace", "path": path, "value": new}]
+
+
+def _parent(doc: Any, path: str):
+    tokens = [_unescape(t) for t in path.split("/")[1:]]
+    for token in tokens[:-1]:
+        doc = doc[int(token)] if isinstance(doc, list) else doc[token]
+    return doc, tokens[-1]
+
+
+def apply(doc: Any, ops: List[Dict[str, Any]]) -> Any:
+    """
+    Returns:
+        A patched copy of doc.
+    """
+    doc = copy.deepcopy(doc)
+    for op in ops:
+        if op["path"] == "":
+            doc = copy.deepcopy(op["value"])
+            continue
+        parent, token = _parent(doc, op["path"])
+        if isinstance(parent, list):
+            if op["op"] == "remove":
+                parent.pop(int(token))
+            elif op["op"] == "add":
+                value = copy.deepcopy(op["value"])
+                if token == "-":
+                    parent.append(value)
+                else:
+                    parent.insert(int(token), value)
+            else:
+                parent[int(token)] = copy.deepcopy(op["value"])
+        else:
+            if op["op"] == "remove":
+                del parent[token]
+            else:
+                parent[token] = copy.deepcopy(op["value"])
+    return doc
@@ -0,0 +1,152 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Literal, Optional
+
+# off:       never touch the cache
+# readwrite: serve hits, call the provider on misses and store the result once
+#            the caller accepted it, see chat.complete_prompt
+# record:    always call the provider and store (overwrite) the result
+# replay:    only serve from the cache, a miss is an error, no network at all
+CacheMode = Literal["off", "readwrite", "record", "replay"]
+
+LLM_CACHE_MODE: CacheMode = os.getenv("LLM_CACHE_MODE", "readwrite")
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", ".llm_cache")
+LLM_CACHE_MAX_BYTES = int(float(os.getenv("LLM_CACHE_MAX_MB", "512")) * 1024 * 1024)
+
+
+def make_key(model: str, messages: List[Dict[str, Any]], params: Dict[str, Any]) -> str:
+    """
+    Content address of a completion request.
+    """
+    payload = json.dumps(
+        {"model": model, "messages": messages, "params": params},
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    On-disk completion cache, one file per key, evicting the least recently used
+    entries once the total size goes over max_bytes.
+
+    Recency survives restarts through the files' mtime, which is bumped on every hit.
+    """
+
+    def __init__(self, directory: str = LLM_CACHE_DIR, max_bytes: int = LLM_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._index: Optional["OrderedDict[str, int]"] = None
+        self._total_bytes = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _load_index(self) -> None:
+        entries = []
+        if os.path.isdir(self.directory):
+            for sub in os.listdir(self.directory):
+                sub_dir = os.path.join(self.directory, sub)
+                if not os.path.isdir(sub_dir):
+                    continue
+                for filename in os.listdir(sub_dir):
+                    if not filename.endswith(".json"):
+                        continue
+                    stat = os.stat(os.path.join(sub_dir, filename))
+                    entries.append((stat.st_mtime, filename[:-5], stat.st_size))
+        entries.sort()
+        self._index = OrderedDict((key, size) for _, key, size in entries)
+        self._total_bytes = sum(self._index.values())
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            if self._index is None:
+                self._load_index()
+            if key not in self._index:
+                self.misses += 1
+                return None
+            path = self._path(key)
+            try:
+                with open(path, "r") as f:
+                    content = json.load(f)["content"]
+            except (OSError, ValueError, KeyError):
+                self._total_bytes -= self._index.pop(key)
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+            os.utime(path)
+            self.hits += 1
+            return content
+
+    def put(self, key: str, content: str, model: str) -> None:
+        path = self._path(key)
+        data = json.dumps({"model": model, "created": time.time(), "content": content})
+        with self._lock:
+            if self._index is None:
+                self._load_index()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+            self._total_bytes -= self._index.pop(key, 0)
+            size = os.path.getsize(path)
+            self._index[key] = size
+            self._total_bytes += size
+            self._evict()
+
+    def discard(self, key: str) -> None:
+        with self._lock:
+            if self._index is None:
+                self._load_index()
+            self._total_bytes -= self._index.pop(key, 0)
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self) -> None:
+        while self._total_bytes > self.max_bytes and len(self._index) > 1:
+            key, size = self._index.popitem(last=False)
+            self._total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    async def aget(self, key: str) -> Optional[str]:
+        return await asyncio.to_thread(self.get, key)
+
+    async def aput(self, key: str, content: str, model: str) -> None:
+        await asyncio.to_thread(self.put, key, content, model)
+
+    async def adiscard(self, key: str) -> None:
+        await asyncio.to_thread(self.discard, key)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "mode": LLM_CACHE_MODE,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self._index) if self._index is not None else None,
+            "bytes": self._total_bytes,
+        }
+
+
+response_cache = ResponseCache()
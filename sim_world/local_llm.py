@@ -0,0 +1,327 @@
+"""
+Local CPU inference for default_model_type == "llama", behind raw_completion.
+
+Concurrent requests are collected into batches of up to LOCAL_LLM_MAX_BATCH,
+waiting at most LOCAL_LLM_MAX_WAIT_MS for a batch to fill, and decoded
+together. A compiled prompt comes with its template's static prefix (the CoT
+protocol and the instructions before the first dynamic section, see
+prompt_compiler.CompiledPrompt.prefix); requests with the same prefix are
+decoded together, and the KV cache of the prefix is computed once, kept in a
+small LRU keyed on the prefix, and shared by every row starting with it.
+Prompts without a prefix, e.g. of raw_completion, are not prefix cached.
+"""
+
+import asyncio
+import functools
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# the messages of a template's static prefix, as (role, content) pairs
+Prefix = Tuple[Tuple[str, str], ...]
+
+from structured_log import get_logger
+
+log = get_logger("local_llm")
+
+LOCAL_LLM_MODEL = os.getenv("LOCAL_LLM_MODEL", "Qwen/Qwen2.5-0.5B-Instruct")
+LOCAL_LLM_MAX_BATCH = int(os.getenv("LOCAL_LLM_MAX_BATCH", "8"))
+LOCAL_LLM_MAX_WAIT_MS = float(os.getenv("LOCAL_LLM_MAX_WAIT_MS", "20"))
+LOCAL_LLM_MAX_NEW_TOKENS = int(os.getenv("LOCAL_LLM_MAX_NEW_TOKENS", "2048"))
+LOCAL_LLM_THREADS = int(os.getenv("LOCAL_LLM_THREADS", "0"))
+# shorter prefixes are not worth a cache entry
+LOCAL_LLM_MIN_PREFIX = int(os.getenv("LOCAL_LLM_MIN_PREFIX", "64"))
+LOCAL_LLM_PREFIX_CACHE_SIZE = int(os.getenv("LOCAL_LLM_PREFIX_CACHE_SIZE", "4"))
+
+
+class LocalModel:
+    """
+    A transformers causal LM on CPU with a hand-written decoding loop, so that
+    a batch can start from a cached prefix.
+    """
+
+    def __init__(self, model_name: str = LOCAL_LLM_MODEL):
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        if LOCAL_LLM_THREADS:
+            torch.set_num_threads(LOCAL_LLM_THREADS)
+        self.torch = torch
+        self.model_name = model_name
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModelForCausalLM.from_pretrained(
+            model_name, torch_dtype=torch.float32
+        ).to("cpu").eval()
+        self.pad_id = (
+            self.tokenizer.pad_token_id
+            if self.tokenizer.pad_token_id is not None
+            else self.tokenizer.eos_token_id
+        )
+        self.eos_ids = {self.tokenizer.eos_token_id}
+        if self.model.generation_config.eos_token_id is not None:
+            eos = self.model.generation_config.eos_token_id
+            self.eos_ids.update(eos if isinstance(eos, list) else [eos])
+        # prefix -> its token ids and legacy (key, value) tuples for batch size 1
+        self.prefix_cache: "OrderedDict[Prefix, Tuple[Tuple[int, ...], Any]]" = OrderedDict()
+        self.prefix_hits = 0
+        self.prefix_misses = 0
+
+    def encode(self, messages: List[Dict[str, str]]) -> List[int]:
+        return self.tokenizer.apply_chat_template(messages, add_generation_prompt=True)
+
+    @staticmethod
+    def common_length(tokens: Sequence[int], row: Sequence[int]) -> int:
+        length = 0
+        for a, b in zip(tokens, row):
+            if a != b:
+                break
+            length += 1
+        return length
+
+    def cached_prefix(self, prefix: Prefix, rows: Sequence[Sequence[int]]) -> Tuple[int, Any]:
+        """
+        The number of leading tokens every row shares with prefix, and the KV
+        cache of at least that many tokens; (0, None) if too short to be worth it.
+        """
+        if not prefix:
+            return 0, None
+        entry = self.prefix_cache.get(prefix)
+        if entry is None:
+            tokens = self.tokenizer.apply_chat_template(
+                [{"role": role, "content": content} for role, content in prefix],
+                add_generation_prompt=False,
+            )
+            # the rows go on with the dynamic text where the prefix closes its message
+            tokens = tuple(tokens[: self.common_length(tokens, rows[0])])
+            if len(tokens) < LOCAL_LLM_MIN_PREFIX:
+                return 0, None
+            self.prefix_misses += 1
+            entry = (tokens, self.prefix_kv(tokens))
+            self.prefix_cache[prefix] = entry
+            while len(self.prefix_cache) > LOCAL_LLM_PREFIX_CACHE_SIZE:
+                self.prefix_cache.popitem(last=False)
+        else:
+            self.prefix_hits += 1
+            self.prefix_cache.move_to_end(prefix)
+        tokens, cached = entry
+        # every row keeps at least one token to feed after the prefix
+        length = min(min(self.common_length(tokens, row), len(row) - 1) for row in rows)
+        if length < LOCAL_LLM_MIN_PREFIX:
+            return 0, None
+        return length, cached
+
+    def prefix_kv(self, tokens: Tuple[int, ...]) -> Any:
+        with self.torch.inference_mode():
+            output = self.model(self.torch.tensor([tokens]), use_cache=True)
+        past = output.past_key_values
+        return past.to_legacy_cache() if hasattr(past, "to_legacy_cache") else past
+
+    def generate(
+        self,
+        rows: List[List[int]],
+        max_new_tokens: int,
+        temperature: float,
+        prefix: Prefix = (),
+    ) -> Tuple[List[str], int]:
+        """
+        Decode a batch of tokenized prompts, which all start with prefix.
+
+        Returns:
+            The completions, and the number of tokens generated.
+        """
+        from transformers import DynamicCache
+
+        torch = self.torch
+        batch = len(rows)
+        prefix_len, legacy = self.cached_prefix(prefix, rows)
+        past = None
+        if legacy is not None:
+            past = DynamicCache.from_legacy_cache(
+                tuple(
+                    (
+                        k[:, :, :prefix_len].expand(batch, -1, -1, -1).contiguous(),
+                        v[:, :, :prefix_len].expand(batch, -1, -1, -1).contiguous(),
+                    )
+                    for k, v in legacy
+                )
+            )
+
+        # left-pad the suffixes, padding sits between the prefix and the suffix
+        # and is masked out, positions come from the mask
+        suffixes = [row[prefix_len:] for row in rows]
+        width = max(len(s) for s in suffixes)
+        input_ids = torch.tensor([[self.pad_id] * (width - len(s)) + s for s in suffixes])
+        suffix_mask = torch.tensor([[0] * (width - len(s)) + [1] * len(s) for s in suffixes])
+        attention_mask = torch.cat(
+            [torch.ones(batch, prefix_len, dtype=suffix_mask.dtype), suffix_mask], dim=1
+        )
+        positions = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        position_ids = positions[:, prefix_len:]
+
+        generated: List[List[int]] = [[] for _ in range(batch)]
+        done = [False] * batch
+        with torch.inference_mode():
+            for _ in range(max_new_tokens):
+                output = self.model(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    position_ids=position_ids,
+                    past_key_values=past,
+                    use_cache=True,
+                )
+                past = output.past_key_values
+                logits = output.logits[:, -1, :]
+                if temperature > 0:
+                    probs = torch.softmax(logits / temperature, dim=-1)
+                    next_tokens = torch.multinomial(probs, 1).squeeze(-1)
+                else:
+                    next_tokens = logits.argmax(dim=-1)
+                for i, token in enumerate(next_tokens.tolist()):
+                    if done[i]:
+                        continue
+                    if token in self.eos_ids:
+                        done[i] = True
+                    else:
+                        generated[i].append(token)
+                if all(done):
+                    break
+                input_ids = next_tokens.unsqueeze(-1)
+                attention_mask = torch.cat(
+                    [attention_mask, torch.ones(batch, 1, dtype=attention_mask.dtype)], dim=1
+                )
+                position_ids = position_ids[:, -1:] + 1
+        texts = [self.tokenizer.decode(tokens, skip_special_tokens=True) for tokens in generated]
+        return texts, sum(len(tokens) for tokens in generated)
+
+
+class _Request:
+    def __init__(self, messages, max_new_tokens: int, temperature: float, prefix: Prefix):
+        self.messages = messages
+        self.prefix = prefix
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class Batcher:
+    """
+    Collects concurrent completions into batches for one LocalModel. Decoding
+    runs in a worker thread, one batch at a time, while the next batch fills.
+    """
+
+    def __init__(self, max_batch: int = LOCAL_LLM_MAX_BATCH, max_wait_ms: float = LOCAL_LLM_MAX_WAIT_MS):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._model: Optional[LocalModel] = None
+        self._model_lock = threading.Lock()
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.requests = 0
+        self.generated_tokens = 0
+        self.prompt_tokens = 0
+        self.decode_seconds = 0.0
+
+    def model(self) -> LocalModel:
+        with self._model_lock:
+            if self._model is None:
+                self._model = LocalModel()
+            return self._model
+
+    async def complete(
+        self, messages, max_new_tokens: int, temperature: float, prefix: Prefix = ()
+    ) -> str:
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        request = _Request(messages, max_new_tokens, temperature, prefix)
+        await self._queue.put(request)
+        return await request.future
+
+    async def _collect(self) -> List[_Request]:
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._collect()
+            # rows of one decode share the sampling temperature and the prefix
+            groups: Dict[Tuple[float, Prefix], List[_Request]] = {}
+            for request in batch:
+                groups.setdefault((request.temperature, request.prefix), []).append(request)
+            for (temperature, prefix), requests in groups.items():
+                try:
+                    texts = await asyncio.to_thread(self._decode, requests, temperature, prefix)
+                except Exception as e:
+                    for request in requests:
+                        if not request.future.done():
+                            request.future.set_exception(e)
+                    continue
+                for request, text in zip(requests, texts):
+                    if not request.future.done():
+                        request.future.set_result(text)
+
+    def _decode(self, requests: List[_Request], temperature: float, prefix: Prefix) -> List[str]:
+        model = self.model()
+        rows = [model.encode(request.messages) for request in requests]
+        start = time.perf_counter()
+        texts, generated = model.generate(
+            rows, max(r.max_new_tokens for r in requests), temperature, prefix
+        )
+        elapsed = time.perf_counter() - start
+        self.batches += 1
+        self.requests += len(requests)
+        self.prompt_tokens += sum(len(row) for row in rows)
+        self.generated_tokens += generated
+        self.decode_seconds += elapsed
+        log.debug(
+            f"Local batch of {len(requests)}: {generated} tokens in {elapsed:.1f}s, "
+            f"{generated / max(elapsed, 1e-9):.1f} tokens/s"
+        )
+        return texts
+
+    def stats(self) -> Dict[str, Any]:
+        model = self._model
+        return {
+            "model": LOCAL_LLM_MODEL,
+            "batches": self.batches,
+            "requests": self.requests,
+            "mean_batch_size": self.requests / self.batches if self.batches else 0,
+            "prompt_tokens": self.prompt_tokens,
+            "generated_tokens": self.generated_tokens,
+            "tokens_per_second": self.generated_tokens / self.decode_seconds
+            if self.decode_seconds
+            else 0,
+            "prefix_cache_hits": model.prefix_hits if model else 0,
+            "prefix_cache_misses": model.prefix_misses if model else 0,
+        }
+
+
+@functools.lru_cache(maxsize=1)
+def get_batcher() -> Batcher:
+    return Batcher()
+
+
+async def complete(messages, prefix: Sequence[Dict[str, str]] = (), **params) -> str:
+    """
+    OpenAI-style params that apply locally are max_tokens and temperature,
+    the others are ignored. prefix are the leading messages all prompts of a
+    template start with, see prompt_compiler.CompiledPrompt.prefix.
+    """
+    return await get_batcher().complete(
+        messages,
+        params.get("max_tokens") or LOCAL_LLM_MAX_NEW_TOKENS,
+        float(params.get("temperature", 0.0)),
+        tuple((message["role"], message["content"]) for message in prefix),
+    )
@@ -1,23 +1,80 @@
-from fastapi import FastAPI, HTTPException, WebSocket
+from fastapi import FastAPI, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect
 import asyncio
-import json
-from World import world
-from Character import Character
+from Character import Character, CharacterStore
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
-import datetime
+from datetime import datetime
 from contextlib import asynccontextmanager
-from websocket_service import clients, notifyUpdate
-from fastapi import WebSocketDisconnect
-from websockets.exceptions import ConnectionClosedError
-
-Character.load_all_characters
+from websocket_service import broadcaster, entity_versions, handle_client_message
+from chat import close_client
+from llm_cache import response_cache
+from jobs import JobManager
+import snapshot
+import workers
+import metrics
+from structured_log import get_logger, start_logging, stop_logging
+import http_cache
+from event_log import get_event_log
+from typing import Literal, Optional
+
+log = get_logger("main")
+
+# the world is loaded in lifespan, not at import
+job_manager = JobManager()
+# characters are not kept by entity_versions, resyncs read the population
+entity_versions.register_loader(
+    "Character", lambda character_id: CharacterStore.population.record(int(character_id))
+)
+
+metrics.Gauge(
+    "sim_ws_clients", "Connected websocket clients.",
+    lambda: {(): broadcaster.metrics()["clients"]},
+)
+metrics.Gauge(
+    "sim_ws_queue_depth", "Messages waiting in websocket send queues.",
+    lambda: {(): broadcaster.metrics()["queue_depth_total"]},
+)
+metrics.Gauge(
+    "sim_characters_loaded", "Characters held in memory.",
+    lambda: {(): len(CharacterStore.population)},
+)
+metrics.Gauge(
+    "sim_event_log_records", "Records in the event log.",
+    lambda: {(): get_event_log().stats()["records"]},
+)
+metrics.Gauge(
+    "sim_work_items", "Work items in the worker queue, by status.",
+    lambda: {
+        (status,): count for status, count in workers.get_work_queue().counts().items()
+    } if workers.enabled() else {},
+    ("status",),
+)
+metrics.Gauge(
+    "sim_llm_cache_entries", "Responses in the LLM cache.",
+    lambda: {(): response_cache.stats()["entries"] or 0},
+)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    yield
-    scheduler.shutdown()
+    # logs are written by a thread while the app runs, see structured_log
+    start_logging()
+    try:
+        job_manager.world = await snapshot.warm_start()
+        scheduler.add_job(
+            scheduled_test, CronTrigger(hour=0, minute=0)
+        )  # Run every day at midnight
+        scheduler.start()
+        yield
+        scheduler.shutdown()
+        workers.stop_local_workers()
+        await close_client()
+        # a day in flight, or a failed one not rolled back, leaves memory ahead of the store
+        idle = job_manager.current is None or job_manager.current.done
+        if idle and job_manager.consistent:
+            await snapshot.save_current(job_manager.world)
+    finally:
+        stop_logging()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -27,54 +84,96 @@ scheduler = AsyncIOScheduler()
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
-    clients.append(websocket)
-    await websocket.send_json({"event": "init", "world": world.model_dump()})
+    connection = broadcaster.register(websocket)
+    connection.send(
+        entity_versions.init_message(lambda: job_manager.world.model_dump(mode="json"))
+    )
+    heartbeat = asyncio.create_task(send_heartbeat(connection))
     try:
-        # Periodically send updates
-        while True:
-            try:
-                message = {"event": "alive", "status": "Event ongoing"}
-                await websocket.send_json(message)
-                await asyncio.sleep(15)
-            except ConnectionClosedError as ce:
-                print(f"WebSocket connection closed: {ce}")
-                break
-            except Exception as e:
-                print(f"Error sending message: {str(e)}")
-                break
+        # clients subscribe to characters and ask for snapshots when they
+        # detect a version gap
+        while not connection.closed:
+            message = await websocket.receive_json()
+            if isinstance(message, dict):
+                handle_client_message(connection, message)
     except WebSocketDisconnect:
-        print(f"Client #{id(websocket)} disconnected normally")
+        log.info(f"Client #{id(websocket)} disconnected normally")
     except Exception as e:
-        print(f"WebSocket error: {str(e)}, type: {type(e)}")
+        log.warning(f"WebSocket error: {str(e)}, type: {type(e)}")
     finally:
-        if websocket in clients:
-            clients.remove(websocket)
-        print(f"Client #{id(websocket)} connection cleaned up")
+        heartbeat.cancel()
+        broadcaster.unregister(websocket)
+        log.info(f"Client #{id(websocket)} connection cleaned up")
+
+
+async def send_heartbeat(connection):
+    # Periodically send updates, a closed connection ends the loop
+    while not connection.closed:
+        connection.send({"event": "alive", "status": "Event ongoing"})
+        await asyncio.sleep(15)
+
+
+@app.get("/ws/metrics")
+def websocket_metrics():
+    return broadcaster.metrics()
 
 
 @app.post("/interact")
 async def interact():
     message = {"event": "interaction", "status": "User interacted"}
-    for client in clients:
-        await client.send_json(message)
+    broadcaster.broadcast(message)
     return {"message": "Interaction sent"}
 
 
 @app.get("/")
-def read_root():
-    return world.model_dump()
+def read_root(request: Request):
+    return http_cache.respond(
+        request,
+        http_cache.get_or_build(
+            "World", None, lambda: job_manager.world.model_dump_json().encode()
+        ),
+    )
 
 
-# simulate a day
+# simulate a day in the background, poll /jobs/{id} for progress
 @app.get("/test")
 async def test():
-    response = await world.sim_one_day()
-    return json.dumps(response)
+    return job_manager.submit_day().to_dict()
+
+
+@app.post("/jobs/sim_one_day")
+async def submit_sim_one_day(trace: bool = False, profile: bool = False):
+    """
+    trace writes the span tree of the day to traces/{date}.json, profile a
+    sampled flame graph to profiles/{date}.folded. Both only apply when a new
+    job starts, not when attaching to the one in flight.
+    """
+    return job_manager.submit_day(trace=trace, profile=profile).to_dict()
+
+
+@app.get("/jobs")
+def list_jobs():
+    return [job.to_dict() for job in job_manager.list()]
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job.to_dict()
+
+
+@app.get("/metrics")
+def prometheus_metrics():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
 
 
 async def scheduled_test():
-    print(f"Running scheduled test at {datetime.now()}")
-    await test()
+    log.info(f"Running scheduled test at {datetime.now()}")
+    job = await job_manager.wait(job_manager.submit_day())
+    if job.status == "failed":
+        log.error(f"Scheduled test failed: {job.error}")
 
 
 @app.get("/introduce_new_character")
@@ -86,28 +185,45 @@ async def test2():
     return {"test": c.model_dump()}
 
 
-@app.get("/char/{id}")
-async def check_character(id: int):
-    try:
-        character = await Character.load_from_json(id)
-        return character.model_dump()
-    except FileNotFoundError:
-        raise HTTPException(status_code=404, detail=f"Character with id {id} not found")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
-
-
-@app.on_event("startup")
-async def startup_event():
-    scheduler.add_job(
-        scheduled_test, CronTrigger(hour=0, minute=0)
-    )  # Run every day at midnight
-    scheduler.start()
+@app.get("/history")
+def history(
+    character_id: Optional[int] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    location: Optional[str] = None,
+    kind: Optional[Literal["event", "character"]] = None,
+    after: int = 0,
+    limit: int = Query(50, ge=1, le=500),
+):
+    """
+    e.g. /history?kind=event&character_id=3&date_from=2024-03-01&date_to=2024-03-31,
+    pass next_cursor as after to get the next page.
+    """
+    return get_event_log().query(
+        character_id=character_id,
+        date_from=date_from,
+        date_to=date_to,
+        location=location,
+        kind=kind,
+        after=after,
+        limit=limit,
+    )
 
 
-@app.on_event("shutdown")
-async def shutdown_event():
-    scheduler.shutdown()
+@app.get("/char/{id}")
+async def check_character(id: int, request: Request):
+    population = await Character.get_population()
+    if id not in population:
+        raise HTTPException(status_code=404, detail=f"Character with id {id} not found")
+    # the model is only built on a cache miss, a 304 costs a lookup
+    return http_cache.respond(
+        request,
+        http_cache.get_or_build(
+            "Character",
+            id,
+            lambda: Character.model_validate(population.record(id)).model_dump_json().encode(),
+        ),
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,319 @@
+"""
+Per-character memories, retrieved by embedding similarity.
+
+Every processed event becomes a memory of each character involved. When a
+prompt is built for a new event, only the MEMORY_TOP_K memories closest to it
+are included, so the prompt does not grow with the age of a character.
+
+Forgetting is random, as described in character.md: once a character holds
+MEMORY_CAPACITY memories, one is dropped at random, less important memories
+being more likely to go, but any of them can.
+
+At most MEMORY_CACHE_CHARACTERS characters' memories are held in memory, the
+least recently used are dropped and loaded again from their .npz file, which
+is written on every change. Inside a store batch, e.g. a simulated day, the
+files are written with the batch, and the changed memories are kept until then.
+"""
+
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from storage import get_store
+from structured_log import get_logger
+
+log = get_logger("memory")
+
+MEMORY_DIR = os.getenv("MEMORY_DIR", "memories")
+MEMORY_MODEL = os.getenv("MEMORY_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+MEMORY_CAPACITY = int(os.getenv("MEMORY_CAPACITY", "200"))
+MEMORY_TOP_K = int(os.getenv("MEMORY_TOP_K", "5"))
+# memories are event descriptions, long ones are cut in the prompt
+MEMORY_TEXT_CHARS = int(os.getenv("MEMORY_TEXT_CHARS", "400"))
+MEMORY_SEED = os.getenv("MEMORY_SEED")
+# a character's memories take about 300 KB at the default capacity
+MEMORY_CACHE_CHARACTERS = int(os.getenv("MEMORY_CACHE_CHARACTERS", "500"))
+LOCK_STRIPES = 64
+HASH_DIM = 384
+
+# importance of the memories a character starts with, from its event history
+HISTORY_IMPORTANCE = {
+    "highlight_3_max": 0.9,
+    "lowlight_3_max": 0.9,
+    "events_latest_10": 0.5,
+}
+
+
+class HashingEmbedder:
+    """
+    Bag of hashed words, used when the transformer model cannot be loaded.
+    Much weaker, but retrieval still prefers memories sharing names and places.
+    """
+
+    name = f"hashing-{HASH_DIM}"
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), HASH_DIM), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in re.findall(r"\w+", text.lower()):
+                digest = hashlib.md5(word.encode()).digest()
+                vectors[row, int.from_bytes(digest[:4], "little") % HASH_DIM] += 1.0
+        return _normalize(vectors)
+
+
+class TransformerEmbedder:
+    """
+    Mean-pooled sentence embeddings from a local transformers model, on CPU.
+    """
+
+    def __init__(self, model_name: str):
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+
+        self.torch = torch
+        self.name = model_name
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModel.from_pretrained(model_name).to("cpu").eval()
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        batch = self.tokenizer(
+            texts, padding=True, truncation=True, max_length=256, return_tensors="pt"
+        )
+        with self.torch.inference_mode():
+            hidden = self.model(**batch).last_hidden_state
+        mask = batch["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+        pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+        return _normalize(pooled.numpy().astype(np.float32))
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-9)
+
+
+@functools.lru_cache(maxsize=1)
+def get_embedder():
+    try:
+        return TransformerEmbedder(MEMORY_MODEL)
+    except Exception as e:
+        log.warning(f"Embedding model {MEMORY_MODEL} unavailable, using hashed words: {e}")
+        return HashingEmbedder()
+
+
+class CharacterMemory:
+    """
+    The memories of one character: texts with their date and importance, and
+    an (n, dim) matrix of unit vectors, so retrieval is one matrix product.
+    """
+
+    def __init__(self, character_id: int, embedder_name: str):
+        self.character_id = character_id
+        self.embedder_name = embedder_name
+        self.items: List[Dict[str, Any]] = []
+        self.vectors: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def add(self, vector: np.ndarray, text: str, date: str, importance: float, rng: random.Random) -> None:
+        self.items.append({"text": text, "date": date, "importance": importance})
+        vector = vector.reshape(1, -1)
+        self.vectors = vector if self.vectors is None else np.vstack([self.vectors, vector])
+        while len(self.items) > MEMORY_CAPACITY:
+            self.forget(rng)
+
+    def forget(self, rng: random.Random) -> None:
+        weights = [1.1 - item["importance"] for item in self.items]
+        index = rng.choices(range(len(self.items)), weights=weights)[0]
+        del self.items[index]
+        self.vectors = np.delete(self.vectors, index, axis=0)
+
+    def top_k(self, query: np.ndarray, k: int) -> List[Tuple[float, Dict[str, Any]]]:
+        if not self.items:
+            return []
+        scores = self.vectors @ query
+        k = min(k, len(self.items))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [(float(scores[i]), self.items[i]) for i in best]
+
+    def save(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{self.character_id}.npz")
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(
+            tmp_path,
+            vectors=self.vectors if self.vectors is not None else np.zeros((0, 0), np.float32),
+            meta=np.array(json.dumps({"embedder": self.embedder_name, "items": self.items})),
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, directory: str, character_id: int, embedder_name: str) -> Optional["CharacterMemory"]:
+        """
+        None if there is no file, or it was embedded with another model.
+        """
+        path = os.path.join(directory, f"{character_id}.npz")
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            if meta["embedder"] != embedder_name:
+                return None
+            memory = cls(character_id, embedder_name)
+            memory.items = meta["items"]
+            memory.vectors = data["vectors"] if memory.items else None
+        return memory
+
+
+class MemoryStore:
+    """
+    Used from the threads of arecall and aremember. The cache and the lazily
+    loaded embedder are guarded by locks, and a character's memories are only
+    loaded, read or changed and saved holding the lock of its stripe, so a
+    dropped copy still in use cannot race a fresh one loaded from its file.
+    """
+
+    def __init__(
+        self,
+        directory: str = MEMORY_DIR,
+        embedder=None,
+        max_characters: int = MEMORY_CACHE_CHARACTERS,
+    ):
+        self.directory = directory
+        self.max_characters = max_characters
+        self._embedder = embedder
+        self._embedder_lock = threading.Lock()
+        # least recently used first
+        self._memories: "OrderedDict[int, CharacterMemory]" = OrderedDict()
+        # changed, their file is written with the store batch
+        self._unsaved: Dict[int, CharacterMemory] = {}
+        self._lock = threading.Lock()
+        self._stripes = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self.rng = random.Random(MEMORY_SEED)
+
+    @property
+    def embedder(self):
+        if self._embedder is None:
+            with self._embedder_lock:
+                if self._embedder is None:
+                    self._embedder = get_embedder()
+        return self._embedder
+
+    def _stripe(self, character) -> threading.Lock:
+        return self._stripes[character.basic_info.id % LOCK_STRIPES]
+
+    def _get(self, character) -> CharacterMemory:
+        """
+        With the character's stripe held.
+        """
+        character_id = character.basic_info.id
+        with self._lock:
+            memory = self._memories.get(character_id)
+            if memory is None:
+                memory = self._unsaved.get(character_id)
+            if memory is not None:
+                self._memories[character_id] = memory
+                self._memories.move_to_end(character_id)
+                return memory
+        # loaded and seeded without the cache lock, other characters go on meanwhile
+        memory = CharacterMemory.load(self.directory, character_id, self.embedder.name)
+        if memory is None:
+            memory = self._seed(character)
+        with self._lock:
+            self._memories[character_id] = memory
+            # the files or _unsaved are up to date, dropping is enough
+            while len(self._memories) > self.max_characters:
+                self._memories.popitem(last=False)
+        return memory
+
+    def _seed(self, character) -> CharacterMemory:
+        """
+        A character without a memory file starts from its event history, saved
+        right away so that it can be dropped from the cache.
+        """
+        memory = CharacterMemory(character.basic_info.id, self.embedder.name)
+        events = [
+            (event, importance)
+            for field, importance in HISTORY_IMPORTANCE.items()
+            for event in getattr(character, field)
+        ]
+        if events:
+            vectors = self.embedder.embed([event.description for event, _ in events])
+            for vector, (event, importance) in zip(vectors, events):
+                memory.add(vector, event.description, event.date, importance, self.rng)
+            self._save(memory)
+        return memory
+
+    def _save(self, memory: CharacterMemory) -> None:
+        with self._lock:
+            self._unsaved[memory.character_id] = memory
+        get_store().save_file(
+            os.path.join(self.directory, f"{memory.character_id}.npz"),
+            functools.partial(self._write, memory),
+        )
+
+    def _write(self, memory: CharacterMemory) -> None:
+        # under the stripe from _save, or once the batch is over
+        memory.save(self.directory)
+        with self._lock:
+            if self._unsaved.get(memory.character_id) is memory:
+                del self._unsaved[memory.character_id]
+
+    def discard_unsaved(self) -> int:
+        """
+        Forget the changes whose batch was dropped, e.g. by a failed day, the
+        memories are loaded again from their files.
+
+        Returns:
+            int: how many characters' memories were forgotten.
+        """
+        with self._lock:
+            for character_id in self._unsaved:
+                self._memories.pop(character_id, None)
+            discarded = len(self._unsaved)
+            self._unsaved.clear()
+        return discarded
+
+    def recall(self, characters, query: str, k: int = MEMORY_TOP_K) -> Dict[int, List[Dict[str, Any]]]:
+        """
+        The k memories of each character closest to query, most similar first.
+        """
+        vector = self.embedder.embed([query])[0]
+        recalled = {}
+        for character in characters:
+            with self._stripe(character):
+                best = self._get(character).top_k(vector, k)
+            recalled[character.basic_info.id] = [
+                {"date": item["date"], "text": item["text"][:MEMORY_TEXT_CHARS]}
+                for _, item in best
+            ]
+        return recalled
+
+    def remember(self, characters, text: str, date: str, importance: float = 0.5) -> None:
+        vector = self.embedder.embed([text])[0]
+        for character in characters:
+            with self._stripe(character):
+                memory = self._get(character)
+                memory.add(vector, text, date, importance, self.rng)
+                self._save(memory)
+
+    async def arecall(self, characters, query: str, k: int = MEMORY_TOP_K):
+        # embedding is CPU bound, keep it off the event loop
+        return await asyncio.to_thread(self.recall, characters, query, k)
+
+    async def aremember(self, characters, text: str, date: str, importance: float = 0.5):
+        await asyncio.to_thread(self.remember, characters, text, date, importance)
+
+
+@functools.lru_cache(maxsize=1)
+def get_memory_store() -> MemoryStore:
+    return MemoryStore()
@@ -0,0 +1,293 @@
+"""
+Metrics in the Prometheus text format, per-day trace files and a sampling
+profiler.
+
+    with metrics.stage("process_event"):
+        ...
+
+observes the duration in the sim_stage_seconds histogram and, while a day is
+traced, adds a span to the trace tree. Spans follow asyncio tasks through
+contextvars, so concurrent shards and events nest under the right parent.
+"""
+
+import asyncio
+import contextvars
+import json
+import math
+import os
+import sys
+import threading
+import time
+from collections import Counter as _Counter
+from collections import defaultdict
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from structured_log import get_logger
+
+log = get_logger("metrics")
+
+TRACE_DIR = os.getenv("SIM_TRACE_DIR", "traces")
+PROFILE_DIR = os.getenv("SIM_PROFILE_DIR", "profiles")
+PROFILE_INTERVAL = float(os.getenv("SIM_PROFILE_INTERVAL", "0.005"))
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(
+            name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+def _number(value: float) -> str:
+    # full precision, {:g} would render 1234567 as 1.23457e+06
+    value = float(value)
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name, self.help, self.label_names = name, help, labels
+        self.values: Dict[Tuple[str, ...], float] = defaultdict(float)
+        REGISTRY.append(self)
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self.values[labels] += amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_labels(self.label_names, labels)} {_number(value)}")
+        return lines
+
+
+class Gauge:
+    """
+    Read when scraped, from a function returning {label values: value}.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        read: Callable[[], Dict[Tuple[str, ...], float]],
+        labels: Tuple[str, ...] = (),
+    ):
+        self.name, self.help, self.read, self.label_names = name, help, read, labels
+        REGISTRY.append(self)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            values = self.read()
+        except Exception as e:
+            log.warning(f"Gauge {self.name} failed: {e}")
+            return lines
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{_labels(self.label_names, labels)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name, self.help, self.label_names = name, help, labels
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.counts: Dict[Tuple[str, ...], List[int]] = {}
+        self.sums: Dict[Tuple[str, ...], float] = defaultdict(float)
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *labels: str) -> None:
+        counts = self.counts.get(labels)
+        if counts is None:
+            counts = self.counts[labels] = [0] * len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        self.sums[labels] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, counts in sorted(self.counts.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else f"{bound:g}"
+                label_text = _labels(self.label_names + ("le",), labels + (le,))
+                lines.append(f"{self.name}_bucket{label_text} {cumulative}")
+            label_text = _labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label_text} {_number(self.sums[labels])}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+REGISTRY: List[Any] = []
+
+stage_seconds = Histogram(
+    "sim_stage_seconds", "Duration of each simulation stage.", ("stage",)
+)
+llm_calls = Counter(
+    "sim_llm_calls_total", "Completions by call type and outcome.", ("call_type", "outcome")
+)
+llm_tokens = Counter(
+    "sim_llm_tokens_total", "Tokens billed, by call type and kind.", ("call_type", "kind")
+)
+llm_errors = Counter(
+    "sim_llm_errors_total", "Failed completions by call type and error.", ("call_type", "error")
+)
+jobs_total = Counter("sim_jobs_total", "Simulation jobs by final status.", ("status",))
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class Span:
+    def __init__(self, name: str, attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.attributes = attributes or {}
+        self.start = time.time()
+        self.duration: Optional[float] = None
+        self.children: List["Span"] = []
+
+    def to_dict(self, origin: float) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "start_ms": round((self.start - origin) * 1000, 3),
+            "duration_ms": round((self.duration or 0) * 1000, 3),
+            **({"attributes": self.attributes} if self.attributes else {}),
+            **({"children": [c.to_dict(origin) for c in self.children]} if self.children else {}),
+        }
+
+
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+
+@contextmanager
+def stage(name: str, **attributes):
+    """
+    Time a stage, and trace it as a child of the current span if there is one.
+    """
+    parent = _current_span.get()
+    span = None
+    token = None
+    if parent is not None:
+        span = Span(name, attributes)
+        parent.children.append(span)
+        token = _current_span.set(span)
+    start = time.perf_counter()
+    try:
+        yield span
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, name)
+        if span is not None:
+            span.duration = elapsed
+            _current_span.reset(token)
+
+
+def _write_trace(path: str, data: Dict[str, Any]) -> None:
+    os.makedirs(TRACE_DIR, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(data, f, indent=1)
+
+
+@asynccontextmanager
+async def trace_day(date: str, enabled: bool):
+    """
+    Record the span tree of one simulated day into TRACE_DIR/{date}.json,
+    written in a thread.
+    """
+    if not enabled:
+        yield None
+        return
+    root = Span("day", {"date": date})
+    token = _current_span.set(root)
+    start = time.perf_counter()
+    try:
+        yield root
+    finally:
+        root.duration = time.perf_counter() - start
+        _current_span.reset(token)
+        path = os.path.join(TRACE_DIR, f"{date}.json")
+        await asyncio.to_thread(_write_trace, path, root.to_dict(root.start))
+        log.info(f"Trace of {date} written to {path}")
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread every interval from a background thread,
+    and counts the stacks in the collapsed format flame graph tools read:
+    "outer;inner;innermost count" per line.
+    """
+
+    def __init__(self, thread_id: int, interval: float = PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples: _Counter = _Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+@asynccontextmanager
+async def profile_day(date: str, enabled: bool):
+    """
+    Profile the event loop thread for one simulated day into
+    PROFILE_DIR/{date}.folded, written in a thread.
+    """
+    if not enabled:
+        yield None
+        return
+    profiler = SamplingProfiler(threading.get_ident())
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        path = os.path.join(PROFILE_DIR, f"{date}.folded")
+        await asyncio.to_thread(profiler.write, path)
+        log.info(f"Profile of {date} written to {path}, {sum(profiler.samples.values())} samples")
@@ -0,0 +1,284 @@
+"""
+The loaded characters as one columnar table instead of a dict of models.
+
+A Character model with its nested sections costs tens of KB of Python
+objects, and any population-wide question means a loop over attributes.
+Here every character is a row:
+- the 0-100 scales of trait_evolution.trait_fields() form one uint8 matrix;
+- other numbers, like age and salary, are NumPy columns;
+- repeated strings, like city or occupation, are dictionary-encoded: an
+  int32 code per row and the distinct values once;
+- whatever is left (name, hobbies, experiences, events...) is kept as
+  zlib-compressed JSON.
+
+Questions are vectorized over the columns:
+
+    population.filter(city="Davis", risk_taking_scale__gt=70)
+
+Rows hold the JSON form of a character, as stored on disk. Models are only
+built from a row where one is needed, see CharacterStore.
+"""
+
+import functools
+import json
+import zlib
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# (section, field) of repeated strings, dictionary-encoded
+CATEGORY_FIELDS: Tuple[Tuple[str, str], ...] = (
+    ("basic_info", "gender"),
+    ("basic_info", "nationality"),
+    ("basic_info", "ethnicity"),
+    ("basic_info", "city"),
+    ("basic_info", "home_city"),
+    ("basic_info", "native_language"),
+    ("basic_info", "Zodiac_sign"),
+    ("personality_and_psychology", "personality"),
+    ("education_and_career", "current_occupation"),
+    ("education_and_career", "highest_education_level"),
+    ("physical_attributes", "eye_color"),
+    ("physical_attributes", "hair_color"),
+    ("physical_attributes", "skin_tone"),
+    ("personal_life", "relationship_status"),
+    ("personal_life", "sexual_orientation"),
+    ("personal_life", "religion"),
+    ("personal_life", "political_views"),
+)
+# (section, field, dtype) of unbounded numbers
+NUMBER_FIELDS: Tuple[Tuple[str, str, Any], ...] = (
+    ("basic_info", "age", np.int32),
+    ("personality_and_psychology", "iq", np.int32),
+    ("personality_and_psychology", "eq", np.int32),
+    ("education_and_career", "salary_in_usd", np.int64),
+    ("physical_attributes", "height_in_cm", np.float64),
+    ("physical_attributes", "weight_in_kg", np.float64),
+    ("personal_life", "rent_in_usd", np.int64),
+)
+COMPARISONS: Dict[str, Callable[[np.ndarray, Any], np.ndarray]] = {
+    "eq": np.equal,
+    "ne": np.not_equal,
+    "gt": np.greater,
+    "ge": np.greater_equal,
+    "lt": np.less,
+    "le": np.less_equal,
+}
+INITIAL_CAPACITY = 1024
+
+
+@functools.lru_cache(maxsize=1)
+def trait_fields() -> Tuple[Tuple[str, str], ...]:
+    # imported here, trait_evolution needs the Character model
+    import trait_evolution
+
+    return trait_evolution.trait_fields()
+
+
+class Categories:
+    """
+    Distinct values of a dictionary-encoded column, code -1 is None.
+    """
+
+    def __init__(self):
+        self.values: List[str] = []
+        self.codes: Dict[str, int] = {}
+
+    def encode(self, value: Optional[str]) -> int:
+        if value is None:
+            return -1
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def decode(self, code: int) -> Optional[str]:
+        return self.values[code] if code >= 0 else None
+
+
+class Population:
+    def __init__(self):
+        self.size = 0
+        self.rows: Dict[int, int] = {}
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.traits = np.zeros((0, 0), dtype=np.uint8)
+        self.numbers: Dict[str, np.ndarray] = {}
+        self.category_codes: Dict[str, np.ndarray] = {}
+        self.categories: Dict[str, Categories] = {
+            name: Categories() for _, name in CATEGORY_FIELDS
+        }
+        self.rest: List[bytes] = []
+        self._trait_columns: Dict[str, int] = {}
+        self._resize(0)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __contains__(self, character_id: int) -> bool:
+        return character_id in self.rows
+
+    def _resize(self, capacity: int) -> None:
+        def grown(array: np.ndarray, shape) -> np.ndarray:
+            new = np.zeros(shape, dtype=array.dtype)
+            new[: self.size] = array[: self.size]
+            return new
+
+        self.ids = grown(self.ids, capacity)
+        self.traits = grown(self.traits, (capacity, self.traits.shape[1]))
+        for _, name, dtype in NUMBER_FIELDS:
+            self.numbers[name] = grown(self.numbers.get(name, np.zeros(0, dtype)), capacity)
+        for _, name in CATEGORY_FIELDS:
+            self.category_codes[name] = grown(
+                self.category_codes.get(name, np.zeros(0, np.int32)), capacity
+            )
+
+    def _ensure_traits(self) -> None:
+        # deferred to the first row, the trait fields come from the Character model
+        if not self._trait_columns:
+            fields = trait_fields()
+            self._trait_columns = {name: i for i, (_, name) in enumerate(fields)}
+            self.traits = np.zeros((len(self.ids), len(fields)), dtype=np.uint8)
+
+    def put(self, data: Dict[str, Any]) -> int:
+        """
+        Insert or replace a character from its JSON form.
+
+        Returns:
+            int: its row.
+        """
+        self._ensure_traits()
+        character_id = data["basic_info"]["id"]
+        row = self.rows.get(character_id)
+        if row is None:
+            row = self.size
+            if row >= len(self.ids):
+                self._resize(max(INITIAL_CAPACITY, 2 * len(self.ids)))
+            self.rows[character_id] = row
+            self.rest.append(b"")
+            self.size += 1
+        # shallow copies of the sections, the columns are blanked out of them
+        # but keep their place, so that a record has the fields in order
+        rest = {
+            key: dict(value) if isinstance(value, dict) else value
+            for key, value in data.items()
+        }
+        self.ids[row] = character_id
+        for column, (section, name) in enumerate(trait_fields()):
+            self.traits[row, column] = rest[section][name]
+            rest[section][name] = None
+        for section, name, _ in NUMBER_FIELDS:
+            self.numbers[name][row] = rest[section][name]
+            rest[section][name] = None
+        for section, name in CATEGORY_FIELDS:
+            self.category_codes[name][row] = self.categories[name].encode(rest[section][name])
+            rest[section][name] = None
+        self.rest[row] = zlib.compress(
+            json.dumps(rest, separators=(",", ":"), ensure_ascii=False).encode(), 1
+        )
+        return row
+
+    def record(self, character_id: int) -> Optional[Dict[str, Any]]:
+        """
+        The JSON form of a character, as it was put.
+        """
+        row = self.rows.get(character_id)
+        if row is None:
+            return None
+        data = json.loads(zlib.decompress(self.rest[row]))
+        for column, (section, name) in enumerate(trait_fields()):
+            data[section][name] = int(self.traits[row, column])
+        for section, name, _ in NUMBER_FIELDS:
+            data[section][name] = self.numbers[name][row].item()
+        for section, name in CATEGORY_FIELDS:
+            data[section][name] = self.categories[name].decode(self.category_codes[name][row])
+        return data
+
+    def records(self, character_ids: Optional[Iterable[int]] = None) -> List[Dict[str, Any]]:
+        if character_ids is None:
+            character_ids = self.ids[: self.size].tolist()
+        return [self.record(character_id) for character_id in character_ids]
+
+    def column(self, name: str) -> np.ndarray:
+        """
+        One column over all rows: scale values, numbers, or the codes of a
+        dictionary-encoded field.
+        """
+        self._ensure_traits()
+        if name == "id":
+            return self.ids[: self.size]
+        if name in self._trait_columns:
+            return self.traits[: self.size, self._trait_columns[name]]
+        if name in self.numbers:
+            return self.numbers[name][: self.size]
+        if name in self.category_codes:
+            return self.category_codes[name][: self.size]
+        raise KeyError(f"No column {name}")
+
+    def decoded(self, name: str) -> np.ndarray:
+        """
+        A dictionary-encoded column as its values.
+        """
+        values = np.array(self.categories[name].values + [None], dtype=object)
+        # code -1 picks the trailing None
+        return values[self.column(name)]
+
+    def mask(self, **conditions: Any) -> np.ndarray:
+        """
+        Rows matching all conditions, given as field=value or field__op=value
+        with op one of eq, ne, gt, ge, lt, le, in. Dictionary-encoded fields
+        support eq, ne and in.
+        """
+        mask = np.ones(self.size, dtype=bool)
+        for key, value in conditions.items():
+            name, _, op = key.partition("__")
+            op = op or "eq"
+            column = self.column(name)
+            if name in self.categories:
+                if op not in ("eq", "ne", "in"):
+                    raise ValueError(f"{name} is categorical, {op} is not supported")
+                codes = self.categories[name].codes
+                if op == "in":
+                    value = [codes.get(v, -2) for v in value]
+                else:
+                    value = codes.get(value, -2)
+            if op == "in":
+                mask &= np.isin(column, list(value))
+            elif op in COMPARISONS:
+                mask &= COMPARISONS[op](column, value)
+            else:
+                raise ValueError(f"Unknown comparison {op} in {key}")
+        return mask
+
+    def filter(self, **conditions: Any) -> List[int]:
+        """
+        Ids of the characters matching conditions, see mask, in row order.
+        """
+        return self.ids[: self.size][self.mask(**conditions)].tolist()
+
+    def count(self, **conditions: Any) -> int:
+        return int(self.mask(**conditions).sum())
+
+    def trait_matrix(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Ids and scales of every row, as copies in a signed type that leaves
+        room for arithmetic.
+        """
+        self._ensure_traits()
+        return self.ids[: self.size].copy(), self.traits[: self.size].astype(np.int16)
+
+    def set_traits(self, character_ids: Iterable[int], traits: np.ndarray) -> None:
+        """
+        Scales of the given characters, values in 0-100.
+        """
+        rows = [self.rows[character_id] for character_id in character_ids]
+        self.traits[rows] = traits
+
+    def nbytes(self) -> int:
+        """
+        Memory of the columns and the compressed rest, not counting the
+        Python objects of the id index.
+        """
+        arrays = [self.ids, self.traits, *self.numbers.values(), *self.category_codes.values()]
+        values = sum(len(v) for c in self.categories.values() for v in c.values)
+        return sum(a.nbytes for a in arrays) + sum(len(r) for r in self.rest) + values
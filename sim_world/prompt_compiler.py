@@ -0,0 +1,224 @@
+import functools
+import json
+import os
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple, Type
+from pydantic import BaseModel
+import CoTTemplate
+from structured_log import get_logger
+
+log = get_logger("prompt_compiler")
+
+# a tokenizer.json path or a Hugging Face repo id
+PROMPT_TOKENIZER = os.getenv("PROMPT_TOKENIZER", "Xenova/gpt-4o")
+
+# per call type, the number of prompt tokens a single completion may use
+PROMPT_TOKEN_BUDGETS: Dict[str, int] = {
+    "sim_one_day": int(os.getenv("PROMPT_BUDGET_SIM_ONE_DAY", "48000")),
+    "process_event": int(os.getenv("PROMPT_BUDGET_PROCESS_EVENT", "12000")),
+    "fix_character": int(os.getenv("PROMPT_BUDGET_FIX_CHARACTER", "12000")),
+    "new_character": int(os.getenv("PROMPT_BUDGET_NEW_CHARACTER", "8000")),
+}
+
+# tokens the chat format adds around every message and before the reply
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+# which part of a Character each call type gets to see, None means the whole section
+CHARACTER_VIEWS: Dict[str, Dict[str, Optional[Tuple[str, ...]]]] = {
+    "sim_one_day": {
+        "basic_info": ("id", "name", "gender", "age", "city", "native_language"),
+        "personality_and_psychology": (
+            "personality",
+            "introvert_extrovert_scale",
+            "optimism_pessimism_scale",
+            "risk_taking_scale",
+            "openness_to_experience",
+            "agreeableness",
+        ),
+        "education_and_career": ("current_occupation",),
+        "personal_life": ("relationship_status", "hobbies"),
+        "preferences": ("favorite_food", "favorite_sport", "pet_preference"),
+    },
+    "process_event": {
+        "basic_info": None,
+        "personality_and_psychology": None,
+        "education_and_career": None,
+        "physical_attributes": None,
+        "personal_life": None,
+        "preferences": None,
+        "skills_and_abilities": None,
+        "experiences": None,
+    },
+}
+
+
+@functools.lru_cache(maxsize=1)
+def get_tokenizer():
+    try:
+        from tokenizers import Tokenizer
+
+        if os.path.exists(PROMPT_TOKENIZER):
+            return Tokenizer.from_file(PROMPT_TOKENIZER)
+        return Tokenizer.from_pretrained(PROMPT_TOKENIZER)
+    except Exception as e:
+        log.warning(f"Tokenizer {PROMPT_TOKENIZER} unavailable, estimating token counts: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        # roughly 4 bytes per token for English and JSON
+        return (len(text.encode("utf-8")) + 3) // 4
+    return len(tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+def _strip_titles(node: Any) -> Any:
+    if isinstance(node, dict):
+        return {
+            key: (
+                {name: _strip_titles(prop) for name, prop in value.items()}
+                if key in ("properties", "$defs")
+                else _strip_titles(value)
+            )
+            for key, value in node.items()
+            if not (key == "title" and isinstance(value, str))
+        }
+    if isinstance(node, list):
+        return [_strip_titles(item) for item in node]
+    return node
+
+
+@functools.lru_cache(maxsize=None)
+def compact_schema(model: Type[BaseModel], exclude: Tuple[str, ...] = ()) -> str:
+    """
+    JSON schema of model without titles or whitespace, leaving out the top-level
+    fields in exclude.
+    """
+    schema = _strip_titles(model.model_json_schema())
+    for field in exclude:
+        schema["properties"].pop(field, None)
+        if field in schema.get("required", []):
+            schema["required"].remove(field)
+    return json.dumps(schema, separators=(",", ":"))
+
+
+def character_view(character: BaseModel, call_type: str) -> Dict[str, Any]:
+    """
+    The fields of character that call_type needs, see CHARACTER_VIEWS.
+    """
+    data = character.model_dump(mode="json")
+    view = {}
+    for section, fields in CHARACTER_VIEWS[call_type].items():
+        if fields is None:
+            view[section] = data[section]
+        else:
+            view[section] = {field: data[section][field] for field in fields}
+    return view
+
+
+def compact_json(value: Any) -> str:
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+
+class Section(NamedTuple):
+    name: str
+    text: str
+    # static sections are inserted verbatim, others are format strings
+    static: bool
+
+
+def static(name: str, text: str) -> Section:
+    return Section(name, text, True)
+
+
+def dynamic(name: str, text: str) -> Section:
+    return Section(name, text, False)
+
+
+class CompiledPrompt(NamedTuple):
+    call_type: str
+    messages: List[Dict[str, str]]
+    section_tokens: Dict[str, int]
+    total_tokens: int
+    # the leading messages every prompt of the template starts with, up to
+    # the first dynamic section; local decoding caches their KV, see local_llm
+    prefix: List[Dict[str, str]]
+
+    @property
+    def budget(self) -> Optional[int]:
+        return PROMPT_TOKEN_BUDGETS.get(self.call_type)
+
+    @property
+    def over_budget(self) -> bool:
+        return self.budget is not None and self.total_tokens > self.budget
+
+
+class PromptTemplate:
+    """
+    A system prompt made of named sections. Static sections (schemas, fixed
+    instructions) are tokenized once; only the dynamic ones are counted per call.
+    """
+
+    def __init__(self, call_type: str, sections: Iterable[Section], cot: bool = False):
+        self.call_type = call_type
+        self.sections = list(sections)
+        self.cot = cot
+        self._static_tokens: Dict[int, int] = {}
+        leading = []
+        for section in self.sections:
+            if not section.static:
+                break
+            leading.append(section.text)
+        self.prefix: List[Dict[str, str]] = list(CoTTemplate.template_in_message) if cot else []
+        if leading:
+            self.prefix.append({"role": "system", "content": "".join(leading)})
+
+    def _section_tokens(self, index: int, section: Section, text: str) -> int:
+        if not section.static:
+            return count_tokens(text)
+        if index not in self._static_tokens:
+            self._static_tokens[index] = count_tokens(text)
+        return self._static_tokens[index]
+
+    def render(self, **values) -> CompiledPrompt:
+        parts = []
+        section_tokens: Dict[str, int] = defaultdict(int)
+        for index, section in enumerate(self.sections):
+            text = section.text if section.static else section.text.format(**values)
+            parts.append(text)
+            section_tokens[section.name] += self._section_tokens(index, section, text)
+
+        messages = [{"role": "system", "content": "".join(parts)}]
+        if self.cot:
+            messages = CoTTemplate.template_in_message + messages
+            section_tokens["cot_protocol"] += _cot_tokens()
+        total = sum(section_tokens.values()) + TOKENS_PER_REPLY
+        total += TOKENS_PER_MESSAGE * len(messages)
+        prompt = CompiledPrompt(
+            self.call_type, messages, dict(section_tokens), total, self.prefix
+        )
+        record(prompt)
+        return prompt
+
+
+@functools.lru_cache(maxsize=1)
+def _cot_tokens() -> int:
+    return count_tokens(CoTTemplate.template)
+
+
+# per call type: number of prompts and tokens used by each section
+prompt_stats: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+
+def record(prompt: CompiledPrompt) -> None:
+    stats = prompt_stats[prompt.call_type]
+    stats["calls"] += 1
+    stats["total_tokens"] += prompt.total_tokens
+    for name, tokens in prompt.section_tokens.items():
+        stats[f"section.{name}"] += tokens
+
+
+def get_prompt_stats() -> Dict[str, Dict[str, int]]:
+    return {call_type: dict(stats) for call_type, stats in prompt_stats.items()}
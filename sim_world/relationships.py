@@ -0,0 +1,189 @@
+"""
+Who knows whom, as a sparse weighted graph built from processed events.
+
+Every event adds weight to the edges between the characters involved. Weights
+fade by RELATIONSHIP_DECAY per day without contact, applied lazily when an
+edge is read or updated, so an update costs O(pairs in the event) and a
+neighbourhood query O(degree).
+"""
+
+import functools
+import json
+import os
+import random
+from datetime import date as date_type
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+RELATIONSHIPS_PATH = os.getenv("RELATIONSHIPS_PATH", "relationships.json")
+RELATIONSHIP_DECAY = float(os.getenv("RELATIONSHIP_DECAY", "0.99"))
+
+
+@functools.lru_cache(maxsize=4096)
+def _day(date: str) -> int:
+    return date_type.fromisoformat(date).toordinal()
+
+
+class RelationshipGraph:
+    def __init__(self):
+        # id -> neighbour id -> (weight, ordinal day of the weight)
+        self.adjacency: Dict[int, Dict[int, Tuple[float, int]]] = {}
+
+    def __len__(self) -> int:
+        return len(self.adjacency)
+
+    def edge_count(self) -> int:
+        return sum(len(neighbours) for neighbours in self.adjacency.values()) // 2
+
+    @staticmethod
+    def _decayed(weight: float, since: int, today: int) -> float:
+        return weight * RELATIONSHIP_DECAY ** max(0, today - since)
+
+    def add_event(self, character_ids: Iterable[int], date: str, weight: float = 1.0) -> None:
+        ids = sorted(set(character_ids))
+        today = _day(date)
+        for i, a in enumerate(ids):
+            for b in ids[i + 1 :]:
+                old, since = self.adjacency.get(a, {}).get(b, (0.0, today))
+                edge = (self._decayed(old, since, today) + weight, today)
+                self.adjacency.setdefault(a, {})[b] = edge
+                self.adjacency.setdefault(b, {})[a] = edge
+
+    def neighbours(self, character_id: int, date: Optional[str] = None) -> Dict[int, float]:
+        """
+        Neighbour id -> weight, decayed to date if given.
+        """
+        edges = self.adjacency.get(character_id, {})
+        if date is None:
+            return {other: weight for other, (weight, _) in edges.items()}
+        today = _day(date)
+        return {
+            other: self._decayed(weight, since, today)
+            for other, (weight, since) in edges.items()
+        }
+
+    def sample_partners(
+        self,
+        character_id: int,
+        k: int,
+        rng: random.Random,
+        date: Optional[str] = None,
+        exclude: Iterable[int] = (),
+    ) -> List[int]:
+        """
+        Up to k distinct neighbours, drawn with probability proportional to
+        their weight, so close friends show up often but not always.
+        """
+        excluded = set(exclude)
+        candidates = [
+            (other, weight)
+            for other, weight in self.neighbours(character_id, date).items()
+            if other not in excluded and weight > 0
+        ]
+        # weighted sampling without replacement: sort by u ** (1 / weight)
+        keyed = sorted(
+            candidates, key=lambda item: rng.random() ** (1 / item[1]), reverse=True
+        )
+        return [other for other, _ in keyed[:k]]
+
+    def to_csr(self, date: Optional[str] = None):
+        """
+        Returns:
+            (ids, indptr, indices, weights): row i of the adjacency matrix
+            belongs to ids[i], its neighbours are
+            ids[indices[indptr[i]:indptr[i + 1]]].
+        """
+        ids = sorted(self.adjacency)
+        position = {character_id: i for i, character_id in enumerate(ids)}
+        indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+        indices, weights = [], []
+        for i, character_id in enumerate(ids):
+            neighbours = sorted(self.neighbours(character_id, date).items())
+            indices.extend(position[other] for other, _ in neighbours)
+            weights.extend(weight for _, weight in neighbours)
+            indptr[i + 1] = len(indices)
+        return (
+            np.array(ids, dtype=np.int64),
+            indptr,
+            np.array(indices, dtype=np.int64),
+            np.array(weights, dtype=np.float64),
+        )
+
+    def to_networkx(self, date: Optional[str] = None):
+        import networkx as nx
+
+        graph = nx.Graph()
+        graph.add_nodes_from(self.adjacency)
+        for a in self.adjacency:
+            for b, weight in self.neighbours(a, date).items():
+                if a < b:
+                    graph.add_edge(a, b, weight=weight)
+        return graph
+
+    def save(self, path: str = RELATIONSHIPS_PATH) -> None:
+        edges = [
+            [a, b, weight, since]
+            for a, neighbours in self.adjacency.items()
+            for b, (weight, since) in neighbours.items()
+            if a < b
+        ]
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"edges": edges}, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str = RELATIONSHIPS_PATH) -> Optional["RelationshipGraph"]:
+        if not os.path.exists(path):
+            return None
+        graph = cls()
+        with open(path, "r") as f:
+            for a, b, weight, since in json.load(f)["edges"]:
+                graph.adjacency.setdefault(a, {})[b] = (weight, since)
+                graph.adjacency.setdefault(b, {})[a] = (weight, since)
+        return graph
+
+    @classmethod
+    def from_characters(cls, characters) -> "RelationshipGraph":
+        """
+        A first graph from the event history kept in every character. Events
+        shared by several characters are in each of their histories, so they
+        are counted once.
+        """
+        graph = cls()
+        seen = set()
+        events = []
+        for character in characters:
+            for field in ("events_latest_10", "highlight_3_max", "lowlight_3_max"):
+                for event in getattr(character, field):
+                    key = (event.date, event.start_time, tuple(sorted(event.id_of_character_involved)))
+                    if key not in seen:
+                        seen.add(key)
+                        events.append(event)
+        for event in sorted(events, key=lambda e: (e.date, e.start_time)):
+            graph.add_event(event.id_of_character_involved, event.date)
+        return graph
+
+
+_graph: Optional[RelationshipGraph] = None
+
+
+def reset_graph() -> None:
+    """
+    Forget the graph in memory, the next get_graph reads the saved one again.
+    """
+    global _graph
+    _graph = None
+
+
+def get_graph(characters=None) -> RelationshipGraph:
+    """
+    The graph saved on disk, or one built from the characters' histories.
+    """
+    global _graph
+    if _graph is None:
+        _graph = RelationshipGraph.load()
+        if _graph is None:
+            _graph = RelationshipGraph.from_characters(characters or [])
+    return _graph
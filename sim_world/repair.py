@@ -0,0 +1,366 @@
+"""
+Local repair of data that fails pydantic validation, before asking the LLM.
+
+Driven by the validation errors and the model's field types: out-of-range
+scales are clamped, numbers in strings are parsed, dates and times are
+normalized, enums are matched case-insensitively, known legacy field names are
+renamed and missing optional, list, string or numeric fields get a default.
+Identity fields (IDENTITY_FIELDS) never get a default, a made-up id or name
+would be stored as someone else. Anything else is left for fix_with_chat.
+"""
+
+import copy
+import enum
+import re
+import typing
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Type
+
+import annotated_types
+from pydantic import BaseModel, ValidationError
+from structured_log import get_logger
+
+log = get_logger("repair")
+
+# old field name -> current name, looked up in the object missing the field
+LEGACY_RENAMES: Dict[str, str] = {
+    "zodiac_sign": "Zodiac_sign",
+    "zodiac": "Zodiac_sign",
+    "salary": "salary_in_usd",
+    "rent": "rent_in_usd",
+    "height": "height_in_cm",
+    "weight": "weight_in_kg",
+    "occupation": "current_occupation",
+    "education_level": "highest_education_level",
+    "events": "events_latest_10",
+    "latest_events": "events_latest_10",
+    "highlights": "highlight_3_max",
+    "lowlights": "lowlight_3_max",
+    "characters_involved": "id_of_character_involved",
+    "character_ids": "id_of_character_involved",
+}
+
+# never defaulted or blanked, see _fix
+IDENTITY_FIELDS = {"id", "name", "id_of_character_involved"}
+
+DATE_FORMATS = (
+    "%Y-%m-%d",
+    "%Y/%m/%d",
+    "%Y.%m.%d",
+    "%m/%d/%Y",
+    "%d.%m.%Y",
+    "%B %d, %Y",
+    "%b %d, %Y",
+    "%d %B %Y",
+    "%d %b %Y",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%dT%H:%M",
+)
+TIME_FORMATS = ("%H:%M", "%H:%M:%S", "%I:%M %p", "%I:%M%p", "%I %p", "%I%p", "%H.%M")
+DATE_PATTERN = r"^\d{4}-\d{2}-\d{2}$"
+TIME_PATTERN = r"^\d{2}:\d{2}$"
+MAX_PASSES = 5
+
+# repairs by kind in documents that were repaired, plus "local" / "llm" for
+# how each failed document was fixed
+repair_stats: Counter = Counter()
+# repairs by kind that were tried and did not work, e.g. a date in no known
+# format, in documents left for the LLM
+repair_failures: Counter = Counter()
+
+
+class RepairResult(NamedTuple):
+    # None if errors remain
+    value: Optional[BaseModel]
+    # the data with every repair that could be made
+    data: Any
+    changes: List[str]
+    errors: List[Dict[str, Any]]
+
+
+def _unwrap(annotation: Any) -> Any:
+    """
+    Optional[X] -> X, other annotations unchanged.
+    """
+    args = [a for a in typing.get_args(annotation) if a is not type(None)]
+    if typing.get_origin(annotation) is typing.Union and len(args) == 1:
+        return args[0]
+    return annotation
+
+
+def _is_optional(annotation: Any) -> bool:
+    return typing.get_origin(annotation) is typing.Union and type(None) in typing.get_args(annotation)
+
+
+def _field_at(model: Type[BaseModel], loc: Tuple[Any, ...]):
+    """
+    (annotation, FieldInfo) of the field at loc, None when loc leaves the models.
+    """
+    annotation, field = model, None
+    for token in loc:
+        annotation = _unwrap(annotation)
+        if isinstance(token, int):
+            args = typing.get_args(annotation)
+            if typing.get_origin(annotation) not in (list, List) or not args:
+                return None
+            annotation, field = args[0], None
+        elif isinstance(annotation, type) and issubclass(annotation, BaseModel):
+            field = annotation.model_fields.get(token)
+            if field is None:
+                return None
+            annotation = field.annotation
+        else:
+            return None
+    return annotation, field
+
+
+def _bounds(field) -> Tuple[Optional[float], Optional[float]]:
+    low = high = None
+    for constraint in getattr(field, "metadata", []):
+        if isinstance(constraint, annotated_types.Ge):
+            low = constraint.ge
+        elif isinstance(constraint, annotated_types.Le):
+            high = constraint.le
+    return low, high
+
+
+def _pattern(field) -> Optional[str]:
+    for constraint in getattr(field, "metadata", []):
+        pattern = getattr(constraint, "pattern", None)
+        if pattern:
+            return pattern
+    return None
+
+
+def _default(annotation: Any, field) -> Any:
+    """
+    A neutral value for a missing field, or raises LookupError if there is none
+    that would not make something up, e.g. a whole missing section.
+    """
+    if _is_optional(annotation):
+        return None
+    annotation = _unwrap(annotation)
+    origin = typing.get_origin(annotation)
+    if origin in (list, List) or annotation is list:
+        return []
+    if annotation is str and _pattern(field) is None:
+        return ""
+    if annotation in (int, float):
+        low, high = _bounds(field)
+        if low is not None and high is not None:
+            # the middle of a scale says the least
+            return annotation((low + high) / 2)
+        return annotation(0)
+    raise LookupError(annotation)
+
+
+def _parse_number(value: Any, annotation: Any) -> Any:
+    if isinstance(value, str):
+        match = re.search(r"-?\d[\d,]*(\.\d+)?", value)
+        if match is None:
+            raise ValueError(value)
+        value = float(match.group(0).replace(",", ""))
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(value)
+    return int(round(value)) if annotation is int else float(value)
+
+
+def _normalize_date(value: Any) -> str:
+    text = str(value).strip()
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    match = re.match(r"^(\d{4})-(\d{1,2})-(\d{1,2})", text)
+    if match:
+        return datetime(*map(int, match.groups())).strftime("%Y-%m-%d")
+    raise ValueError(value)
+
+
+def _normalize_time(value: Any) -> str:
+    text = str(value).strip().upper()
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.strptime(text, time_format).strftime("%H:%M")
+        except ValueError:
+            continue
+    raise ValueError(value)
+
+
+def _match_enum(value: Any, annotation: Any) -> Any:
+    wanted = re.sub(r"[\s_-]", "", str(value)).lower()
+    for member in annotation:
+        if re.sub(r"[\s_-]", "", str(member.value)).lower() == wanted:
+            return member.value
+    raise ValueError(value)
+
+
+def _fix(
+    model: Type[BaseModel],
+    data: Any,
+    error: Dict[str, Any],
+    fixes: Counter,
+    failures: Counter,
+) -> Optional[str]:
+    """
+    Repair data in place at the location of error, counting the kind of
+    repair in fixes, or in failures if it was attempted and did not work.
+
+    Returns:
+        A description of the change, None if it could not be repaired.
+    """
+    loc = tuple(error["loc"])
+    if not loc:
+        return None
+    parent = data
+    for token in loc[:-1]:
+        try:
+            parent = parent[token]
+        except (KeyError, IndexError, TypeError):
+            return None
+    key = loc[-1]
+    if isinstance(parent, list) and not (isinstance(key, int) and 0 <= key < len(parent)):
+        # an element that is not there, e.g. of an empty experiences list
+        return None
+    path = "/".join(str(token) for token in loc)
+    resolved = _field_at(model, loc)
+    if resolved is None:
+        return None
+    annotation, field = resolved
+    kind = error["type"]
+
+    attempt = None
+    try:
+        if kind == "missing":
+            if not isinstance(parent, dict):
+                return None
+            for old, new in LEGACY_RENAMES.items():
+                if new == key and old in parent:
+                    parent[key] = parent.pop(old)
+                    fixes["rename"] += 1
+                    return f"{path}: renamed from {old}"
+            loose = re.sub(r"[\s_-]", "", key).lower()
+            for other in list(parent):
+                if isinstance(other, str) and re.sub(r"[\s_-]", "", other).lower() == loose:
+                    parent[key] = parent.pop(other)
+                    fixes["rename"] += 1
+                    return f"{path}: renamed from {other}"
+            if key in IDENTITY_FIELDS:
+                return None
+            attempt = "default"
+            parent[key] = _default(annotation, field)
+            fixes[attempt] += 1
+            return f"{path}: missing, set to {parent[key]!r}"
+
+        value = parent[key]
+        if value is None and key in IDENTITY_FIELDS:
+            return None
+        base = _unwrap(annotation)
+        if kind in ("greater_than_equal", "greater_than", "less_than_equal", "less_than"):
+            attempt = "clamp"
+            low, high = _bounds(field)
+            fixed = value
+            if low is not None:
+                fixed = max(low, fixed)
+            if high is not None:
+                fixed = min(high, fixed)
+            if fixed == value:
+                raise ValueError(value)
+        elif kind in ("int_parsing", "int_from_float", "int_type", "float_parsing", "float_type"):
+            attempt = "coerce"
+            fixed = _parse_number(value, base)
+        elif kind == "string_type" and isinstance(value, (int, float)) and not isinstance(value, bool):
+            attempt = "coerce"
+            fixed = str(value)
+        elif kind == "string_type" and value is None and _pattern(field) is None:
+            attempt = "default"
+            fixed = ""
+        elif kind == "list_type":
+            attempt = "coerce"
+            fixed = [] if value is None else [value]
+        elif kind == "string_pattern_mismatch":
+            pattern = _pattern(field)
+            if pattern == DATE_PATTERN:
+                attempt = "date"
+                fixed = _normalize_date(value)
+            elif pattern == TIME_PATTERN:
+                attempt = "date"
+                fixed = _normalize_time(value)
+            else:
+                return None
+        elif kind == "enum" and isinstance(base, type) and issubclass(base, enum.Enum):
+            attempt = "enum"
+            fixed = _match_enum(value, base)
+        else:
+            return None
+    except (ValueError, TypeError, LookupError, OverflowError):
+        if attempt is not None:
+            failures[attempt] += 1
+        return None
+    parent[key] = fixed
+    fixes[attempt] += 1
+    return f"{path}: {value!r} -> {fixed!r}"
+
+
+def repair(model: Type[BaseModel], data: Any, max_passes: int = MAX_PASSES) -> RepairResult:
+    """
+    Validate data as model, repairing what can be repaired locally. A rename
+    can reveal new errors inside the renamed value, hence several passes.
+    data is not modified.
+    """
+    data = copy.deepcopy(data)
+    changes: List[str] = []
+    errors: List[Dict[str, Any]] = []
+    fixes: Counter = Counter()
+    failures: Counter = Counter()
+    for _ in range(max_passes):
+        try:
+            value = model.model_validate(data)
+        except ValidationError as e:
+            errors = e.errors()
+        else:
+            repair_stats.update(fixes)
+            return RepairResult(value, data, changes, [])
+        failures = Counter()
+        fixed = [
+            change
+            for change in (_fix(model, data, error, fixes, failures) for error in errors)
+            if change
+        ]
+        if not fixed:
+            break
+        changes.extend(fixed)
+    # the document is left for the LLM, none of its fixes count as a repair
+    repair_failures.update(failures)
+    return RepairResult(None, data, changes, errors)
+
+
+def validate_or_repair(model: Type[BaseModel], data: Any, context: str = "") -> BaseModel:
+    """
+    model.model_validate(data), with a local repair when it fails.
+
+    Raises:
+        ValidationError: of the original data, if the repair was not enough.
+    """
+    try:
+        return model.model_validate(data)
+    except ValidationError as original:
+        result = repair(model, data)
+        if result.value is None:
+            raise original
+        repair_stats["local"] += 1
+        log.info(f"Repaired {model.__name__} {context} locally: {'; '.join(result.changes)}")
+        return result.value
+
+
+def get_repair_stats() -> Dict[str, int]:
+    """
+    Repairs by kind, and failed attempts as "failed.<kind>".
+    """
+    return {
+        **repair_stats,
+        **{f"failed.{kind}": count for kind, count in repair_failures.items()},
+    }
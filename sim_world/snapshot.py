@@ -0,0 +1,133 @@
+"""
+Warm start from a pickle of the validated world and population table.
+
+A cold start reads, parses and validates every character. The snapshot holds
+the population.Population built from them, so a restart only unpickles its
+columns. It is used only if both of these still match:
+- its version stamp, which changes with the models' schemas and the
+  pydantic and Python versions, so a code change never unpickles stale
+  classes;
+- the store's fingerprint, which changes with any write to the characters
+  or the world, so a snapshot never hides newer data.
+
+A snapshot is written after a cold start and by save_current at shutdown.
+The one on disk is stale, i.e. older than the store, whenever shutdown
+skipped save_current: while a day is in flight, after a failed day whose
+rollback failed as well (JobManager.consistent), while characters wait for
+an LLM repair, or after a crash. Edits by hand make it stale too. In all of
+these the fingerprint no longer matches, warm_start falls back to a cold
+load from the store and writes a new snapshot.
+
+The file is two pickles in a row, a small header and the payload, so a stale
+snapshot is rejected without unpickling the payload. Only load snapshots
+written by this process' own code, unpickling runs arbitrary code.
+"""
+
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import pickle
+import sys
+import time
+from typing import Optional, Tuple
+
+import pydantic
+
+from Character import Character, CharacterStore
+from population import Population
+from storage import get_store
+from structured_log import get_logger
+from World import World
+
+log = get_logger("snapshot")
+
+SNAPSHOT_PATH = os.getenv("SIM_SNAPSHOT_PATH", "snapshot.pickle")
+# bump when the layout of the file changes
+SNAPSHOT_FORMAT = 2
+
+
+@functools.lru_cache(maxsize=1)
+def version_stamp() -> str:
+    data = [
+        SNAPSHOT_FORMAT,
+        World.model_json_schema(),
+        Character.model_json_schema(),
+        pydantic.VERSION,
+        list(sys.version_info[:2]),
+    ]
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def save(world: World, population: Population, path: str = SNAPSHOT_PATH) -> None:
+    header = {
+        "version": version_stamp(),
+        "fingerprint": get_store().fingerprint(),
+        "created": time.time(),
+        "characters": len(population),
+    }
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump((world, population), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def load(path: str = SNAPSHOT_PATH) -> Optional[Tuple[World, Population]]:
+    """
+    None if there is no usable snapshot.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as f:
+            header = pickle.load(f)
+            if header.get("version") != version_stamp():
+                log.info("Snapshot was written by another version, ignoring it")
+                return None
+            fingerprint = get_store().fingerprint()
+            if fingerprint is None or header.get("fingerprint") != fingerprint:
+                log.info("Store changed since the snapshot, ignoring it")
+                return None
+            return pickle.load(f)
+    except Exception as e:
+        log.warning(f"Unreadable snapshot {path}: {e}")
+        return None
+
+
+async def warm_start(path: str = SNAPSHOT_PATH) -> World:
+    """
+    The world, with every character loaded, from the snapshot if it is
+    current or else from the store, then snapshotted for the next start.
+    """
+    start = time.perf_counter()
+    loaded = await asyncio.to_thread(load, path)
+    if loaded is not None:
+        world, population = loaded
+        CharacterStore.restore(population)
+        log.info(
+            f"Warm start from {path}: {len(population)} characters "
+            f"in {time.perf_counter() - start:.2f}s"
+        )
+        return world
+    await Character.ensure_loaded()
+    world = await asyncio.to_thread(World.load_from_local)
+    await save_current(world, path)
+    log.info(f"Cold start in {time.perf_counter() - start:.2f}s")
+    return world
+
+
+async def save_current(world: World, path: str = SNAPSHOT_PATH) -> bool:
+    """
+    Snapshot world and the population, unless characters are still
+    waiting for a repair: they are not loaded, and a warm start would not
+    queue them again.
+
+    Returns:
+        bool: whether a snapshot was written.
+    """
+    if CharacterStore.unrepaired or not CharacterStore._loaded:
+        return False
+    await asyncio.to_thread(save, world, CharacterStore.population, path)
+    return True
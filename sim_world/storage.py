@@ -0,0 +1,411 @@
+import abc
+import argparse
+import asyncio
+import contextvars
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import metrics
+from structured_log import get_logger
+
+log = get_logger("storage")
+
+SIM_STORAGE = os.getenv("SIM_STORAGE", "json")
+SIM_SQLITE_PATH = os.getenv("SIM_SQLITE_PATH", "sim_world.db")
+CHARACTERS_DIR = "characters"
+WORLD_PATH = "world.json"
+LOAD_THREADS = int(os.getenv("SIM_LOAD_THREADS", "16"))
+
+
+class Batch:
+    """
+    Saves buffered by one `async with store.batch():` block.
+    """
+
+    def __init__(self):
+        self.characters: Dict[int, Tuple[str, Dict[str, Any]]] = {}
+        self.world: Optional[Dict[str, Any]] = None
+        # writers of files kept next to the store, e.g. memories, by path
+        self.files: Dict[str, Callable[[], None]] = {}
+
+
+# the batch of the running task, tasks and threads started inside the block
+# copy the context and share it, every other save is written straight away
+_current_batch: contextvars.ContextVar[Optional[Batch]] = contextvars.ContextVar(
+    "store_batch", default=None
+)
+
+
+def leave_batch() -> None:
+    """
+    Detaches the calling task from the batch it was started in, for background
+    work that outlives it, e.g. the repair worker. A task runs in a copy of the
+    context, so this does not end the batch for anyone else.
+    """
+    _current_batch.set(None)
+
+
+class Store(abc.ABC):
+    """
+    Persistence of characters and the world.
+
+    Inside `async with store.batch():` saves made by the block, and by tasks it
+    starts, are buffered and written together in a thread when it exits, e.g.
+    once per simulated day. Its reads see its buffered saves, saves from
+    elsewhere, like a request introducing a character, are written at once.
+    If the block raises, its buffered saves are dropped so that characters and
+    world stay consistent on disk.
+    """
+
+    @asynccontextmanager
+    async def batch(self):
+        if _current_batch.get() is not None:
+            # nested blocks are part of the outer one
+            yield self
+            return
+        batch = Batch()
+        token = _current_batch.set(batch)
+        try:
+            yield self
+        except BaseException:
+            log.error(
+                f"Dropping {len(batch.characters)} buffered character saves "
+                f"and {len(batch.files)} file writes after a failure"
+            )
+            raise
+        finally:
+            _current_batch.reset(token)
+        await asyncio.to_thread(self.flush, batch)
+
+    def flush(self, batch: Batch) -> None:
+        if batch.characters or batch.world is not None:
+            with metrics.stage("store_flush", characters=len(batch.characters)):
+                self._write(batch.characters, batch.world)
+        for write in batch.files.values():
+            write()
+
+    def save_character(self, character_id: int, city: str, data: Dict[str, Any]) -> None:
+        self.save_characters({character_id: (city, data)})
+
+    def save_characters(self, characters: Dict[int, Tuple[str, Dict[str, Any]]]) -> None:
+        """
+        Save many characters, id -> (city, data), in one write.
+        """
+        batch = _current_batch.get()
+        if batch is not None:
+            batch.characters.update(characters)
+        elif characters:
+            self._write(characters, None)
+
+    def save_world(self, data: Dict[str, Any]) -> None:
+        batch = _current_batch.get()
+        if batch is not None:
+            batch.world = data
+        else:
+            self._write({}, data)
+
+    def save_file(self, path: str, write: Callable[[], None]) -> None:
+        """
+        Call write now, or once the batch is written. Only the last write of a
+        path in a batch is called.
+        """
+        batch = _current_batch.get()
+        if batch is not None:
+            batch.files[path] = write
+        else:
+            write()
+
+    def load_character(self, character_id: int) -> Optional[Dict[str, Any]]:
+        batch = _current_batch.get()
+        if batch is not None and character_id in batch.characters:
+            return batch.characters[character_id][1]
+        return self._read_character(character_id)
+
+    def load_world(self) -> Optional[Dict[str, Any]]:
+        batch = _current_batch.get()
+        if batch is not None and batch.world is not None:
+            return batch.world
+        return self._read_world()
+
+    def load_all_characters(self) -> Dict[int, Dict[str, Any]]:
+        return {
+            character_id: json.loads(raw)
+            for character_id, raw in self.load_all_raw_characters().items()
+        }
+
+    def load_all_raw_characters(self) -> Dict[int, str]:
+        """
+        Every character as unparsed JSON text, so that parsing and validation can
+        happen in one step with Character.model_validate_json.
+        """
+        characters = self._read_all_raw_characters()
+        batch = _current_batch.get()
+        for character_id, (_, data) in (batch.characters if batch else {}).items():
+            characters[character_id] = json.dumps(data)
+        return characters
+
+    def character_ids_in_city(self, city: str) -> List[int]:
+        return [
+            character_id
+            for character_id, data in self.load_all_characters().items()
+            if data.get("basic_info", {}).get("city") == city
+        ]
+
+    @abc.abstractmethod
+    def _write(
+        self,
+        characters: Dict[int, Tuple[str, Dict[str, Any]]],
+        world: Optional[Dict[str, Any]],
+    ) -> None:
+        """
+        Write characters, id -> (city, data), and the world if not None.
+        """
+
+    @abc.abstractmethod
+    def _read_character(self, character_id: int) -> Optional[Dict[str, Any]]:
+        """
+        None if there is no such character.
+        """
+
+    @abc.abstractmethod
+    def _read_all_raw_characters(self) -> Dict[int, str]:
+        """
+        id -> raw JSON of every character, not parsed.
+        """
+
+    @abc.abstractmethod
+    def _read_world(self) -> Optional[Dict[str, Any]]:
+        """
+        None if no world was saved yet.
+        """
+
+    def fingerprint(self) -> Optional[str]:
+        """
+        Changes whenever a character or the world is written, without reading
+        them. None if the store cannot tell, then nothing may be cached across
+        restarts.
+        """
+        return None
+
+
+class JsonStore(Store):
+    """
+    The original layout, characters/{id}.json and world.json. Every file is
+    replaced atomically, but a batch is not atomic as a whole.
+    """
+
+    def __init__(self, characters_dir: str = CHARACTERS_DIR, world_path: str = WORLD_PATH):
+        super().__init__()
+        self.characters_dir = characters_dir
+        self.world_path = world_path
+
+    @staticmethod
+    def _replace(file_path: str, data: Dict[str, Any]) -> None:
+        tmp_path = f"{file_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, file_path)
+
+    def _write(self, characters, world) -> None:
+        if characters:
+            os.makedirs(self.characters_dir, exist_ok=True)
+        for character_id, (_, data) in characters.items():
+            self._replace(os.path.join(self.characters_dir, f"{character_id}.json"), data)
+        if world is not None:
+            self._replace(self.world_path, world)
+
+    def _read_character(self, character_id: int) -> Optional[Dict[str, Any]]:
+        file_path = os.path.join(self.characters_dir, f"{character_id}.json")
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path, "r") as f:
+            return json.load(f)
+
+    def _read_raw(self, character_id: int) -> str:
+        with open(os.path.join(self.characters_dir, f"{character_id}.json"), "r") as f:
+            return f.read()
+
+    def _read_all_raw_characters(self) -> Dict[int, str]:
+        if not os.path.exists(self.characters_dir):
+            return {}
+        ids = [
+            int(filename.split(".")[0])
+            for filename in os.listdir(self.characters_dir)
+            if filename.endswith(".json")
+        ]
+        # file reads release the GIL, so a thread pool overlaps their latency
+        with ThreadPoolExecutor(max_workers=LOAD_THREADS) as executor:
+            return dict(zip(ids, executor.map(self._read_raw, ids)))
+
+    def _read_world(self) -> Optional[Dict[str, Any]]:
+        if not os.path.exists(self.world_path):
+            return None
+        with open(self.world_path, "r") as f:
+            return json.load(f)
+
+    def fingerprint(self) -> Optional[str]:
+        # every write replaces a file, which changes its mtime
+        digest = hashlib.sha1()
+        entries = []
+        if os.path.exists(self.characters_dir):
+            with os.scandir(self.characters_dir) as it:
+                for entry in it:
+                    if entry.name.endswith(".json"):
+                        stat = entry.stat()
+                        entries.append((entry.name, stat.st_mtime_ns, stat.st_size))
+        if os.path.exists(self.world_path):
+            stat = os.stat(self.world_path)
+            entries.append((self.world_path, stat.st_mtime_ns, stat.st_size))
+        for entry in sorted(entries):
+            digest.update(repr(entry).encode())
+        return digest.hexdigest()
+
+
+class SqliteStore(Store):
+    """
+    Characters and world in one SQLite database in WAL mode, a batch is a
+    single transaction. Characters are indexed by id and city.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS characters (
+        id INTEGER PRIMARY KEY,
+        city TEXT NOT NULL,
+        data TEXT NOT NULL,
+        updated_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS characters_city ON characters (city);
+    CREATE TABLE IF NOT EXISTS world (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        date TEXT NOT NULL,
+        data TEXT NOT NULL,
+        updated_at REAL NOT NULL
+    );
+    """
+
+    def __init__(self, path: str = SIM_SQLITE_PATH):
+        super().__init__()
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+
+    def _write(self, characters, world) -> None:
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO characters (id, city, data, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET city = excluded.city, data = excluded.data, "
+                "updated_at = excluded.updated_at",
+                [
+                    (character_id, city, json.dumps(data), now)
+                    for character_id, (city, data) in characters.items()
+                ],
+            )
+            if world is not None:
+                self._conn.execute(
+                    "INSERT INTO world (id, date, data, updated_at) VALUES (1, ?, ?, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET date = excluded.date, data = excluded.data, "
+                    "updated_at = excluded.updated_at",
+                    (world["date"], json.dumps(world), now),
+                )
+
+    def _read_character(self, character_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM characters WHERE id = ?", (character_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _read_all_raw_characters(self) -> Dict[int, str]:
+        with self._lock:
+            rows = self._conn.execute("SELECT id, data FROM characters").fetchall()
+        return dict(rows)
+
+    def _read_world(self) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM world WHERE id = 1").fetchone()
+        return json.loads(row[0]) if row else None
+
+    def fingerprint(self) -> Optional[str]:
+        # every write sets updated_at
+        with self._lock:
+            characters = self._conn.execute(
+                "SELECT count(*), max(updated_at) FROM characters"
+            ).fetchone()
+            world = self._conn.execute("SELECT updated_at FROM world WHERE id = 1").fetchone()
+        return f"{characters[0]}:{characters[1]}:{world[0] if world else None}"
+
+    def character_ids_in_city(self, city: str) -> List[int]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id FROM characters WHERE city = ? ORDER BY id", (city,)
+            ).fetchall()
+        ids = {row[0] for row in rows}
+        batch = _current_batch.get()
+        for character_id, (pending_city, _) in (batch.characters if batch else {}).items():
+            if pending_city == city:
+                ids.add(character_id)
+            else:
+                ids.discard(character_id)
+        return sorted(ids)
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return (
+                self._conn.execute("SELECT 1 FROM characters LIMIT 1").fetchone() is None
+                and self._conn.execute("SELECT 1 FROM world LIMIT 1").fetchone() is None
+            )
+
+    def import_from_json(self, source: JsonStore) -> int:
+        """
+        Copy every character and the world of a JsonStore, in one transaction.
+
+        Returns:
+            int: number of characters imported.
+        """
+        characters = source.load_all_characters()
+        self._write(
+            {
+                character_id: (data.get("basic_info", {}).get("city", ""), data)
+                for character_id, data in characters.items()
+            },
+            source.load_world(),
+        )
+        return len(characters)
+
+
+@functools.lru_cache(maxsize=1)
+def get_store() -> Store:
+    if SIM_STORAGE == "sqlite":
+        store = SqliteStore(SIM_SQLITE_PATH)
+        source = JsonStore()
+        if store.is_empty() and os.path.exists(source.world_path):
+            count = store.import_from_json(source)
+            log.info(f"Imported {count} characters and the world into {SIM_SQLITE_PATH}")
+        return store
+    return JsonStore()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Import characters/*.json and world.json into a SQLite store."
+    )
+    parser.add_argument("--db", default=SIM_SQLITE_PATH)
+    parser.add_argument("--characters-dir", default=CHARACTERS_DIR)
+    parser.add_argument("--world", default=WORLD_PATH)
+    args = parser.parse_args()
+
+    start = time.time()
+    count = SqliteStore(args.db).import_from_json(JsonStore(args.characters_dir, args.world))
+    print(f"Imported {count} characters into {args.db} in {time.time() - start:.2f} seconds")
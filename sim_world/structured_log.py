@@ -0,0 +1,254 @@
+"""
+Structured logging that never writes on the event loop.
+
+    log = get_logger(__name__)
+    log.info("event processed", event_id=..., seconds=1.2)
+
+Each record is written as one JSON object per line to LOG_DIR/sim_world.jsonl
+and as a short line to stderr. Between start_logging() and stop_logging(),
+called by the entry points that run an event loop, e.g. the lifespan of the
+app, records go through a queue to a listener thread that does the writing;
+outside, e.g. in tests and short scripts, the logging thread writes. Keyword
+arguments become fields of the record, and so do the correlation ids set
+with correlate(): every record logged while a day or an event is being
+simulated carries its "day" and "event" id, also from tasks started inside.
+
+The log file is rotated when it reaches LOG_MAX_MB or is LOG_ROTATE_HOURS
+old, whichever comes first. Rotated files are gzipped by the writing thread,
+and only the newest LOG_BACKUPS archives are kept.
+"""
+
+import contextvars
+import functools
+import glob
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+LOG_DIR = os.getenv("LOG_DIR", "logs")
+LOG_FILE_NAME = "sim_world.jsonl"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG")
+LOG_CONSOLE_LEVEL = os.getenv("LOG_CONSOLE_LEVEL", "INFO")
+LOG_MAX_BYTES = int(float(os.getenv("LOG_MAX_MB", "50")) * 1024 * 1024)
+LOG_ROTATE_SECONDS = float(os.getenv("LOG_ROTATE_HOURS", "24")) * 3600
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "20"))
+# longest prompt or response stored in a record
+LOG_PAYLOAD_CHARS = int(os.getenv("LOG_PAYLOAD_CHARS", "4000"))
+
+_correlation: contextvars.ContextVar[Dict[str, str]] = contextvars.ContextVar(
+    "log_correlation", default={}
+)
+_RESERVED = {"exc_info", "stack_info", "stacklevel", "extra"}
+
+
+def new_id(prefix: str) -> str:
+    return f"{prefix}-{uuid.uuid4().hex[:12]}"
+
+
+@contextmanager
+def correlate(**ids: Any):
+    """
+    Add correlation ids to every record logged inside, e.g. correlate(day=date).
+    """
+    token = _correlation.set({**_correlation.get(), **{k: str(v) for k, v in ids.items()}})
+    try:
+        yield
+    finally:
+        _correlation.reset(token)
+
+
+def correlation_ids() -> Dict[str, str]:
+    """
+    The ids set by correlate() around the caller, e.g. to pass to another process.
+    """
+    return dict(_correlation.get())
+
+
+def cap(text: Any, limit: int = LOG_PAYLOAD_CHARS) -> Optional[str]:
+    """
+    text cut to limit characters, with a note of how much was left out.
+    """
+    if text is None:
+        return None
+    if not isinstance(text, str):
+        text = json.dumps(text, ensure_ascii=False, default=str)
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}... [{len(text) - limit} more characters]"
+
+
+class StructuredLogger(logging.LoggerAdapter):
+    """
+    Takes the fields of a record as keyword arguments.
+    """
+
+    def process(self, msg, kwargs):
+        fields = {k: kwargs.pop(k) for k in list(kwargs) if k not in _RESERVED}
+        extra = kwargs.setdefault("extra", {})
+        extra["fields"] = {**_correlation.get(), **fields}
+        return msg, kwargs
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class ConsoleFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        ids = {k: v for k, v in getattr(record, "fields", {}).items() if k in ("day", "event")}
+        if ids:
+            text += " [" + " ".join(f"{k}={v}" for k, v in ids.items()) + "]"
+        return text
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # only format what is needed here, the writing happens in the listener
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class RotatingFileHandler(logging.FileHandler):
+    """
+    Rotates by size and by age into gzipped archives next to the log file:
+    sim_world.jsonl -> sim_world.jsonl.20240301-120000.gz
+    The file is only created with the first record.
+    """
+
+    def __init__(self, path: str, max_bytes: int, max_seconds: float, backups: int):
+        super().__init__(path, mode="a", encoding="utf-8", delay=True)
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.backups = backups
+        self.opened = time.time()
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        stream = super()._open()
+        size = stream.tell()
+        self.opened = os.path.getmtime(self.baseFilename) if size else time.time()
+        return stream
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            size = self.stream.tell()
+            if size >= self.max_bytes or (size and time.time() - self.opened >= self.max_seconds):
+                self.rotate()
+        except Exception:
+            self.handleError(record)
+            return
+        super().emit(record)
+
+    def rotate(self) -> None:
+        self.stream.close()
+        self.stream = None
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        archive = f"{self.baseFilename}.{stamp}.gz"
+        n = 1
+        while os.path.exists(archive):
+            archive = f"{self.baseFilename}.{stamp}-{n}.gz"
+            n += 1
+        with open(self.baseFilename, "rb") as source, gzip.open(archive, "wb") as target:
+            shutil.copyfileobj(source, target)
+        os.remove(self.baseFilename)
+        archives = sorted(
+            glob.glob(f"{glob.escape(self.baseFilename)}.*.gz"), key=os.path.getmtime
+        )
+        for old in archives[: max(0, len(archives) - self.backups)]:
+            os.remove(old)
+        self.stream = self._open()
+
+
+@functools.lru_cache(maxsize=1)
+def _handlers() -> List[logging.Handler]:
+    file_handler = RotatingFileHandler(
+        os.path.join(LOG_DIR, LOG_FILE_NAME), LOG_MAX_BYTES, LOG_ROTATE_SECONDS, LOG_BACKUPS
+    )
+    file_handler.setFormatter(JsonFormatter())
+    file_handler.setLevel(LOG_LEVEL)
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(ConsoleFormatter())
+    console_handler.setLevel(LOG_CONSOLE_LEVEL)
+
+    root = logging.getLogger("sim")
+    root.setLevel(min(logging.getLevelName(LOG_LEVEL), logging.getLevelName(LOG_CONSOLE_LEVEL)))
+    # uvicorn configures the root logger, do not print twice
+    root.propagate = False
+    handlers: List[logging.Handler] = [file_handler, console_handler]
+    for handler in handlers:
+        root.addHandler(handler)
+    return handlers
+
+
+# (listener, the handler feeding it) between start_logging and stop_logging
+_started: Optional[Tuple[logging.handlers.QueueListener, logging.Handler]] = None
+
+
+def start_logging() -> None:
+    """
+    Hand the writing of records to a listener thread, so that logging never
+    blocks the event loop. Does nothing if it is already started.
+    """
+    global _started
+    if _started is not None:
+        return
+    handlers = _handlers()
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    queue_handler = _QueueHandler(records)
+    root = logging.getLogger("sim")
+    root.addHandler(queue_handler)
+    for handler in handlers:
+        root.removeHandler(handler)
+    _started = (listener, queue_handler)
+
+
+def stop_logging() -> None:
+    """
+    Write what is queued and stop the listener thread, records are written by
+    the logging thread again.
+    """
+    global _started
+    if _started is None:
+        return
+    listener, queue_handler = _started
+    _started = None
+    root = logging.getLogger("sim")
+    for handler in _handlers():
+        root.addHandler(handler)
+    root.removeHandler(queue_handler)
+    listener.stop()
+
+
+def get_logger(name: str) -> StructuredLogger:
+    _handlers()
+    return StructuredLogger(logging.getLogger(f"sim.{name}"), {})
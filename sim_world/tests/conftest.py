@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules are imported flat, as when the app runs from sim_world/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,63 @@
+"""
+The asyncio primitives of CharacterStore and chat belong to the running
+event loop, a second asyncio.run gets its own.
+"""
+
+import asyncio
+
+import pytest
+
+import chat
+from Character import Character, CharacterStore
+
+
+@pytest.fixture
+def store(monkeypatch):
+    repaired = []
+
+    async def repair(character_id, raw):
+        repaired.append(character_id)
+
+    monkeypatch.setattr(Character, "repair", repair)
+    monkeypatch.setattr(CharacterStore, "unrepaired", set())
+    yield repaired
+    CharacterStore._loop = None
+    CharacterStore._repair_queue = None
+    CharacterStore._load_lock = None
+
+
+async def contend(lock):
+    # a waiter binds the lock to the running loop
+    async with lock:
+        waiter = asyncio.create_task(lock.acquire())
+        await asyncio.sleep(0)
+    await waiter
+    lock.release()
+
+
+def test_each_loop_gets_its_own_lock_and_semaphore(store):
+    async def run():
+        lock = CharacterStore.get_load_lock()
+        await contend(lock)
+        await contend(chat._get_semaphore())
+        assert CharacterStore.get_load_lock() is lock
+        return lock, chat._get_semaphore()
+
+    first = asyncio.run(run())
+    second = asyncio.run(run())
+    assert first[0] is not second[0] and first[1] is not second[1]
+
+
+def test_queued_repairs_move_to_the_next_loop(store):
+    async def queue():
+        CharacterStore.get_repair_queue().put_nowait((7, "{}"))
+
+    async def run():
+        CharacterStore.get_repair_queue()
+        await CharacterStore._repair_task
+
+    asyncio.run(queue())
+    assert store == []
+    asyncio.run(run())
+    assert store == [7]
+    assert CharacterStore._repair_queue.empty()
@@ -0,0 +1,54 @@
+"""
+Raw completions go through the response cache like compiled prompts.
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import chat
+from llm_cache import ResponseCache
+
+MESSAGES = [{"role": "user", "content": "Say hi as Alice."}]
+
+
+@pytest.fixture
+def provider(tmp_path, monkeypatch):
+    calls = []
+
+    async def create_completion(**kwargs):
+        calls.append(kwargs)
+        message = SimpleNamespace(content=f" hi {len(calls)} ")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+    monkeypatch.setattr(chat, "response_cache", ResponseCache(str(tmp_path / "cache")))
+    monkeypatch.setattr(chat, "LLM_CACHE_MODE", "readwrite")
+    monkeypatch.setattr(chat, "default_model_type", "openai")
+    monkeypatch.setattr(chat, "_create_completion", create_completion)
+    return calls
+
+
+def test_raw_completion_is_cached(provider):
+    async def run():
+        first = await chat.raw_completion(MESSAGES, temperature=0)
+        second = await chat.raw_completion(MESSAGES, temperature=0)
+        streamed = [delta async for delta in chat.raw_completion_stream(MESSAGES, temperature=0)]
+        other = await chat.raw_completion(MESSAGES, temperature=1)
+        return first, second, streamed, other
+
+    first, second, streamed, other = asyncio.run(run())
+    assert first == second == "hi 1"
+    assert streamed == ["hi 1"]
+    # params are part of the key
+    assert other == "hi 2"
+    assert len(provider) == 2
+
+
+def test_replay_serves_raw_completions_without_the_provider(provider, monkeypatch):
+    asyncio.run(chat.raw_completion(MESSAGES))
+    monkeypatch.setattr(chat, "LLM_CACHE_MODE", "replay")
+    assert asyncio.run(chat.raw_completion(MESSAGES)) == "hi 1"
+    with pytest.raises(chat.LLMReplayMissError):
+        asyncio.run(chat.raw_completion(MESSAGES, temperature=1))
+    assert len(provider) == 1
@@ -0,0 +1,141 @@
+"""
+The event log seals full segments, recovers from a crash while appending and
+pages through queries with a cursor.
+"""
+
+import asyncio
+import gzip
+import json
+import os
+
+import pytest
+
+from event_log import MANIFEST, EventLog
+
+
+def event(date, ids, location="Davis"):
+    return {
+        "id_of_character_involved": ids,
+        "date": date,
+        "start_time": "09:00",
+        "location": location,
+        "description": "they met",
+    }
+
+
+@pytest.fixture
+def log(tmp_path):
+    event_log = EventLog(str(tmp_path), segment_records=3)
+    yield event_log
+    event_log.close()
+
+
+def test_full_segment_is_gzipped_and_indexed(log, tmp_path):
+    for day in range(1, 5):
+        log.append_event(event(f"2024-03-0{day}", [day]))
+    # waits for the background sealing
+    log.close()
+
+    assert sorted(os.listdir(tmp_path)) == [
+        MANIFEST,
+        "segment-000000.jsonl.gz",
+        "segment-000001.jsonl",
+    ]
+    with gzip.open(tmp_path / "segment-000000.jsonl.gz", "rt") as f:
+        assert [json.loads(line)["seq"] for line in f] == [1, 2, 3]
+    with open(tmp_path / MANIFEST) as f:
+        (segment,) = json.load(f)["segments"]
+    assert segment["first_seq"] == 1 and segment["last_seq"] == 3
+    assert sorted(segment["character_ids"]) == [1, 2, 3]
+
+    reopened = EventLog(str(tmp_path), segment_records=3)
+    assert reopened.stats() == {"segments": 2, "records": 4, "last_seq": 4}
+    assert [r["seq"] for r in reopened.query()["records"]] == [1, 2, 3, 4]
+    reopened.close()
+
+
+def test_torn_last_line_is_dropped_on_recovery(log, tmp_path):
+    log.append_event(event("2024-03-01", [1]))
+    log.append_event(event("2024-03-01", [2]))
+    log.close()
+    with open(tmp_path / "segment-000000.jsonl", "a") as f:
+        f.write('{"seq": 3, "kind": "event", "da')
+
+    recovered = EventLog(str(tmp_path), segment_records=3)
+    assert recovered.stats()["records"] == 2
+    assert recovered.append_event(event("2024-03-02", [3])) == 3
+    assert [r["seq"] for r in recovered.query()["records"]] == [1, 2, 3]
+    recovered.close()
+
+
+def test_plain_segment_missing_from_the_manifest_is_sealed(log, tmp_path):
+    for day in range(1, 5):
+        log.append_event(event(f"2024-03-0{day}", [day]))
+    log.close()
+    # as if the process died after gzipping, before the manifest was written
+    os.remove(tmp_path / MANIFEST)
+    os.rename(tmp_path / "segment-000000.jsonl.gz", tmp_path / "gone.gz")
+    with gzip.open(tmp_path / "gone.gz", "rt") as src, open(
+        tmp_path / "segment-000000.jsonl", "w"
+    ) as dst:
+        dst.write(src.read())
+
+    recovered = EventLog(str(tmp_path), segment_records=3)
+    recovered.close()
+    assert [s.segment_id for s in recovered.sealed] == [0]
+    assert recovered.active.segment_id == 1
+    assert not os.path.exists(tmp_path / "segment-000000.jsonl")
+
+
+def test_query_filters(log):
+    log.append_event(event("2024-03-01", [1, 2], "Davis"))
+    log.append_event(event("2024-03-02", [2, 3], "Sacramento"))
+    log.append_event(event("2024-03-03", [1], "Sacramento"))
+    old = {"basic_info": {"id": 1, "name": "A"}}
+    log.append_character_change(old, {"basic_info": {"id": 1, "name": "B"}}, "2024-03-03")
+    log.append_event(event("2024-03-04", [3], "Davis"))
+
+    def seqs(**filters):
+        return [r["seq"] for r in log.query(**filters)["records"]]
+
+    assert seqs(character_id=1) == [1, 3, 4]
+    assert seqs(character_id=1, kind="event") == [1, 3]
+    assert seqs(location="Sacramento") == [2, 3]
+    assert seqs(date_from="2024-03-02", date_to="2024-03-03") == [2, 3, 4]
+    assert seqs(character_id=3, location="Davis") == [5]
+    assert seqs(character_id=4) == []
+
+
+def test_cursor_pages_through_sealed_and_active_segments(log):
+    for n in range(8):
+        log.append_event(event("2024-03-01", [n % 2]))
+    log.close()
+
+    pages = []
+    cursor = 0
+    while cursor is not None:
+        page = log.query(character_id=0, after=cursor, limit=2)
+        pages.append([r["seq"] for r in page["records"]])
+        cursor = page["next_cursor"]
+    assert pages == [[1, 3], [5, 7], []]
+
+
+def test_segments_that_cannot_match_are_not_read(log):
+    for day in range(1, 7):
+        log.append_event(event(f"2024-03-0{day}", [day]))
+    log.close()
+    page = log.query(date_from="2024-03-05")
+    assert [r["seq"] for r in page["records"]] == [5, 6]
+    # the first segment only holds March 1 to 3
+    assert page["segments_read"] == 1
+
+
+def test_failed_transaction_writes_nothing(log):
+    async def day():
+        async with log.transaction():
+            log.append_event(event("2024-03-01", [1]))
+            raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(day())
+    assert log.stats()["records"] == 0
@@ -0,0 +1,137 @@
+"""
+Events are processed while the shards are still streaming, in start_time
+order per character.
+"""
+
+import asyncio
+import json
+
+import World as world_module
+from Character import Event
+from event_pipeline import EventPipeline, StartTimeGate
+from World import World
+
+DATE = "2024-03-01"
+
+
+def event(start_time, *ids):
+    return Event(
+        id_of_character_involved=list(ids),
+        date=DATE,
+        start_time=start_time,
+        description="they met",
+    )
+
+
+def test_events_of_a_character_run_in_submission_order():
+    timeline = []
+    # the later events of character 1 would finish first if nothing ordered them
+    delays = {"a1": 0.05, "a2": 0.02, "a3": 0.0, "b1": 0.01}
+
+    async def apply(processed):
+        name = processed.description
+        timeline.append(f"start {name}")
+        await asyncio.sleep(delays[name])
+        timeline.append(f"end {name}")
+        return name
+
+    events = [
+        Event(id_of_character_involved=ids, date=DATE, start_time="09:00", description=name)
+        for name, ids in [("a1", [1]), ("a2", [1, 2]), ("b1", [3]), ("a3", [1])]
+    ]
+
+    async def main():
+        pipeline = EventPipeline(apply)
+        for submitted in events:
+            pipeline.submit(submitted)
+        return await pipeline.join()
+
+    assert asyncio.run(main()) == ["a1", "a2", "b1", "a3"]
+    at = timeline.index
+    assert at("end a1") < at("start a2") and at("end a2") < at("start a3")
+    # b1 shares no character with a1, they ran at the same time
+    assert at("start b1") < at("end a1")
+
+
+def test_failed_event_does_not_block_the_next_one():
+    async def apply(processed):
+        if processed.description == "fails":
+            raise ValueError("bad JSON")
+        return processed.description
+
+    async def main():
+        pipeline = EventPipeline(apply)
+        pipeline.submit(event("09:00", 1).model_copy(update={"description": "fails"}))
+        pipeline.submit(event("10:00", 1))
+        return await pipeline.join(), pipeline.failures
+
+    results, failures = asyncio.run(main())
+    assert results == [None, "they met"]
+    assert [e.description for e, _ in failures] == ["fails"]
+
+
+def test_event_is_applied_before_the_stream_ends(monkeypatch):
+    order = []
+    applied = asyncio.Event()
+    first = event("08:00", 1, 2).model_dump_json()
+    second = event("09:00", 1).model_dump_json()
+
+    async def fake_stream(shard, prompt, candidates, accept):
+        yield f'<answer>{{"date": "{DATE}", "weathers": [], "events": [{first}, '
+        await asyncio.wait_for(applied.wait(), 5)
+        yield f"{second}]}}</answer>"
+        order.append("stream ended")
+        accept(
+            "<answer>"
+            + json.dumps(
+                {"date": DATE, "weathers": [], "events": [json.loads(first), json.loads(second)]}
+            )
+            + "</answer>"
+        )
+
+    async def apply(processed):
+        order.append(f"applied {processed.start_time}")
+        applied.set()
+
+    monkeypatch.setattr(world_module, "chat_sim_one_day_stream", fake_stream)
+
+    async def main():
+        pipeline = EventPipeline(apply)
+        gate = StartTimeGate([[1, 2], [3]], pipeline.submit)
+        seen = set()
+
+        def on_event(streamed):
+            # _sim_shard replays the full answer at the end, see _sim_one_day
+            if streamed.start_time not in seen:
+                seen.add(streamed.start_time)
+                gate.add(0, streamed)
+
+        today = World(date=DATE, events=[], weathers=[])
+        await today._sim_shard([], [], DATE, lambda weather: None, on_event)
+        gate.close(0)
+        await pipeline.join()
+
+    asyncio.run(main())
+    assert order == ["applied 08:00", "stream ended", "applied 09:00"]
+
+
+def test_event_waits_for_a_shard_that_can_still_stream_an_earlier_one():
+    released = []
+    gate = StartTimeGate([[1, 3], [2, 3]], lambda e: released.append(e.start_time))
+    gate.add(0, event("10:00", 1, 3))
+    # shard 1 has not streamed anything, it could still mention 3 at 09:00
+    assert released == []
+    gate.add(1, event("09:00", 2, 3))
+    gate.add(1, event("11:00", 2))
+    assert released == ["09:00", "10:00", "11:00"]
+
+
+def test_later_event_does_not_pass_a_held_one():
+    released = []
+    gate = StartTimeGate([[1, 2], [2]], lambda e: released.append(e.start_time))
+    gate.add(0, event("08:00", 1, 2))
+    # 1 alone is settled, but the held event of 1 and 2 is earlier
+    gate.add(0, event("09:00", 1))
+    assert released == []
+    gate.close(1)
+    assert released == ["08:00", "09:00"]
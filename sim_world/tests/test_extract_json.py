@@ -0,0 +1,103 @@
+"""
+util.extract_longest_json against the cases the previous regex got wrong.
+
+Run from the repository root or sim_world/:
+    python -m pytest sim_world/tests
+"""
+
+import glob
+import json
+import os
+
+import pytest
+
+import util
+from benchmarks.extract_json import (
+    legacy_extract_longest_json,
+    make_cot_response,
+    make_nested_response,
+    make_truncated_response,
+)
+
+SIM_WORLD = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = [os.path.join(SIM_WORLD, "world.json")] + sorted(
+    glob.glob(os.path.join(SIM_WORLD, "characters", "*.json"))
+)
+
+DEEP = {"a": {"b": {"c": {"d": {"e": [1, {"f": {"g": "deep"}}]}}}}, "z": 0}
+
+
+def extract(text):
+    found = util.extract_longest_json(text)
+    return None if found is None else json.loads(found)
+
+
+def test_deeply_nested_object():
+    text = f"Here it is: {json.dumps(DEEP)} done."
+    assert extract(text) == DEEP
+    # the regex only matched two levels of nesting
+    legacy = legacy_extract_longest_json(text)
+    assert legacy is None or json.loads(legacy) != DEEP
+
+
+def test_deeply_nested_answer_after_thinking():
+    text = make_cot_response(DEEP, size_kb=4)
+    assert extract(text) == DEEP
+    legacy = legacy_extract_longest_json(text)
+    assert legacy is None or json.loads(legacy) != DEEP
+
+
+def test_braces_and_escaped_quotes_in_strings():
+    expected = {"description": 'She said "}{ is not JSON" and {left}', "nested": {"x": "\\"}}
+    text = "before { stray " + json.dumps(expected) + " after }"
+    assert extract(text) == expected
+
+
+def test_answer_block_wins_over_longer_json_in_thinking():
+    thinking = {"draft": ["x" * 200], "more": {"y": 1}}
+    answer = {"date": "2024-03-02", "events": []}
+    text = f"```thinking\n{json.dumps(thinking)}\n```\n<answer>\n{json.dumps(answer)}\n</answer>"
+    assert extract(text) == answer
+
+
+def test_longest_of_several_objects():
+    text = '{"a": 1} then {"b": {"c": {"d": [1, 2, 3]}}} then {"e": 2}'
+    assert extract(text) == {"b": {"c": {"d": [1, 2, 3]}}}
+
+
+def test_unbalanced_brace_before_the_object():
+    text = 'Hmm, not sure about {unbalanced here, but {"ok": {"deep": {"er": true}}}'
+    assert extract(text) == {"ok": {"deep": {"er": True}}}
+
+
+def test_truncated_response_after_an_object():
+    # every open brace used to be rescanned to the end of the text
+    text = '{"ok": {"a": 1}} ' + make_truncated_response(size_kb=100)
+    assert extract(text) == {"ok": {"a": 1}}
+
+
+def test_objects_nested_in_a_truncated_one():
+    text = '{"draft": {"a": 1}, "b": {"c": {"d": 2}}, "cut'
+    assert extract(text) == {"c": {"d": 2}}
+
+
+def test_deeper_than_json_can_parse():
+    # the deepest objects json.loads can parse are the longest found
+    found = extract(make_nested_response(size_kb=100))
+    depth = 0
+    while isinstance(found, dict):
+        found = found["a"]
+        depth += 1
+    assert found == 1 and depth > 100
+
+
+@pytest.mark.parametrize("text", [None, "", "no json here", "{not: json}", "{unclosed"])
+def test_nothing_found(text):
+    assert util.extract_longest_json(text) is None
+
+
+@pytest.mark.parametrize("path", FIXTURES, ids=os.path.basename)
+def test_fixture_in_a_cot_response(path):
+    with open(path) as f:
+        expected = json.load(f)
+    assert extract(make_cot_response(expected, size_kb=16, seed=len(path))) == expected
@@ -0,0 +1,49 @@
+"""
+Cached response bodies follow the version of their entity, and only the most
+recently used are kept.
+"""
+
+import pytest
+
+import http_cache
+
+
+@pytest.fixture(autouse=True)
+def small_cache(monkeypatch):
+    monkeypatch.setattr(http_cache, "HTTP_CACHE_ENTRIES", 3)
+    monkeypatch.setattr(http_cache, "_versions", http_cache.OrderedDict())
+    monkeypatch.setattr(http_cache, "_entries", http_cache.OrderedDict())
+
+
+def body(entity_id, text):
+    return http_cache.get_or_build("Character", entity_id, lambda: text).body
+
+
+def test_invalidate_rebuilds():
+    assert body(1, b"a") == b"a"
+    assert body(1, b"b") == b"a"
+    http_cache.invalidate("Character", 1)
+    assert body(1, b"b") == b"b"
+    http_cache.invalidate_all("Character")
+    assert body(1, b"c") == b"c"
+
+
+def test_least_recently_used_bodies_are_dropped():
+    for entity_id in range(3):
+        body(entity_id, b"old")
+    # 0 is used again, 1 is now the least recently used
+    body(0, b"new")
+    body(3, b"old")
+    assert len(http_cache._entries) == 3
+    assert body(1, b"new") == b"new"
+    assert body(0, b"new") == b"old"
+
+
+def test_versions_are_bounded_and_take_their_body_along():
+    for entity_id in range(5):
+        body(entity_id, b"old")
+        http_cache.invalidate("Character", entity_id)
+    assert len(http_cache._versions) == 3
+    # forgotten, back to version 0, nothing stale can match it
+    assert http_cache.version("Character", 0) == 0
+    assert body(0, b"new") == b"new"
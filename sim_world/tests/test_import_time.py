@@ -0,0 +1,24 @@
+"""
+`import main` stays within its budget and leaves data, clients and heavy
+optional dependencies to main.lifespan, see benchmarks/import_time.py.
+IMPORT_TIME_BUDGET overrides the budget, in seconds, e.g. on a slow machine.
+"""
+
+from benchmarks.import_time import IMPORT_TIME_BUDGET, LAZY_MODULES, measure
+
+
+def test_import_main_within_budget():
+    # the first import may compile bytecode, which is not what is measured
+    measure("main")
+    total, modules = measure("main")
+    slowest = sorted(modules, reverse=True)[:5]
+    assert total <= IMPORT_TIME_BUDGET, (
+        f"import main took {total:.3f}s, budget {IMPORT_TIME_BUDGET:.3f}s, slowest: "
+        + ", ".join(f"{name} {own * 1000:.0f} ms" for own, _, name in slowest)
+    )
+
+
+def test_import_main_loads_no_optional_heavy_modules():
+    _, modules = measure("main")
+    loaded = {name.split(".")[0] for _, _, name in modules}
+    assert not loaded & set(LAZY_MODULES)
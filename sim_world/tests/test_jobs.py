@@ -0,0 +1,126 @@
+"""
+JobManager swaps the served world and its cached HTTP body together, and
+rolls back what a failed day changed in memory.
+"""
+
+import asyncio
+
+import pytest
+
+import http_cache
+import jobs
+from benchmarks.load_characters import write_population
+from Character import Character
+from jobs import JobManager
+from memory import HashingEmbedder, MemoryStore
+from relationships import get_graph
+from storage import get_store
+
+
+class FakeWorld:
+    def __init__(self, date, on_sim=None):
+        self.date = date
+        self.on_sim = on_sim
+
+    def next_date(self):
+        return f"{self.date}+1"
+
+    def body(self):
+        return self.date.encode()
+
+    async def sim_one_day(self, progress):
+        new_world = FakeWorld(self.next_date())
+        # saved, but not swapped in yet, e.g. while the store flushes
+        await asyncio.sleep(0)
+        self.on_sim()
+        await asyncio.sleep(0)
+        return new_world
+
+
+@pytest.fixture(autouse=True)
+def fresh_world_entry():
+    # the cache is module state, shared with the other tests
+    http_cache.invalidate("World")
+
+
+@pytest.fixture
+def memories(tmp_path, monkeypatch):
+    """
+    A store of a few characters in tmp_path, and their memories.
+    """
+    write_population(str(tmp_path), 3)
+    monkeypatch.chdir(tmp_path)
+    store = MemoryStore(str(tmp_path / "memories"), embedder=HashingEmbedder())
+    monkeypatch.setattr(jobs, "get_memory_store", lambda: store)
+    asyncio.run(Character.reload())
+    return store
+
+
+def get_root(manager):
+    return http_cache.get_or_build("World", None, lambda: manager.world.body()).body
+
+
+def test_get_between_save_and_swap_is_not_served_after_the_swap():
+    async def run():
+        manager = JobManager()
+        seen = []
+        manager.world = FakeWorld("2024-03-01", lambda: seen.append(get_root(manager)))
+        assert get_root(manager) == b"2024-03-01"
+        await manager.wait(manager.submit_day())
+        return seen, get_root(manager)
+
+    seen, after = asyncio.run(run())
+    assert seen == [b"2024-03-01"]
+    assert after == b"2024-03-01+1"
+
+
+def test_failed_day_keeps_the_world(memories):
+    async def run():
+        manager = JobManager()
+
+        def fail():
+            raise RuntimeError("boom")
+
+        manager.world = FakeWorld("2024-03-01", fail)
+        job = await manager.wait(manager.submit_day())
+        return job, get_root(manager)
+
+    job, body = asyncio.run(run())
+    assert job.status == "failed"
+    assert body == b"2024-03-01"
+
+
+def test_failed_day_is_rolled_back(memories):
+    async def run():
+        manager = JobManager()
+        character = await Character.get_character(1)
+        before = character.model_dump(mode="json")
+        cached = http_cache.get_or_build("Character", 1, lambda: b"before")
+        memories.remember([character], "seen before", "2024-03-01")
+
+        async def fail(progress):
+            async with get_store().batch():
+                changed = character.model_copy(deep=True)
+                changed.basic_info.name = "Changed"
+                changed.save()
+                http_cache.get_or_build("Character", 1, lambda: b"partial")
+                await asyncio.to_thread(
+                    memories.remember, [changed], "the failed day", "2024-03-02"
+                )
+                get_graph().add_event([1, 2], "2024-03-02")
+                raise RuntimeError("boom")
+
+        manager.world = FakeWorld("2024-03-01")
+        manager.world.sim_one_day = fail
+        job = await manager.wait(manager.submit_day())
+        after = await Character.get_character(1)
+        recalled = memories.recall([after], "the failed day", k=5)[1]
+        return job, manager, before, after.model_dump(mode="json"), cached, recalled
+
+    job, manager, before, after, cached, recalled = asyncio.run(run())
+    assert job.status == "failed" and manager.consistent
+    assert after == before
+    assert http_cache.get_or_build("Character", 1, lambda: b"reloaded").body == b"reloaded"
+    assert "the failed day" not in [memory["text"] for memory in recalled]
+    assert "seen before" in [memory["text"] for memory in recalled]
+    assert 2 not in get_graph().neighbours(1)
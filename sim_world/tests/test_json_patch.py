@@ -0,0 +1,96 @@
+"""
+json_patch.apply(old, json_patch.diff(old, new)) gives back new.
+"""
+
+import copy
+import glob
+import json
+import os
+
+import pytest
+
+import json_patch
+
+SIM_WORLD = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def round_trip(old, new):
+    before = copy.deepcopy(old)
+    ops = json_patch.diff(old, new)
+    assert json_patch.apply(old, ops) == new
+    # the patch is applied to a copy
+    assert old == before
+    return ops
+
+
+def test_nested_dicts():
+    old = {"a": {"b": {"c": 1, "d": [1, 2]}, "e": "x"}}
+    new = {"a": {"b": {"c": 2, "d": [1, 2]}, "e": "x"}}
+    assert round_trip(old, new) == [{"op": "replace", "path": "/a/b/c", "value": 2}]
+
+
+def test_added_and_removed_keys():
+    old = {"a": 1, "b": {"c": 2, "d": 3}}
+    new = {"a": 1, "b": {"c": 2, "e": {"f": None}}}
+    assert round_trip(old, new) == [
+        {"op": "remove", "path": "/b/d"},
+        {"op": "add", "path": "/b/e", "value": {"f": None}},
+    ]
+
+
+def test_sliding_window():
+    old = {"events": list(range(10))}
+    new = {"events": list(range(2, 11))}
+    assert round_trip(old, new) == [
+        {"op": "remove", "path": "/events/0"},
+        {"op": "remove", "path": "/events/0"},
+        {"op": "add", "path": "/events/-", "value": 10},
+    ]
+
+
+@pytest.mark.parametrize(
+    "old, new",
+    [
+        ([1, 2, 3], [1, 5, 3]),
+        ([{"a": 1}, {"a": 2}], [{"a": 1}, {"a": 3}]),
+        ([1, 2, 3], [3, 2]),
+        ([], [1]),
+        ([1], []),
+        ([1, 2], [0, 1, 2]),
+    ],
+)
+def test_list_changes(old, new):
+    round_trip({"list": old}, {"list": new})
+
+
+def test_type_changes():
+    round_trip({"a": [1], "b": 1, "c": None}, {"a": {"0": 1}, "b": 1.0, "c": "x"})
+    assert round_trip(1, [1]) == [{"op": "replace", "path": "", "value": [1]}]
+
+
+def test_tilde_and_slash_in_keys():
+    old = {"a/b": {"~c": 1}, "~1": 2, "d": 3}
+    new = {"a/b": {"~c": 2}, "d": 3, "~0/": 4}
+    ops = round_trip(old, new)
+    assert {op["path"] for op in ops} == {"/a~1b/~0c", "/~01", "/~00~1"}
+
+
+def test_unchanged_document_has_no_ops():
+    doc = {"a": [1, {"b": "c"}]}
+    assert json_patch.diff(doc, copy.deepcopy(doc)) == []
+
+
+@pytest.mark.parametrize(
+    "path",
+    sorted(glob.glob(os.path.join(SIM_WORLD, "characters", "*.json"))),
+    ids=os.path.basename,
+)
+def test_character_after_an_event(path):
+    with open(path) as f:
+        old = json.load(f)
+    new = copy.deepcopy(old)
+    new["basic_info"]["city"] = "Sacramento/West"
+    event = {"date": "2024-03-02", "start_time": "09:00", "description": "moved"}
+    new["events_latest_10"] = (new.get("events_latest_10") or [])[1:] + [event]
+    new.setdefault("personality_and_psychology", {}).pop("mbti", None)
+    round_trip(old, new)
@@ -0,0 +1,134 @@
+"""
+The KV cache of local decoding is keyed on the static prefix of a template,
+tested with a stub model that counts the prefixes it computes.
+"""
+
+import asyncio
+from collections import OrderedDict
+
+import pytest
+
+import local_llm
+from local_llm import Batcher, LocalModel
+from prompt_compiler import PromptTemplate, dynamic, static
+
+INSTRUCTIONS = "Simulate a day for these characters. " * 4
+END = 0
+GENERATION = 1
+
+
+class StubTokenizer:
+    """
+    One token per character, messages are closed by END.
+    """
+
+    def apply_chat_template(self, messages, add_generation_prompt=True):
+        tokens = []
+        for message in messages:
+            tokens += [ord(c) for c in message["content"]] + [END]
+        return tokens + [GENERATION] if add_generation_prompt else tokens
+
+
+class StubModel(LocalModel):
+    def __init__(self):
+        self.tokenizer = StubTokenizer()
+        self.prefix_cache = OrderedDict()
+        self.prefix_hits = 0
+        self.prefix_misses = 0
+        self.computed = []
+        self.decoded = []
+
+    def prefix_kv(self, tokens):
+        self.computed.append(tokens)
+        return ("kv", tokens)
+
+    def generate(self, rows, max_new_tokens, temperature, prefix=()):
+        length, cached = self.cached_prefix(prefix, rows)
+        self.decoded.append((len(rows), length))
+        return [f"row {i}" for i in range(len(rows))], len(rows)
+
+
+def template(cot=False):
+    return PromptTemplate(
+        "sim_one_day",
+        [static("instructions", INSTRUCTIONS), dynamic("characters", "{characters}")],
+        cot=cot,
+    )
+
+
+def key(prompt):
+    return tuple((m["role"], m["content"]) for m in prompt.prefix)
+
+
+@pytest.fixture
+def model():
+    return StubModel()
+
+
+def test_prefix_is_the_static_head_of_the_template():
+    prompt = template().render(characters="[1, 2]")
+    assert prompt.prefix == [{"role": "system", "content": INSTRUCTIONS}]
+    assert prompt.messages[0]["content"].startswith(INSTRUCTIONS)
+    cot = template(cot=True).render(characters="[1, 2]")
+    assert cot.prefix[:-1] == cot.messages[:-1]
+    headless = PromptTemplate("x", [dynamic("a", "{a}"), static("b", INSTRUCTIONS)])
+    assert headless.render(a="1").prefix == []
+
+
+def test_one_row_is_cached_under_its_prefix(model):
+    first = template().render(characters="[1]")
+    row = model.encode(first.messages)
+    length, cached = model.cached_prefix(key(first), [row])
+    # the prefix ends where the dynamic text starts, not at the end of the row
+    assert length == len(INSTRUCTIONS)
+    assert cached == ("kv", tuple(row[: len(INSTRUCTIONS)]))
+    second = template().render(characters="[2, 3]")
+    assert model.cached_prefix(key(second), [model.encode(second.messages)]) == (length, cached)
+    assert len(model.computed) == 1
+    assert (model.prefix_hits, model.prefix_misses) == (1, 1)
+    assert list(model.prefix_cache) == [key(first)]
+
+
+def test_prompts_without_a_prefix_are_not_cached(model):
+    rows = [model.encode([{"role": "user", "content": "x" * 200}])]
+    assert model.cached_prefix((), rows) == (0, None)
+    short = (("system", "too short"),)
+    rows = [model.encode([{"role": "system", "content": "too short, and more"}])]
+    assert model.cached_prefix(short, rows) == (0, None)
+    assert model.computed == [] and not model.prefix_cache
+
+
+def test_lru_of_prefixes(model, monkeypatch):
+    monkeypatch.setattr(local_llm, "LOCAL_LLM_PREFIX_CACHE_SIZE", 2)
+    prefixes = [(("system", f"{n} {INSTRUCTIONS}"),) for n in range(3)]
+    for prefix in prefixes + prefixes[2:]:
+        rows = [model.encode([{"role": "system", "content": prefix[0][1] + "data"}])]
+        model.cached_prefix(prefix, rows)
+    assert list(model.prefix_cache) == prefixes[1:]
+    assert len(model.computed) == 3
+
+
+def test_batches_are_grouped_by_prefix(model, monkeypatch):
+    batcher = Batcher(max_batch=8, max_wait_ms=50)
+    batcher._model = model
+    day = template()
+    other = PromptTemplate(
+        "process_event", [static("instructions", "Process the event. " * 5), dynamic("e", "{e}")]
+    )
+    prompts = [day.render(characters=f"[{n}]") for n in range(3)]
+    prompts.append(other.render(e="{}"))
+
+    async def main():
+        return await asyncio.gather(
+            *(local_llm.complete(p.messages, p.prefix, max_tokens=8) for p in prompts),
+            batcher.complete([{"role": "user", "content": "hi"}], 8, 0.0),
+        )
+
+    monkeypatch.setattr(local_llm, "get_batcher", lambda: batcher)
+    asyncio.run(main())
+    assert sorted(model.decoded) == [
+        (1, 0),
+        (1, len("Process the event. " * 5)),
+        (3, len(INSTRUCTIONS)),
+    ]
+    assert len(model.computed) == 2
@@ -0,0 +1,71 @@
+"""
+Metrics render in the Prometheus text format.
+"""
+
+import asyncio
+import json
+import math
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture(autouse=True)
+def registry():
+    # every metric registers itself, keep the ones made here out of /metrics
+    registered = list(metrics.REGISTRY)
+    yield
+    metrics.REGISTRY[:] = registered
+
+
+def test_large_values_keep_full_precision():
+    counter = metrics.Counter("test_tokens_total", "Tokens.", ("kind",))
+    counter.inc("prompt", amount=1234567)
+    counter.inc("completion", amount=0.1 + 0.2)
+    assert counter.render()[2:] == [
+        'test_tokens_total{kind="completion"} 0.30000000000000004',
+        'test_tokens_total{kind="prompt"} 1234567.0',
+    ]
+
+
+def test_gauge_renders_infinity_and_nan():
+    gauge = metrics.Gauge(
+        "test_gauge",
+        "Gauge.",
+        lambda: {("a",): math.inf, ("b",): -math.inf, ("c",): math.nan, ("d",): 10**7},
+        ("name",),
+    )
+    assert gauge.render()[2:] == [
+        'test_gauge{name="a"} +Inf',
+        'test_gauge{name="b"} -Inf',
+        'test_gauge{name="c"} NaN',
+        'test_gauge{name="d"} 10000000.0',
+    ]
+
+
+def test_histogram_sum():
+    histogram = metrics.Histogram("test_seconds", "Seconds.", buckets=(1,))
+    histogram.observe(2_000_000.5)
+    assert histogram.render()[2:] == [
+        'test_seconds_bucket{le="1"} 0',
+        'test_seconds_bucket{le="+Inf"} 1',
+        "test_seconds_sum 2000000.5",
+        "test_seconds_count 1",
+    ]
+
+
+def test_trace_of_a_day_is_written(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "TRACE_DIR", str(tmp_path / "traces"))
+
+    async def day():
+        async with metrics.trace_day("2024-03-01", True) as root:
+            with metrics.stage("sim_shard", characters=2):
+                await asyncio.sleep(0)
+        return root
+
+    root = asyncio.run(day())
+    with open(tmp_path / "traces" / "2024-03-01.json") as f:
+        trace = json.load(f)
+    assert trace == root.to_dict(root.start)
+    assert [child["name"] for child in trace["children"]] == ["sim_shard"]
@@ -0,0 +1,104 @@
+"""
+A character put into the population table comes back as the same model.
+"""
+
+import copy
+import glob
+import json
+import os
+
+import numpy as np
+import pytest
+
+from Character import Character
+from population import INITIAL_CAPACITY, Population
+
+SIM_WORLD = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = sorted(glob.glob(os.path.join(SIM_WORLD, "characters", "*.json")))
+
+
+def fixtures():
+    characters = []
+    for path in FIXTURES:
+        with open(path) as f:
+            characters.append(json.load(f))
+    return characters
+
+
+def model(data):
+    return Character.model_validate(data).model_dump(mode="json")
+
+
+@pytest.fixture
+def population():
+    population = Population()
+    for data in fixtures():
+        population.put(data)
+    return population
+
+
+def test_record_round_trip(population):
+    for data in fixtures():
+        record = population.record(data["basic_info"]["id"])
+        assert model(record) == model(data)
+        # the sections keep their fields in order
+        assert list(record["basic_info"]) == list(data["basic_info"])
+    assert population.record(12345) is None
+
+
+def test_put_replaces_and_does_not_change_its_input(population):
+    data = fixtures()[0]
+    before = copy.deepcopy(data)
+    data["basic_info"]["city"] = "Nowhere"
+    data["basic_info"]["age"] += 1
+    data["personality_and_psychology"]["risk_taking_scale"] = 99
+    changed = copy.deepcopy(data)
+    population.put(data)
+    assert data == changed
+    assert len(population) == len(FIXTURES)
+    record = population.record(before["basic_info"]["id"])
+    assert model(record) == model(changed)
+
+
+def test_filter_matches_the_models(population):
+    characters = [Character.model_validate(data) for data in fixtures()]
+    city = characters[0].basic_info.city
+    assert population.filter(city=city) == [
+        c.basic_info.id for c in characters if c.basic_info.city == city
+    ]
+    assert population.filter(age__gt=30, city__ne=city) == [
+        c.basic_info.id for c in characters if c.basic_info.age > 30 and c.basic_info.city != city
+    ]
+    assert population.filter(risk_taking_scale__le=50) == [
+        c.basic_info.id
+        for c in characters
+        if c.personality_and_psychology.risk_taking_scale <= 50
+    ]
+    assert population.filter(city__in=[city, "Nowhere"]) == population.filter(city=city)
+    assert population.filter(city="Nowhere") == []
+    with pytest.raises(ValueError):
+        population.filter(city__gt="A")
+
+
+def test_grows_past_its_initial_capacity():
+    population = Population()
+    template = fixtures()[0]
+    for character_id in range(1, INITIAL_CAPACITY + 2):
+        data = copy.deepcopy(template)
+        data["basic_info"]["id"] = character_id
+        data["basic_info"]["age"] = character_id % 90
+        population.put(data)
+    assert len(population) == INITIAL_CAPACITY + 1
+    assert population.count(age=0) == len(range(90, INITIAL_CAPACITY + 2, 90))
+    record = population.record(INITIAL_CAPACITY + 1)
+    assert record["basic_info"]["age"] == (INITIAL_CAPACITY + 1) % 90
+    assert model(record)["basic_info"]["name"] == template["basic_info"]["name"]
+
+
+def test_set_traits(population):
+    ids, traits = population.trait_matrix()
+    population.set_traits(ids.tolist(), np.clip(traits + 5, 0, 100))
+    for data in fixtures():
+        record = population.record(data["basic_info"]["id"])
+        expected = min(100, data["personality_and_psychology"]["risk_taking_scale"] + 5)
+        assert record["personality_and_psychology"]["risk_taking_scale"] == expected
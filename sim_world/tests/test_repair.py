@@ -0,0 +1,147 @@
+"""
+Local schema repair of the characters/*.json fixtures after the kinds of
+damage seen in LLM output and older files.
+"""
+
+import copy
+import glob
+import json
+import os
+
+import pytest
+
+import repair
+from Character import Character
+
+SIM_WORLD = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = sorted(glob.glob(os.path.join(SIM_WORLD, "characters", "*.json")))
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def repaired(data):
+    result = repair.repair(Character, data)
+    assert result.value is not None, result.errors
+    return result.value.model_dump(mode="json")
+
+
+@pytest.fixture(params=FIXTURES, ids=os.path.basename)
+def character(request):
+    return load(request.param)
+
+
+def test_valid_fixture_is_unchanged(character):
+    result = repair.repair(Character, character)
+    assert result.changes == []
+    expected = Character.model_validate(character).model_dump(mode="json")
+    assert result.value.model_dump(mode="json") == expected
+
+
+def test_scales_numbers_and_enums(character):
+    expected = Character.model_validate(character).model_dump(mode="json")
+    damaged = copy.deepcopy(character)
+    damaged["personality_and_psychology"]["risk_taking_scale"] = 140
+    damaged["skills_and_abilities"]["patience"] = "55"
+    damaged["basic_info"]["age"] = f"{character['basic_info']['age']} years"
+    damaged["basic_info"]["gender"] = character["basic_info"]["gender"].upper()
+    fixed = repaired(damaged)
+    assert fixed["personality_and_psychology"]["risk_taking_scale"] == 100
+    assert fixed["skills_and_abilities"]["patience"] == 55
+    assert fixed["basic_info"] == expected["basic_info"]
+
+
+def test_legacy_names_and_missing_lists(character):
+    damaged = copy.deepcopy(character)
+    damaged["events"] = damaged.pop("events_latest_10")
+    del damaged["highlight_3_max"]
+    expected = Character.model_validate(character).model_dump(mode="json")
+    fixed = repaired(damaged)
+    assert fixed["events_latest_10"] == expected["events_latest_10"]
+    assert fixed["highlight_3_max"] == []
+
+
+def test_dates_and_times_of_events(character):
+    damaged = copy.deepcopy(character)
+    damaged["lowlight_3_max"] = [
+        {
+            "id_of_character_involved": [character["basic_info"]["id"]],
+            "date": "March 2, 2024",
+            "start_time": "9:30 pm",
+            "description": "missed the bus",
+        }
+    ]
+    (event,) = repaired(damaged)["lowlight_3_max"]
+    assert (event["date"], event["start_time"]) == ("2024-03-02", "21:30")
+
+
+def fixture_1(experiences):
+    data = load(os.path.join(SIM_WORLD, "characters", "1.json"))
+    data["experiences"] = experiences
+    # something else to repair, so the repair walks the whole document
+    data["preferences"]["pet_preference"] = None
+    return data
+
+
+def test_empty_experiences():
+    fixed = repaired(fixture_1([]))
+    assert fixed["experiences"] == []
+    assert fixed["preferences"]["pet_preference"] == ""
+
+
+def test_experience_is_repaired():
+    experience = {"type": "work", "start_date": "2020/01/05", "description": 3}
+    (fixed,) = repaired(fixture_1([experience]))["experiences"]
+    assert (fixed["start_date"], fixed["description"]) == ("2020-01-05", "3")
+
+
+@pytest.mark.parametrize("experience", [{}, None, "x"])
+def test_experience_without_a_default_is_left_for_the_llm(experience):
+    assert repair.repair(Character, fixture_1([experience])).value is None
+
+
+def test_identity_is_never_made_up(character):
+    damaged = copy.deepcopy(character)
+    del damaged["basic_info"]["name"]
+    result = repair.repair(Character, damaged)
+    assert result.value is None
+    assert "name" not in result.data["basic_info"]
+
+
+def test_missing_id_comes_from_the_store(character):
+    damaged = copy.deepcopy(character)
+    character_id = damaged["basic_info"].pop("id")
+    fixed = Character.repair_locally(character_id, json.dumps(damaged))
+    assert fixed is not None and fixed.basic_info.id == character_id
+
+
+def test_repair_does_not_modify_its_input(character):
+    damaged = copy.deepcopy(character)
+    damaged["skills_and_abilities"]["patience"] = "55"
+    before = copy.deepcopy(damaged)
+    repaired(damaged)
+    assert damaged == before
+
+
+def test_only_successful_repairs_are_counted(character, monkeypatch):
+    monkeypatch.setattr(repair, "repair_stats", repair.Counter())
+    monkeypatch.setattr(repair, "repair_failures", repair.Counter())
+    damaged = copy.deepcopy(character)
+    damaged["skills_and_abilities"]["patience"] = "55 points"
+    repaired(damaged)
+    assert repair.get_repair_stats() == {"coerce": 1}
+
+    damaged["skills_and_abilities"]["patience"] = "a lot"
+    damaged["lowlight_3_max"] = [
+        {
+            "id_of_character_involved": [character["basic_info"]["id"]],
+            "date": "someday",
+            "start_time": "9:30 pm",
+            "description": "missed the bus",
+        }
+    ]
+    assert repair.repair(Character, damaged).value is None
+    # the time was fixed, but the document was not repaired
+    assert repair.get_repair_stats() == {"coerce": 1, "failed.coerce": 1, "failed.date": 1}
@@ -0,0 +1,60 @@
+"""
+Store is abstract, and a batch writes its saves together once it exits.
+"""
+
+import asyncio
+
+import pytest
+
+from storage import Store
+
+
+class MemoryStore(Store):
+    def __init__(self):
+        self.characters = {}
+        self.world = None
+        self.writes = 0
+
+    def _write(self, characters, world):
+        self.writes += 1
+        self.characters.update({i: data for i, (_, data) in characters.items()})
+        if world is not None:
+            self.world = world
+
+    def _read_character(self, character_id):
+        return self.characters.get(character_id)
+
+    def _read_all_raw_characters(self):
+        return {}
+
+    def _read_world(self):
+        return self.world
+
+
+def test_store_is_abstract():
+    with pytest.raises(TypeError):
+        Store()
+
+    class Partial(Store):
+        def _write(self, characters, world):
+            pass
+
+    with pytest.raises(TypeError, match="_read_world"):
+        Partial()
+
+
+def test_batch_writes_once():
+    store = MemoryStore()
+
+    async def run():
+        async with store.batch():
+            store.save_characters({1: ("Paris", {"n": 1}), 2: ("Rome", {"n": 2})})
+            store.save_character(1, "Paris", {"n": 3})
+            store.save_world({"date": "2024-03-01"})
+            assert store.writes == 0
+            assert store.load_character(1) == {"n": 3}
+
+    asyncio.run(run())
+    assert store.writes == 1
+    assert store.characters == {1: {"n": 3}, 2: {"n": 2}}
+    assert store.world == {"date": "2024-03-01"}
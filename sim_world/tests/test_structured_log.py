@@ -0,0 +1,52 @@
+"""
+Records are written by a listener thread between start_logging and
+stop_logging, and by the logging thread outside.
+"""
+
+import json
+import logging
+import threading
+
+import structured_log
+
+log = structured_log.get_logger("test")
+
+
+def lines(handler):
+    handler.flush()
+    with open(handler.baseFilename) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_listener_runs_between_start_and_stop(monkeypatch):
+    root = logging.getLogger("sim")
+    handlers = structured_log._handlers()
+    file_handler = handlers[0]
+    log.info("before start")
+    assert lines(file_handler)[-1]["msg"] == "before start"
+
+    structured_log.start_logging()
+    try:
+        listener, queue_handler = structured_log._started
+        assert queue_handler in root.handlers
+        assert not set(handlers) & set(root.handlers)
+        # started once
+        structured_log.start_logging()
+        assert structured_log._started[0] is listener
+        written = []
+        emit = file_handler.emit
+        monkeypatch.setattr(
+            file_handler,
+            "emit",
+            lambda record: written.append(threading.get_ident()) or emit(record),
+        )
+        log.info("while started", n=1)
+    finally:
+        structured_log.stop_logging()
+    # what was queued is written by the time stop_logging returns
+    assert written and written[0] != threading.get_ident()
+    assert lines(file_handler)[-1]["msg"] == "while started"
+    assert set(handlers) <= set(root.handlers)
+    assert queue_handler not in root.handlers
+    log.info("after stop")
+    assert lines(file_handler)[-1]["msg"] == "after stop"
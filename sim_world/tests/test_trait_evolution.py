@@ -0,0 +1,76 @@
+"""
+A day of trait drift is saved in one store write, logged, and sent to
+websocket clients in one batch message.
+"""
+
+import asyncio
+import json
+
+import pytest
+
+import World as world_module
+from benchmarks.load_characters import write_population
+from Character import Character
+from event_log import EventLog
+from storage import get_store
+from websocket_service import Broadcaster, EntityVersions
+
+DATE = "2024-03-02"
+
+
+class FakeConnection:
+    def __init__(self, *ids):
+        self.subscriptions = {"Character": set(ids)}
+        self.texts = []
+
+    def subscribed(self, updated_type, updated_id):
+        return updated_id in self.subscriptions.get(updated_type, ())
+
+    def offer(self, text, key=None):
+        self.texts.append(text)
+        return True
+
+
+@pytest.fixture
+def history(tmp_path, monkeypatch):
+    write_population(str(tmp_path), 20)
+    monkeypatch.chdir(tmp_path)
+    asyncio.run(Character.reload())
+    history = EventLog(str(tmp_path / "event_log"))
+    monkeypatch.setattr(world_module, "get_event_log", lambda: history)
+    yield history
+    history.close()
+
+
+def test_drift_is_saved_logged_and_sent_once(history, monkeypatch):
+    store = get_store()
+    writes = []
+    write = store._write
+    monkeypatch.setattr(store, "_write", lambda c, w: writes.append(sorted(c)) or write(c, w))
+    broadcaster = Broadcaster()
+    subscriber, other = FakeConnection(1, 2, 3), FakeConnection(999)
+    broadcaster.connections = {"a": subscriber, "b": other}
+    monkeypatch.setattr("websocket_service.broadcaster", broadcaster)
+    monkeypatch.setattr("websocket_service.entity_versions", EntityVersions())
+    world = world_module.World(date="2024-03-01", events=[], weathers=[])
+
+    async def run():
+        async with history.transaction():
+            return await world.evolve_traits(DATE)
+
+    changed = asyncio.run(run())
+    assert changed > 0
+    # one write of every changed character
+    assert len(writes) == 1 and len(writes[0]) == changed
+    records = history.query(kind="character", date_from=DATE, limit=1000)["records"]
+    assert len(records) == changed
+    (text,) = subscriber.texts
+    batch = json.loads(text)
+    assert batch["event"] == "batch"
+    assert {m["updated_id"] for m in batch["messages"]} <= {1, 2, 3}
+    assert other.texts == []
+    for record in records:
+        saved = get_store().load_character(record["data"]["id"])
+        for op in record["data"]["ops"]:
+            section, field = op["path"].strip("/").split("/")
+            assert saved[section][field] == op["value"]
@@ -0,0 +1,68 @@
+"""
+Versions and patches of the entities sent to websocket clients.
+"""
+
+import websocket_service
+from websocket_service import EntityVersions, handle_client_message
+
+
+def character(name):
+    return {"basic_info": {"name": name}}
+
+
+def test_patch_against_the_previous_version():
+    versions = EntityVersions()
+    first = versions.publish("Character", 1, character("B"), previous=character("A"))
+    assert first["event"] == "patch"
+    assert (first["base_version"], first["version"]) == (0, 1)
+    assert first["ops"] == [{"op": "replace", "path": "/basic_info/name", "value": "B"}]
+    # nothing changed, nothing to send
+    assert versions.publish("Character", 1, character("B"), previous=character("B")) is None
+    assert versions.publish("Character", 1, character("C"))["event"] == "snapshot"
+    assert versions.version("Character", 1) == 2
+
+
+def test_versions_are_bounded_and_never_go_back():
+    versions = EntityVersions(max_versions=2)
+    versions.publish("World", None, {"date": "2024-03-01"})
+    for _ in range(3):
+        versions.publish("Character", 1, character("A"))
+    versions.publish("Character", 2, character("A"))
+    versions.publish("Character", 3, character("A"))
+    # 1 was forgotten at version 3, the world is always kept
+    assert len(versions._versions) == 3
+    assert versions.version("World", None) == 1
+    assert versions.versions_of("Character", [1, 2, 3, 4]) == {1: 3, 2: 1, 3: 1, 4: 3}
+    message = versions.publish("Character", 1, character("B"), previous=character("A"))
+    assert (message["base_version"], message["version"]) == (3, 4)
+    assert versions.init_message(lambda: None)["version"] == 1
+
+
+class FakeConnection:
+    def __init__(self):
+        self.subscriptions = {}
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+
+def test_subscriptions_take_ids_as_ints(monkeypatch):
+    versions = EntityVersions()
+    versions.register_loader("Character", lambda character_id: {"id": character_id})
+    versions.publish("Character", 3, character("A"))
+    monkeypatch.setattr(websocket_service, "entity_versions", versions)
+    connection = FakeConnection()
+    ids = ["3", 4, "x", True, None, 2.5]
+    handle_client_message(
+        connection, {"event": "subscribe", "updated_type": "Character", "updated_ids": ids}
+    )
+    assert connection.subscriptions == {"Character": {3, 4}}
+    assert connection.sent[-1]["versions"] == {3: 1, 4: 0}
+    handle_client_message(
+        connection, {"event": "resync", "updated_type": "Character", "updated_id": "3"}
+    )
+    assert connection.sent[-1]["updated_id"] == 3 and connection.sent[-1]["version"] == 1
+    message = {"event": "unsubscribe", "updated_type": "Character", "updated_ids": [3, "4"]}
+    handle_client_message(connection, message)
+    assert connection.subscriptions == {"Character": set()}
@@ -0,0 +1,112 @@
+"""
+Leases of the SQLite work queue, and the coordinator giving up on a day
+nobody works on.
+"""
+
+import asyncio
+import time
+
+import pytest
+
+import workers
+from workers import Coordinator, WorkQueue, WorkStalledError
+
+DAY = "2024-03-01"
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return WorkQueue(str(tmp_path / "work_queue.db"), lease_seconds=0.05, max_attempts=2)
+
+
+def test_expired_lease_is_leased_again(queue):
+    item_id = queue.put(DAY, {"n": 1})
+    assert queue.lease("a") == [(item_id, {"n": 1})]
+    # leased, nobody else gets it
+    assert queue.lease("b") == []
+    time.sleep(0.1)
+    assert queue.lease("b") == [(item_id, {"n": 1})]
+    # a lost lease cannot be renewed, finished or given back
+    assert not queue.renew(item_id, "a")
+    assert not queue.complete(item_id, "a", {"late": True})
+    assert not queue.fail(item_id, "a", "late")
+    assert queue.complete(item_id, "b", {"ok": True})
+    assert queue.finished([item_id]) == {item_id: ({"ok": True}, None)}
+
+
+def test_item_fails_after_max_attempts(queue):
+    item_id = queue.put(DAY, {})
+    queue.lease("a")
+    time.sleep(0.1)
+    queue.lease("b")
+    time.sleep(0.1)
+    # the second lease ran out as well, nobody gets a third attempt
+    assert queue.lease("c") == []
+    assert queue.finished([item_id]) == {item_id: (None, "lease expired 2 times")}
+
+
+def test_failed_attempts_are_given_back_until_max_attempts(queue):
+    item_id = queue.put(DAY, {})
+    queue.lease("a")
+    assert queue.fail(item_id, "a", "ValueError: bad JSON")
+    assert queue.finished([item_id]) == {}
+    assert queue.lease("b") == [(item_id, {})]
+    assert queue.fail(item_id, "b", "ValueError: bad JSON")
+    assert queue.finished([item_id]) == {item_id: (None, "ValueError: bad JSON")}
+    assert queue.counts() == {"failed": 1}
+
+
+def test_results_in_order_from_a_worker(queue):
+    queue.lease_seconds = 5
+
+    async def handler(payload):
+        # later items finish first
+        await asyncio.sleep(0.01 * (3 - payload["n"]))
+        return {"n": payload["n"]}
+
+    async def main():
+        coordinator = Coordinator(DAY, queue, stall_seconds=5)
+        worker = asyncio.create_task(
+            workers.run_worker(queue, "w", concurrency=3, handler=handler)
+        )
+        try:
+            item_ids = [await coordinator.submit({"n": n}) for n in range(3)]
+            return [result async for _, result, _ in coordinator.results(item_ids)]
+        finally:
+            worker.cancel()
+
+    assert asyncio.run(main()) == [{"n": 0}, {"n": 1}, {"n": 2}]
+    # yielded items are removed
+    assert queue.counts() == {}
+
+
+def test_day_fails_when_no_worker_makes_progress(queue):
+    async def main():
+        coordinator = Coordinator(DAY, queue, stall_seconds=0.1)
+        item_ids = [await coordinator.submit({"n": n}) for n in range(2)]
+        async for _ in coordinator.results(item_ids):
+            pass
+
+    with pytest.raises(WorkStalledError, match="2 work items"):
+        asyncio.run(main())
+    # nothing is left for the next run
+    assert queue.counts() == {}
+
+
+def test_slow_worker_holding_a_lease_is_not_a_stall(queue):
+    queue.lease_seconds = 5
+
+    async def handler(payload):
+        await asyncio.sleep(0.3)
+        return {"done": True}
+
+    async def main():
+        coordinator = Coordinator(DAY, queue, stall_seconds=0.1)
+        worker = asyncio.create_task(workers.run_worker(queue, "w", handler=handler))
+        try:
+            item_ids = [await coordinator.submit({})]
+            return [result async for _, result, _ in coordinator.results(item_ids)]
+        finally:
+            worker.cancel()
+
+    assert asyncio.run(main()) == [{"done": True}]
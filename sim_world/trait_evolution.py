@@ -0,0 +1,90 @@
+"""
+Daily drift of the 0-100 scales of every character, computed locally.
+
+Each character draws how much it changes today, with the distribution the
+process_event prompt used to ask the model for:
+
+    significant 1.5%, moderate 4.5%, slight 74%, none 20%
+
+and a random subset of its scales moves by up to the step of that level.
+The whole population is one (characters, scales) int matrix, straight
+from the columns of the population table, and the random generator is
+seeded with SIM_TRAIT_SEED and the date, so a day evolves the same way
+however often it is replayed.
+"""
+
+import functools
+import os
+from typing import Tuple
+
+import annotated_types
+import numpy as np
+
+SIM_TRAIT_SEED = int(os.getenv("SIM_TRAIT_SEED", "0"))
+# fraction of the scales of a changing character that move on a given day
+TRAIT_CHANGE_FRACTION = float(os.getenv("TRAIT_CHANGE_FRACTION", "0.25"))
+SCALE_MIN, SCALE_MAX = 0, 100
+
+# (level, probability, maximum step)
+CHANGE_LEVELS: Tuple[Tuple[str, float, int], ...] = (
+    ("significant", 0.015, 15),
+    ("moderate", 0.045, 6),
+    ("slight", 0.74, 2),
+    ("none", 0.20, 0),
+)
+SECTIONS = ("personality_and_psychology", "skills_and_abilities")
+
+
+@functools.lru_cache(maxsize=1)
+def trait_fields() -> Tuple[Tuple[str, str], ...]:
+    """
+    (section, field) of every bounded scale of a Character, in a fixed order.
+    """
+    from Character import Character
+
+    fields = []
+    for section in SECTIONS:
+        model = Character.model_fields[section].annotation
+        for name, field in model.model_fields.items():
+            bounds = [
+                c for c in field.metadata if isinstance(c, (annotated_types.Ge, annotated_types.Le))
+            ]
+            if len(bounds) == 2:
+                fields.append((section, name))
+    return tuple(fields)
+
+
+def rng_for(date: str, seed: int = SIM_TRAIT_SEED) -> np.random.Generator:
+    return np.random.default_rng([seed, int(date.replace("-", ""))])
+
+
+def evolve(traits: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    """
+    One day of drift for a (characters, scales) matrix.
+    """
+    n, k = traits.shape
+    probabilities = [p for _, p, _ in CHANGE_LEVELS]
+    steps = np.array([step for _, _, step in CHANGE_LEVELS])
+    level = rng.choice(len(CHANGE_LEVELS), size=n, p=probabilities)
+    step = steps[level][:, None]
+    # uniform in [-step, step] per scale, then keep only some of the scales
+    deltas = np.floor(rng.random((n, k)) * (2 * step + 1)).astype(traits.dtype) - step
+    deltas *= rng.random((n, k)) < TRAIT_CHANGE_FRACTION
+    return np.clip(traits + deltas, SCALE_MIN, SCALE_MAX)
+
+
+def evolve_population(population, date: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    One day of drift over a population.Population, without changing it.
+
+    Returns:
+        (ids, before, after) of the characters whose scales changed, the
+        scales as rows of trait_fields() order.
+    """
+    ids, traits = population.trait_matrix()
+    # sorted by id, so that the same seed gives the same result in any row order
+    order = np.argsort(ids, kind="stable")
+    ids, traits = ids[order], traits[order]
+    evolved = evolve(traits, rng_for(date))
+    changed = (evolved != traits).any(axis=1)
+    return ids[changed], traits[changed], evolved[changed]
@@ -1,30 +1,196 @@
 import json
 import re
+import sys
 
+ANSWER_BLOCK = re.compile(r"<answer>(.*?)(?:</answer>|$)", re.S)
+_STRUCTURAL = re.compile(r'[{}"]')
+_STRING_END = re.compile(r'["\\]')
 
-def extract_longest_json(text):
-    try:
-        # Find all potential JSON strings (enclosed in curly braces)
-        json_pattern = r"{[^{}]*(?:{[^{}]*}[^{}]*)*}"
-        matches = re.finditer(json_pattern, text)
 
-        # Store valid JSON strings and their lengths
-        valid_jsons = []
+def _object_spans(text, pos=0, end=None):
+    """
+    Yield (start, end, depth, inner) of every top-level balanced {...} in
+    text[pos:end], depth being how many objects are nested in each other there
+    and inner the same tuples for the objects directly nested in it.
+
+    Single pass, braces inside JSON strings and escaped quotes are skipped.
+    Quotes outside of braces are prose and ignored. If the text ends inside an
+    object, the closed objects nested in it are yielded instead.
+    """
+    end = len(text) if end is None else end
+    # one (start, inner) per open brace
+    stack = []
+    while pos < end:
+        if not stack:
+            start = text.find("{", pos, end)
+            if start < 0:
+                return
+            stack.append((start, []))
+            pos = start + 1
+            continue
+        match = _STRUCTURAL.search(text, pos, end)
+        if match is None:
+            break
+        char = match.group()
+        pos = match.end()
+        if char == '"':
+            while True:
+                match = _STRING_END.search(text, pos, end)
+                if match is None:
+                    pos = end
+                    break
+                pos = match.end()
+                if match.group() == '"':
+                    break
+                # skip the escaped character
+                pos += 1
+        elif char == "{":
+            stack.append((pos - 1, []))
+        else:
+            start, inner = stack.pop()
+            depth = 1 + max((span[2] for span in inner), default=0)
+            if stack:
+                stack[-1][1].append((start, pos, depth, inner))
+            else:
+                yield start, pos, depth, inner
+    # never closed, in text order the objects of an outer level come first
+    for _, inner in stack:
+        yield from inner
 
-        for match in matches:
-            potential_json = match.group()
+
+def iter_json_objects(text, pos=0, end=None):
+    """
+    Yield (json_str, parsed) for every top-level JSON object in text[pos:end].
+    When a candidate is not valid JSON or never closed, the objects nested in it
+    are tried, each object is parsed at most once.
+    """
+    # json.loads recurses once per level, deeper objects cannot be parsed
+    max_depth = sys.getrecursionlimit()
+    for span in _object_spans(text, pos, end):
+        todo = [span]
+        while todo:
+            start, stop, depth, inner = todo.pop()
+            if depth >= max_depth:
+                todo.extend(reversed(inner))
+                continue
+            candidate = text[start:stop]
             try:
-                # Try to parse the string as JSON
-                parsed = json.loads(potential_json)
-                valid_jsons.append((potential_json, len(potential_json)))
-            except json.JSONDecodeError:
+                parsed = json.loads(candidate)
+            except (json.JSONDecodeError, RecursionError):
+                todo.extend(reversed(inner))
                 continue
+            yield candidate, parsed
 
-        # Return the longest valid JSON string, or None if none found
-        if valid_jsons:
-            return max(valid_jsons, key=lambda x: x[1])[0]
-        return None
 
-    except Exception as e:
-        print(f"Error: {e}")
+def extract_longest_json(text):
+    """
+    Return the longest JSON object in text, or None if there is none.
+    Objects inside <answer> blocks win over the rest of the text.
+    """
+    if not text:
         return None
+    regions = [match.span(1) for match in ANSWER_BLOCK.finditer(text)]
+    for start, end in regions + [(0, len(text))]:
+        longest = max(
+            (candidate for candidate, _ in iter_json_objects(text, start, end)),
+            key=len,
+            default=None,
+        )
+        if longest is not None:
+            return longest
+    return None
+
+
+class IncrementalJsonParser:
+    """
+    Feed a streamed completion chunk by chunk and get back every object of the
+    arrays in keys as soon as it is closed, e.g. each event of
+    {"weathers": [...], "events": [{...}, {...}]}.
+
+    Only the content after the first <answer> tag is scanned, since the thinking
+    before it may contain braces too.
+    """
+
+    ANSWER_TAG = "<answer>"
+
+    def __init__(self, keys):
+        self.keys = set(keys)
+        self._pending = ""
+        self._started = False
+        self._done = False
+        # container stack, each entry is (bracket, key the container is the value of)
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._string = []
+        self._last_string = None
+        self._capture = None
+
+    def feed(self, chunk: str):
+        """
+        Returns:
+            List[Tuple[str, Any]]: (key, object) for each object closed in this chunk.
+        """
+        if self._done:
+            return []
+        if not self._started:
+            self._pending += chunk
+            index = self._pending.find(self.ANSWER_TAG)
+            if index < 0:
+                # keep enough to find a tag split across chunks
+                self._pending = self._pending[-len(self.ANSWER_TAG) :]
+                return []
+            self._started = True
+            chunk = self._pending[index + len(self.ANSWER_TAG) :]
+            self._pending = ""
+
+        found = []
+        for char in chunk:
+            if self._capture is not None:
+                self._capture.append(char)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    self._last_string = "".join(self._string)
+                else:
+                    self._string.append(char)
+                continue
+            if not self._stack and char != "{":
+                # text around the answer object, e.g. a ```json fence
+                continue
+
+            if char == '"':
+                self._in_string = True
+                self._string = []
+            elif char in "{[":
+                key = self._last_string if self._stack and self._stack[-1][0] == "{" else None
+                if (
+                    char == "{"
+                    and len(self._stack) == 2
+                    and self._stack[-1][0] == "["
+                    and self._stack[-1][1] in self.keys
+                ):
+                    self._capture = [char]
+                self._stack.append((char, key))
+                self._last_string = None
+            elif char in "}]":
+                if not self._stack:
+                    continue
+                self._stack.pop()
+                if self._capture is not None and len(self._stack) == 2:
+                    text = "".join(self._capture)
+                    self._capture = None
+                    try:
+                        found.append((self._stack[-1][1], json.loads(text)))
+                    except json.JSONDecodeError:
+                        pass
+                if not self._stack:
+                    self._done = True
+                    break
+            elif char == ",":
+                self._last_string = None
+        return found
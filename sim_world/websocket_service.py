@@ -1,30 +1,456 @@
 import asyncio
-from typing import Any, List, Literal
+import json
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, Iterable, List, Literal, Optional, Set, Tuple
 from fastapi import WebSocket
+import json_patch
+from structured_log import get_logger
+import metrics
 
-# Store WebSocket clients
-clients: List[WebSocket] = []
+log = get_logger("websocket_service")
+
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", "256"))
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+# versions of subscribed entities kept, least recently published first out
+WS_ENTITY_VERSIONS = int(os.getenv("WS_ENTITY_VERSIONS", "10000"))
+# what to do with a client whose queue is full:
+# drop:     disconnect it, it can reconnect and get a fresh init
+# coalesce: replace its pending update of the same entity, or its oldest message
+WS_SLOW_CLIENT_POLICY: Literal["drop", "coalesce"] = os.getenv(
+    "WS_SLOW_CLIENT_POLICY", "coalesce"
+)
+
+
+class ClientConnection:
+    """
+    One websocket with its own bounded send queue, drained by a writer task,
+    so a slow client only ever delays itself.
+
+    Updates of EntityVersions.SUBSCRIBED_TYPES are only sent for the entities
+    the client subscribed to, see handle_client_message.
+    """
+
+    def __init__(self, websocket: WebSocket, broadcaster: "Broadcaster"):
+        self.websocket = websocket
+        self.broadcaster = broadcaster
+        self.subscriptions: Dict[str, Set[Any]] = {}
+        # (coalescing key, serialized message)
+        self.queue: Deque[Tuple[Optional[str], str]] = deque()
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+        self._wakeup = asyncio.Event()
+        self._writer_task = asyncio.create_task(self._writer())
+
+    def offer(self, text: str, key: Optional[str] = None) -> bool:
+        """
+        Queue a serialized message without waiting.
+
+        Returns:
+            bool: False if the client is closed or was disconnected for being slow.
+        """
+        if self.closed:
+            return False
+        if len(self.queue) >= WS_QUEUE_SIZE:
+            if WS_SLOW_CLIENT_POLICY == "drop":
+                self.broadcaster.slow_disconnects += 1
+                self.close()
+                return False
+            self.dropped += 1
+            self.broadcaster.dropped += 1
+            if key is not None:
+                for i, (pending_key, _) in enumerate(self.queue):
+                    if pending_key == key:
+                        # the newer update of the same entity supersedes the pending one
+                        self.queue[i] = (key, text)
+                        return True
+            self.queue.popleft()
+        self.queue.append((key, text))
+        self._wakeup.set()
+        return True
+
+    def subscribed(self, updated_type: str, updated_id: Any) -> bool:
+        return updated_id in self.subscriptions.get(updated_type, ())
+
+    def send(self, message: Dict[str, Any]) -> bool:
+        return self.offer(json.dumps(message, separators=(",", ":")))
+
+    async def _writer(self) -> None:
+        while not self.closed:
+            if not self.queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            _, text = self.queue.popleft()
+            try:
+                await asyncio.wait_for(self.websocket.send_text(text), WS_SEND_TIMEOUT)
+                self.sent += 1
+            except Exception as e:
+                log.warning(f"Client #{id(self.websocket)} send failed: {e}")
+                self.close()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.clear()
+        self._wakeup.set()
+        self.broadcaster.unregister(self.websocket)
+        asyncio.create_task(self._close_socket())
+
+    async def _close_socket(self) -> None:
+        try:
+            # 1013: try again later
+            await self.websocket.close(code=1013)
+        except Exception:
+            pass
+
+
+class Broadcaster:
+    """
+    Fan-out to every connected client. A message is serialized once and put
+    into each client's queue, broadcasting never waits on a socket.
+    """
+
+    def __init__(self):
+        self.connections: Dict[WebSocket, ClientConnection] = {}
+        self.broadcasts = 0
+        self.dropped = 0
+        self.slow_disconnects = 0
+
+    def register(self, websocket: WebSocket) -> ClientConnection:
+        connection = ClientConnection(websocket, self)
+        self.connections[websocket] = connection
+        return connection
+
+    def unregister(self, websocket: WebSocket) -> None:
+        connection = self.connections.pop(websocket, None)
+        if connection is not None and not connection.closed:
+            connection.close()
+
+    def broadcast(
+        self,
+        message: Dict[str, Any],
+        key: Optional[str] = None,
+        entity: Optional[Tuple[str, Any]] = None,
+    ) -> int:
+        """
+        entity (type, id): only clients subscribed to it get the message.
+
+        Returns:
+            int: number of clients the message was queued for.
+        """
+        self.broadcasts += 1
+        connections = [
+            connection
+            for connection in self.connections.values()
+            if entity is None or connection.subscribed(*entity)
+        ]
+        if not connections:
+            return 0
+        text = json.dumps(message, separators=(",", ":"))
+        queued = 0
+        for connection in connections:
+            queued += connection.offer(text, key)
+        return queued
+
+    def broadcast_batch(self, messages: List[Tuple[Dict[str, Any], Tuple[str, Any]]]) -> int:
+        """
+        (message, entity) pairs as one {"event": "batch", "messages": [...]}
+        per client, holding the messages of the entities it subscribed to.
+        Each message is serialized once.
+
+        Returns:
+            int: number of clients the batch was queued for.
+        """
+        self.broadcasts += 1
+        if not self.connections or not messages:
+            return 0
+        texts = [(json.dumps(m, separators=(",", ":")), entity) for m, entity in messages]
+        queued = 0
+        for connection in list(self.connections.values()):
+            parts = [text for text, entity in texts if connection.subscribed(*entity)]
+            if parts:
+                queued += connection.offer('{"event":"batch","messages":[' + ",".join(parts) + "]}")
+        return queued
+
+    def metrics(self) -> Dict[str, Any]:
+        depths = [len(c.queue) for c in self.connections.values()]
+        return {
+            "clients": len(depths),
+            "queue_depth_total": sum(depths),
+            "queue_depth_max": max(depths, default=0),
+            "broadcasts": self.broadcasts,
+            "dropped_messages": self.dropped,
+            "slow_client_disconnects": self.slow_disconnects,
+            "policy": WS_SLOW_CLIENT_POLICY,
+        }
+
+
+broadcaster = Broadcaster()
+
+
+class EntityVersions:
+    """
+    Version of every entity, so that updates can be sent as JSON Patch diffs
+    against the previous version.
+
+    Clients apply a patch only if its base_version is the version they hold,
+    otherwise they ask for a resync and get a snapshot. Versions restart with
+    the process, the epoch in the init message tells clients when that happened.
+
+    The last state is only kept for the few entities of SNAPSHOT_TYPES. For
+    the others, e.g. the whole population of characters, the publisher passes
+    the previous state or the patch itself, and resyncs read the current state
+    through the loader registered for the type. Clients only get the versions
+    and updates of those they subscribe to.
+
+    Only the max_versions most recently published of those are remembered.
+    A forgotten entity continues from the highest version forgotten so far,
+    so its versions never go back and a client holding an older one resyncs.
+
+    Values are in JSON form, model_dump(mode="json"), so that diffs compare
+    what clients hold.
+    """
+
+    SNAPSHOT_TYPES = ("World", "Weather")
+    SUBSCRIBED_TYPES = ("Character",)
+
+    def __init__(self, max_versions: int = WS_ENTITY_VERSIONS):
+        self.epoch = int(time.time() * 1000)
+        self.max_versions = max_versions
+        self._snapshots: Dict[Tuple[str, Any], Any] = {}
+        self._versions: "OrderedDict[Tuple[str, Any], int]" = OrderedDict()
+        # the highest version forgotten, the base of every entity not remembered
+        self._forgotten = 0
+        self._loaders: Dict[str, Callable[[Any], Any]] = {}
+
+    def register_loader(self, updated_type: str, load: Callable[[Any], Any]) -> None:
+        """
+        load(id) returns the current state of an entity of updated_type, or None.
+        """
+        self._loaders[updated_type] = load
+
+    def version(self, updated_type: str, updated_id: Any) -> int:
+        return self._versions.get((updated_type, updated_id), self._forgotten)
+
+    def versions_of(self, updated_type: str, ids: Iterable[Any]) -> Dict[Any, int]:
+        return {entity_id: self.version(updated_type, entity_id) for entity_id in ids}
+
+    def publish(
+        self,
+        updated_type: str,
+        updated_id: Any,
+        value: Any,
+        previous: Any = None,
+        ops: Optional[List[Dict[str, Any]]] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Record a new state. previous or ops, the patch from previous to value,
+        are used where no snapshot is kept.
+
+        Returns:
+            The message to broadcast: a patch against the previous version, a
+            snapshot if there is nothing to diff against, or None if nothing
+            changed.
+        """
+        key = (updated_type, updated_id)
+        keep = updated_type in self.SNAPSHOT_TYPES
+        if keep:
+            previous = self._snapshots.get(key)
+        if ops is None and previous is not None:
+            ops = json_patch.diff(previous, value)
+        if ops is not None and not ops:
+            return None
+        version = self.version(updated_type, updated_id) + 1
+        self._versions[key] = version
+        self._versions.move_to_end(key)
+        if keep:
+            self._snapshots[key] = value
+        self._forget()
+        if ops is None:
+            return self._snapshot_message(updated_type, updated_id, version, value)
+        return {
+            "event": "patch",
+            "updated_type": updated_type,
+            "updated_id": updated_id,
+            "base_version": version - 1,
+            "version": version,
+            "ops": ops,
+        }
+
+    def _forget(self) -> None:
+        while len(self._versions) > self.max_versions + len(self._snapshots):
+            key, version = self._versions.popitem(last=False)
+            if key in self._snapshots:
+                # the few entities with a snapshot are always remembered
+                self._versions[key] = version
+            else:
+                self._forgotten = max(self._forgotten, version)
+
+    @staticmethod
+    def _snapshot_message(
+        updated_type: str, updated_id: Any, version: int, value: Any
+    ) -> Dict[str, Any]:
+        return {
+            "event": "snapshot",
+            "updated_type": updated_type,
+            "updated_id": updated_id,
+            "version": version,
+            "updated_value": value,
+        }
+
+    def snapshot(self, updated_type: str, updated_id: Any) -> Optional[Dict[str, Any]]:
+        key = (updated_type, updated_id)
+        if key in self._snapshots:
+            value = self._snapshots[key]
+        elif updated_type in self._loaders:
+            try:
+                value = self._loaders[updated_type](updated_id)
+            except (TypeError, ValueError):
+                value = None
+        else:
+            value = None
+        if value is None:
+            return None
+        return self._snapshot_message(updated_type, updated_id, self.version(*key), value)
+
+    def init_message(self, load_world: Callable[[], Any]) -> Dict[str, Any]:
+        """
+        The world as a snapshot with its version, and the versions of today's
+        weathers. load_world is only called before the first publish of the
+        world. Versions of characters come with a subscription, clients fetch
+        the characters through /char/{id} or a resync.
+        """
+        if ("World", None) not in self._snapshots:
+            self.publish("World", None, load_world())
+        weather_ids = [
+            entity_id for entity_type, entity_id in self._snapshots if entity_type == "Weather"
+        ]
+        return {
+            "event": "init",
+            "epoch": self.epoch,
+            "version": self.version("World", None),
+            "world": self._snapshots[("World", None)],
+            "versions": {"Weather": self.versions_of("Weather", weather_ids)},
+        }
+
+
+entity_versions = EntityVersions()
+
+
+def handle_client_message(connection: ClientConnection, message: Dict[str, Any]) -> None:
+    """
+    {"event": "resync", "updated_type": "Character", "updated_id": 3} answers
+    with a snapshot of that entity, without updated_type the world is sent.
+
+    {"event": "subscribe", "updated_type": "Character", "updated_ids": [3, 4]}
+    answers with {"event": "versions", ...} of those, and their updates are
+    sent from then on, until an "unsubscribe" with the same fields. Updates
+    of many characters at once, e.g. the daily trait drift, come as one
+    {"event": "batch", "messages": [...]} of those patches.
+    """
+    if message.get("event") in ("subscribe", "unsubscribe"):
+        _handle_subscription(connection, message)
+        return
+    if message.get("event") != "resync":
+        return
+    updated_type = message.get("updated_type", "World")
+    updated_id = message.get("updated_id")
+    if updated_type in EntityVersions.SUBSCRIBED_TYPES:
+        updated_id = _entity_id(updated_id)
+    snapshot = entity_versions.snapshot(updated_type, updated_id)
+    if snapshot is None:
+        snapshot = {
+            "event": "snapshot",
+            "updated_type": updated_type,
+            "updated_id": updated_id,
+            "version": 0,
+            "updated_value": None,
+        }
+    connection.send(snapshot)
+
+
+def _handle_subscription(connection: ClientConnection, message: Dict[str, Any]) -> None:
+    updated_type = message.get("updated_type")
+    updated_ids = message.get("updated_ids")
+    if updated_type not in EntityVersions.SUBSCRIBED_TYPES or not isinstance(updated_ids, list):
+        return
+    # character ids are ints, "3" from a client is the same character as 3
+    updated_ids = [i for i in map(_entity_id, updated_ids) if i is not None]
+    subscribed = connection.subscriptions.setdefault(updated_type, set())
+    if message["event"] == "unsubscribe":
+        subscribed.difference_update(updated_ids)
+        return
+    subscribed.update(updated_ids)
+    connection.send(
+        {
+            "event": "versions",
+            "updated_type": updated_type,
+            "versions": entity_versions.versions_of(updated_type, updated_ids),
+        }
+    )
+
+
+def _entity_id(value: Any) -> Optional[int]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            return None
+    return None
 
 
 def notify_update_in_background(
-    updated_type: Literal["World", "Character", "Event"],
+    updated_type: Literal["World", "Character", "Event", "Weather"],
     updated_id: str,
     updated_value: Any,
+    previous: Any = None,
+    ops: Optional[List[Dict[str, Any]]] = None,
 ):
-    task = asyncio.create_task(notifyUpdate(updated_type, updated_id, updated_value))
+    """
+    Broadcasting only queues the message, it is safe to call from anywhere
+    on the event loop without awaiting. See EntityVersions.publish for
+    previous and ops.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        # no event loop, e.g. a script, nobody can be connected
+        return
+    _broadcast_update(updated_type, updated_id, updated_value, previous, ops)
 
-    def done_callback(future):
-        try:
-            result = future.result()
-            print("Task completed:", result)
-        except Exception as e:
-            print("Task failed:", e)
 
-    task.add_done_callback(done_callback)
+def notify_updates_in_background(
+    updated_type: Literal["Character"],
+    updates: List[Tuple[Any, Any, Optional[List[Dict[str, Any]]]]],
+) -> None:
+    """
+    Same as notify_update_in_background for (updated_id, updated_value, ops)
+    of many entities of a subscribed type, sent as one batch message per
+    client, see Broadcaster.broadcast_batch.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    with metrics.stage("broadcast", entities=len(updates)):
+        messages = []
+        for updated_id, updated_value, ops in updates:
+            message = entity_versions.publish(updated_type, updated_id, updated_value, None, ops)
+            if message is not None:
+                messages.append((message, (updated_type, updated_id)))
+        broadcaster.broadcast_batch(messages)
 
 
 async def notifyUpdate(
-    updated_type: Literal["World", "Character", "Event"],
+    updated_type: Literal["World", "Character", "Event", "Weather"],
     updated_id: str,
     updated_value: Any,
 ) -> None:
@@ -36,11 +462,31 @@ async def notifyUpdate(
         updated_id: ID of the updated entity
         updated_value: New value/state of the entity
     """
-    message = {
-        "event": "update",
-        "updated_type": updated_type,
-        "updated_id": updated_id,
-        "updated_value": updated_value,
-    }
-    for client in clients:
-        await client.send_json(message)
+    _broadcast_update(updated_type, updated_id, updated_value)
+
+
+def _broadcast_update(updated_type, updated_id, updated_value, previous=None, ops=None) -> int:
+    with metrics.stage("broadcast"):
+        return _publish_update(updated_type, updated_id, updated_value, previous, ops)
+
+
+def _publish_update(updated_type, updated_id, updated_value, previous=None, ops=None) -> int:
+    if updated_type == "Event":
+        # events are not versioned entities, every one of them is delivered as is
+        message = {
+            "event": "update",
+            "updated_type": updated_type,
+            "updated_id": updated_id,
+            "updated_value": updated_value,
+        }
+        return broadcaster.broadcast(message)
+    message = entity_versions.publish(updated_type, updated_id, updated_value, previous, ops)
+    if message is None:
+        return 0
+    entity = (
+        (updated_type, updated_id)
+        if updated_type in EntityVersions.SUBSCRIBED_TYPES
+        else None
+    )
+    # a coalesced patch leaves a version gap, the client then resyncs
+    return broadcaster.broadcast(message, f"{updated_type}:{updated_id}", entity)
@@ -0,0 +1,494 @@
+"""
+Coordinator/worker mode: the events of a day are processed by worker
+processes, on this host or on others, which lease them from a SQLite queue.
+
+With SIM_WORKERS set, World._sim_one_day is the coordinator. Each event is
+put in the queue as a work item holding everything its prompt needs: the
+event, the characters involved, the weathers and their recalled memories.
+A worker leases an item, asks the LLM to narrate the event, validates it
+and stores the result. The coordinator applies the results in event order:
+character updates, memories, the relationship graph and the event log all
+stay in the coordinator, so there is still a single writer.
+
+Leases last SIM_WORK_LEASE_SECONDS and a worker renews them while it works,
+so the items of a crashed worker are leased again by another one once the
+lease ran out, up to SIM_WORK_MAX_ATTEMPTS times. If for
+SIM_WORK_STALL_SECONDS no item finished and none is leased, e.g. no worker
+is running, the coordinator gives up: the day fails and its items are removed.
+
+Since the results are only applied at the end of the day, a worker sees the
+characters as they were when the event was queued: an event does not see the
+earlier events of the same day in events_latest_10, as it does when events
+are processed in this process.
+
+SIM_WORKERS=N starts N local worker processes. Workers on other hosts only
+need the queue file, e.g. on a shared volume, and the same code:
+    python -m workers --queue /shared/work_queue.db
+"""
+
+import argparse
+import asyncio
+import collections
+import functools
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from typing import (
+    Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+)
+
+import structured_log
+from structured_log import correlate, correlation_ids, get_logger
+
+log = get_logger("workers")
+
+# local worker processes started by the coordinator; -1 processes events in
+# this process, 0 leaves them to workers started with python -m workers
+SIM_WORKERS = int(os.getenv("SIM_WORKERS", "-1"))
+SIM_WORK_QUEUE_PATH = os.getenv("SIM_WORK_QUEUE_PATH", "work_queue.db")
+SIM_WORK_LEASE_SECONDS = float(os.getenv("SIM_WORK_LEASE_SECONDS", "120"))
+SIM_WORK_MAX_ATTEMPTS = int(os.getenv("SIM_WORK_MAX_ATTEMPTS", "3"))
+# items a worker processes at the same time, they mostly wait for the LLM
+SIM_WORKER_CONCURRENCY = int(os.getenv("SIM_WORKER_CONCURRENCY", "4"))
+SIM_WORK_POLL_SECONDS = float(os.getenv("SIM_WORK_POLL_SECONDS", "0.05"))
+SIM_WORK_STALL_SECONDS = float(os.getenv("SIM_WORK_STALL_SECONDS", "60"))
+MAX_IDLE_SECONDS = 0.25
+
+
+def enabled() -> bool:
+    return SIM_WORKERS >= 0
+
+
+class WorkStalledError(RuntimeError):
+    """
+    No worker made progress on the items of a day, see Coordinator.results.
+    """
+
+
+class WorkQueue:
+    """
+    Work items in SQLite, shared by the coordinator and the workers of any
+    process that can open the file.
+
+    An item is pending, leased by a worker until lease_until, done with a
+    result, or failed with an error. Leasing and finishing are transactions,
+    so an item is never leased twice at the same time, and a worker whose
+    lease ran out can no longer finish it.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS work_items (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        day TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        worker TEXT,
+        lease_until REAL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        result TEXT,
+        error TEXT
+    );
+    CREATE INDEX IF NOT EXISTS work_items_status ON work_items (status, id);
+    """
+
+    def __init__(
+        self,
+        path: str = SIM_WORK_QUEUE_PATH,
+        lease_seconds: float = SIM_WORK_LEASE_SECONDS,
+        max_attempts: int = SIM_WORK_MAX_ATTEMPTS,
+    ):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        # transactions are explicit, see _transaction
+        self._conn = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+
+    def _transaction(self, sql: str, params=()) -> sqlite3.Cursor:
+        # BEGIN IMMEDIATE takes the write lock up front, so two processes
+        # cannot both read an item as free and lease it
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = self._conn.execute(sql, params)
+            self._conn.execute("COMMIT")
+            return cursor
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def put(self, day: str, payload: Dict[str, Any]) -> int:
+        with self._lock:
+            return self._transaction(
+                "INSERT INTO work_items (day, payload) VALUES (?, ?)",
+                (day, json.dumps(payload)),
+            ).lastrowid
+
+    def lease(self, worker: str, limit: int = 1) -> List[Tuple[int, Dict[str, Any]]]:
+        """
+        Up to limit of the oldest items that are pending or whose lease ran
+        out, now leased by worker.
+        """
+        now = time.time()
+        free = (
+            "(status = 'pending' OR (status = 'leased' AND lease_until < ?)) "
+            "ORDER BY id LIMIT ?"
+        )
+        with self._lock:
+            # readers do not block in WAL mode, an idle worker only looks
+            if not self._conn.execute(
+                f"SELECT 1 FROM work_items WHERE {free}", (now, 1)
+            ).fetchone():
+                return []
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "UPDATE work_items SET status = 'failed', "
+                    "error = 'lease expired ' || attempts || ' times' "
+                    "WHERE status = 'leased' AND lease_until < ? AND attempts >= ?",
+                    (now, self.max_attempts),
+                )
+                rows = self._conn.execute(
+                    f"SELECT id, payload FROM work_items WHERE {free}", (now, limit)
+                ).fetchall()
+                self._conn.executemany(
+                    "UPDATE work_items SET status = 'leased', worker = ?, "
+                    "lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                    [(worker, now + self.lease_seconds, item_id) for item_id, _ in rows],
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [(item_id, json.loads(payload)) for item_id, payload in rows]
+
+    def renew(self, item_id: int, worker: str) -> bool:
+        """
+        Extend the lease of worker on the item, False if it lost it.
+        """
+        with self._lock:
+            return bool(
+                self._transaction(
+                    "UPDATE work_items SET lease_until = ? "
+                    "WHERE id = ? AND worker = ? AND status = 'leased'",
+                    (time.time() + self.lease_seconds, item_id, worker),
+                ).rowcount
+            )
+
+    def complete(self, item_id: int, worker: str, result: Dict[str, Any]) -> bool:
+        """
+        Store the result of a leased item, False if the lease was lost.
+        """
+        with self._lock:
+            return bool(
+                self._transaction(
+                    "UPDATE work_items SET status = 'done', result = ?, lease_until = NULL "
+                    "WHERE id = ? AND worker = ? AND status = 'leased'",
+                    (json.dumps(result), item_id, worker),
+                ).rowcount
+            )
+
+    def fail(self, item_id: int, worker: str, error: str) -> bool:
+        """
+        Give a leased item back for another attempt, or fail it once it had
+        max_attempts. False if the lease was lost.
+        """
+        with self._lock:
+            return bool(
+                self._transaction(
+                    "UPDATE work_items SET error = ?, worker = NULL, lease_until = NULL, "
+                    "status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END "
+                    "WHERE id = ? AND worker = ? AND status = 'leased'",
+                    (error, self.max_attempts, item_id, worker),
+                ).rowcount
+            )
+
+    def finished(
+        self, item_ids: List[int]
+    ) -> Dict[int, Tuple[Optional[Dict[str, Any]], Optional[str]]]:
+        """
+        (result, None) of the done items among item_ids and (None, error) of
+        the failed ones.
+        """
+        if not item_ids:
+            return {}
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, status, result, error FROM work_items "
+                "WHERE status IN ('done', 'failed') AND id IN "
+                f"({','.join('?' * len(item_ids))})",
+                item_ids,
+            ).fetchall()
+        return {
+            item_id: (json.loads(result), None) if status == "done" else (None, error)
+            for item_id, status, result, error in rows
+        }
+
+    def leased(self, day: str) -> int:
+        """
+        Items of the day a worker holds a live lease on.
+        """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT count(*) FROM work_items "
+                "WHERE day = ? AND status = 'leased' AND lease_until >= ?",
+                (day, time.time()),
+            ).fetchone()[0]
+
+    def delete(self, item_ids: List[int]) -> None:
+        if not item_ids:
+            return
+        with self._lock:
+            self._transaction(
+                f"DELETE FROM work_items WHERE id IN ({','.join('?' * len(item_ids))})",
+                item_ids,
+            )
+
+    def clear(self, day: str) -> int:
+        """
+        Drop the items of a day, e.g. left by a coordinator that crashed.
+        """
+        with self._lock:
+            return self._transaction("DELETE FROM work_items WHERE day = ?", (day,)).rowcount
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, count(*) FROM work_items GROUP BY status"
+            ).fetchall()
+        return dict(rows)
+
+
+@functools.lru_cache(maxsize=1)
+def get_work_queue() -> WorkQueue:
+    return WorkQueue()
+
+
+class Coordinator:
+    """
+    Puts the events of one day in the queue and hands back the results in
+    the order the caller asks for them.
+    """
+
+    def __init__(
+        self,
+        day: str,
+        queue: Optional[WorkQueue] = None,
+        stall_seconds: float = SIM_WORK_STALL_SECONDS,
+    ):
+        self.day = day
+        self.queue = queue or get_work_queue()
+        self.stall_seconds = stall_seconds
+        stale = self.queue.clear(day)
+        if stale:
+            log.warning(f"Dropped {stale} work items left from an earlier run of {day}")
+        start_local_workers()
+
+    async def submit(self, payload: Dict[str, Any]) -> int:
+        # the log records of the worker carry the day, event and job ids
+        payload = {**payload, "correlation": correlation_ids()}
+        return await asyncio.to_thread(self.queue.put, self.day, payload)
+
+    async def results(
+        self, item_ids: List[int]
+    ) -> AsyncIterator[Tuple[int, Optional[Dict[str, Any]], Optional[str]]]:
+        """
+        (item id, result, error) of every item, in the order of item_ids,
+        each as soon as it and all the items before it are finished.
+        Yielded items are removed from the queue.
+
+        Raises:
+            WorkStalledError: when for stall_seconds no item finished and no
+                worker held a lease. On any error, or if the caller stops
+                early, the items of the day are removed, so workers lose
+                their leases and nothing is left for the next run.
+        """
+        waiting = collections.deque(item_ids)
+        finished: Dict[int, Tuple[Optional[Dict[str, Any]], Optional[str]]] = {}
+        last_progress = time.monotonic()
+        try:
+            while waiting:
+                unfinished = [item_id for item_id in waiting if item_id not in finished]
+                finished.update(await asyncio.to_thread(self.queue.finished, unfinished))
+                ready = []
+                while waiting and waiting[0] in finished:
+                    ready.append(waiting.popleft())
+                for item_id in ready:
+                    yield (item_id, *finished.pop(item_id))
+                await asyncio.to_thread(self.queue.delete, ready)
+                if ready:
+                    last_progress = time.monotonic()
+                    continue
+                if time.monotonic() - last_progress > self.stall_seconds:
+                    # a worker renews its leases, slow items are not a stall
+                    if not await asyncio.to_thread(self.queue.leased, self.day):
+                        raise WorkStalledError(
+                            f"No worker leased any of {len(waiting)} work items of "
+                            f"{self.day} for {self.stall_seconds:g}s, are workers running?"
+                        )
+                    last_progress = time.monotonic()
+                await asyncio.sleep(SIM_WORK_POLL_SECONDS)
+        except BaseException:
+            await asyncio.to_thread(self.queue.clear, self.day)
+            raise
+
+
+async def process_item(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    The worker side of an event: the narrated event, validated.
+    """
+    # imported here, World imports this module
+    from Character import Character, Event
+    from World import Weather, World
+
+    event = Event.model_validate(payload["event"])
+    with correlate(**payload.get("correlation", {})):
+        processed_event = await World.narrate_event(
+            event,
+            [Character.model_validate(c) for c in payload["characters"]],
+            [Weather.model_validate(w) for w in payload["weathers"]],
+            payload.get("note"),
+            payload.get("memories"),
+        )
+    return {"event": processed_event.model_dump(mode="json")}
+
+
+async def run_worker(
+    queue: Optional[WorkQueue] = None,
+    name: Optional[str] = None,
+    concurrency: int = SIM_WORKER_CONCURRENCY,
+    handler: Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]] = process_item,
+    parent: Optional[int] = None,
+) -> None:
+    """
+    Lease and process items until cancelled, or until the parent process
+    that started this worker is gone.
+    """
+    queue = queue or get_work_queue()
+    name = name or f"{socket.gethostname()}-{os.getpid()}"
+
+    async def keep_leased(item_id: int) -> None:
+        while True:
+            await asyncio.sleep(queue.lease_seconds / 3)
+            if not await asyncio.to_thread(queue.renew, item_id, name):
+                log.warning(f"Lost the lease on work item {item_id}")
+                return
+
+    async def process(item_id: int, payload: Dict[str, Any]) -> None:
+        renewing = asyncio.create_task(keep_leased(item_id))
+        try:
+            result = await handler(payload)
+        except Exception as e:
+            log.warning(f"Work item {item_id} failed: {e}", exc_info=True)
+            await asyncio.to_thread(queue.fail, item_id, name, f"{type(e).__name__}: {e}")
+        else:
+            if not await asyncio.to_thread(queue.complete, item_id, name, result):
+                log.warning(f"Work item {item_id} was leased again before it finished")
+        finally:
+            renewing.cancel()
+
+    log.info(f"Worker {name} started on {queue.path}", concurrency=concurrency)
+    running: Set[asyncio.Task] = set()
+    idle = SIM_WORK_POLL_SECONDS
+    try:
+        while parent is None or os.getppid() == parent:
+            free = max(1, concurrency) - len(running)
+            leased = await asyncio.to_thread(queue.lease, name, free) if free else []
+            for item_id, payload in leased:
+                task = asyncio.create_task(process(item_id, payload))
+                running.add(task)
+                task.add_done_callback(running.discard)
+            if leased:
+                idle = SIM_WORK_POLL_SECONDS
+                continue
+            # poll again when an item is done or after a while, longer when idle
+            if running:
+                await asyncio.wait(
+                    running, timeout=idle, return_when=asyncio.FIRST_COMPLETED
+                )
+            else:
+                await asyncio.sleep(idle)
+            if free:
+                idle = min(idle * 2, MAX_IDLE_SECONDS)
+    finally:
+        for task in running:
+            task.cancel()
+
+
+# slot -> process, a worker that died is replaced in its slot
+_local_workers: Dict[int, subprocess.Popen] = {}
+
+
+def start_local_workers(count: int = SIM_WORKERS) -> None:
+    """
+    Keep count worker processes running on this host, each logging to its
+    own directory under LOG_DIR.
+    """
+    source = os.path.dirname(os.path.abspath(__file__))
+    started = 0
+    for n in range(count):
+        process = _local_workers.get(n)
+        if process is not None and process.poll() is None:
+            continue
+        env = dict(
+            os.environ,
+            PYTHONPATH=os.pathsep.join([source, os.environ.get("PYTHONPATH", "")]),
+            LOG_DIR=os.path.join(structured_log.LOG_DIR, f"worker-{n}"),
+            SIM_WORK_QUEUE_PATH=os.path.abspath(get_work_queue().path),
+        )
+        command = [sys.executable, "-m", "workers", "--parent", str(os.getpid())]
+        _local_workers[n] = subprocess.Popen(command, env=env)
+        started += 1
+    if started:
+        log.info(f"Started {started} local workers, {count} running")
+
+
+def stop_local_workers(timeout: float = 5.0) -> None:
+    for process in _local_workers.values():
+        process.terminate()
+    for process in _local_workers.values():
+        try:
+            process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    _local_workers.clear()
+
+
+async def _main(args) -> None:
+    from chat import close_client
+
+    try:
+        await run_worker(
+            WorkQueue(args.queue), args.name, args.concurrency, parent=args.parent
+        )
+    finally:
+        await close_client()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Process simulated events from a work queue.")
+    parser.add_argument("--queue", default=SIM_WORK_QUEUE_PATH)
+    parser.add_argument("--name", help="worker id in the queue, host-pid by default")
+    parser.add_argument("--concurrency", type=int, default=SIM_WORKER_CONCURRENCY)
+    parser.add_argument("--parent", type=int, help="exit when this process is gone")
+    args = parser.parse_args()
+    structured_log.start_logging()
+    try:
+        asyncio.run(_main(args))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        structured_log.stop_logging()
+
+
+if __name__ == "__main__":
+    main()